@@ -0,0 +1,90 @@
+"""`questgit add .` scaling benchmark across worker counts.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_add --files 100000 --jobs 1 2 4 8
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils.constants import GIT_DIR
+from utils.logger_utils import LoggerUtil
+from questgit.index import Index
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_tree(path: str, count: int):
+    rng = random.Random(count)
+    for n in range(count):
+        directory = os.path.join(path, f"d{n % 100}", f"s{n % 7}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"f{n}.txt"), "wb") as f:
+            f.write(os.urandom(rng.randint(32, 2048)).hex().encode())
+
+
+def run_add(path: str, jobs: int) -> float:
+    shutil.rmtree(os.path.join(path, GIT_DIR), ignore_errors=True)
+    for directory in ("objects", "refs/heads"):
+        os.makedirs(os.path.join(path, GIT_DIR, directory))
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "cli", "add", "-j", str(jobs), "."],
+        cwd=path,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def staged_entries(path: str) -> dict:
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        entries = Index().entries
+    finally:
+        os.chdir(cwd)
+    return {
+        filepath: blob_hash
+        for filepath, blob_hash in entries.items()
+        if not filepath.startswith(LoggerUtil.LOG_DIR + os.sep)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_tree(tmp, args.files)
+
+        baseline = None
+        reference_index = None
+        print(f"{'jobs':>5} {'seconds':>9} {'speedup':>8}")
+        for jobs in args.jobs:
+            elapsed = run_add(tmp, jobs)
+            baseline = baseline or elapsed
+            print(f"{jobs:>5} {elapsed:>9.2f} {baseline / elapsed:>7.2f}x")
+
+            # Every job count must stage the same content. The log file is
+            # written while add runs, so it is left out of the comparison.
+            entries = staged_entries(tmp)
+            if reference_index is None:
+                reference_index = entries
+            elif entries != reference_index:
+                print(f"  index differs from the first run with -j {jobs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Index load benchmark: text index (v1) versus binary mmap index (v2).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_index --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import zlib
+
+from utils.constants import GIT_DIR, INDEX_FILE
+from questgit.index import Index, TEXT_INDEX_SIGNATURE
+
+
+def make_entries(count: int):
+    rng = random.Random(count)
+    entries = {}
+    for n in range(count):
+        depth = rng.randint(0, 4)
+        dirs = "/".join(f"dir{rng.randint(0, 50)}" for _ in range(depth))
+        path = f"{dirs}/file{n}.txt" if dirs else f"file{n}.txt"
+        entries[path] = f"{rng.getrandbits(160):040x}"
+    return entries
+
+
+def write_text_index(entries):
+    lines = [TEXT_INDEX_SIGNATURE]
+    for path, hash_val in entries.items():
+        lines.append(f"{hash_val} 1 1 1 1 33188 {path}")
+    with open(INDEX_FILE, "wb") as f:
+        f.write(zlib.compress("\n".join(lines).encode("utf-8")))
+
+
+def timed(func, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(count: int):
+    entries = make_entries(count)
+    probe = random.Random(0).sample(list(entries), min(1000, count))
+
+    write_text_index(entries)
+    text_load = timed(lambda: Index().entries)
+
+    index = Index()
+    index.save()
+    size = os.path.getsize(INDEX_FILE)
+
+    open_only = timed(Index)
+    full_load = timed(lambda: Index().entries)
+
+    lookup_index = Index()
+    lookups = timed(lambda: [lookup_index.get_entry(p) for p in probe])
+
+    print(
+        f"{count:>9} {text_load * 1000:>12.1f} {open_only * 1000:>10.2f} "
+        f"{full_load * 1000:>12.1f} {lookups / len(probe) * 1e6:>12.2f} "
+        f"{size / 1024 / 1024:>8.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'entries':>9} {'v1 load ms':>12} {'v2 open ms':>10} "
+        f"{'v2 parse ms':>12} {'lookup us':>12} {'v2 MiB':>8}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            os.makedirs(GIT_DIR)
+            for count in args.sizes:
+                run(count)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
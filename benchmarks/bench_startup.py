@@ -0,0 +1,159 @@
+"""CLI start-up benchmark: import time and wall time per subcommand.
+
+Builds a small repository, then runs each subcommand repeatedly and
+reports the median wall time, the median time spent importing modules
+(from python -X importtime) and the time beyond a bare interpreter.
+
+Import times depend on the machine, so the guard against start-up
+regressions compares against a run saved on the same machine: exits
+with status 1 when a subcommand imports for longer than its baseline
+time plus the tolerance, or longer than --budget-ms when that is given.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --save-baseline startup.json
+    python -m benchmarks.bench_startup --baseline startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(args, cwd: str, env: dict) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+
+def questgit(args, cwd: str, env: dict, stdin: bytes = b"") -> bytes:
+    return subprocess.run(
+        [sys.executable, "-m", "cli", *args],
+        cwd=cwd,
+        env=env,
+        input=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    ).stdout
+
+
+def make_repo(path: str, env: dict, files: int) -> str:
+    questgit(["init"], path, env, b"Bench\nbench@example.com\n")
+    for n in range(files):
+        directory = os.path.join(path, f"d{n % 10}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"f{n}.txt"), "w") as f:
+            f.write(f"file {n}\n")
+    questgit(["add", "."], path, env)
+    questgit(["commit", "-m", "bench"], path, env)
+    with open(os.path.join(path, ".questgit", "refs", "heads", "master")) as f:
+        return f.read().strip()
+
+
+# Milliseconds spent importing, from the top-level entries of
+# -X importtime that come after the interpreter's own start-up
+def import_ms(stderr: str) -> float:
+    total = 0
+    counting = False
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2][1:]
+        if name.startswith(" "):
+            continue  # nested import, counted by its parent
+        if name == "runpy":
+            counting = True
+        elif counting:
+            total += int(fields[1])
+    return total / 1000
+
+
+def measure(args, cwd: str, env: dict, runs: int):
+    wall = []
+    imports = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(args, cwd, env)
+        wall.append((time.perf_counter() - start) * 1000)
+        result = run(["-X", "importtime", *args], cwd, env)
+        imports.append(import_ms(result.stderr.decode()))
+    return statistics.median(wall), statistics.median(imports)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument(
+        "--budget-ms", type=float,
+        help="most import time allowed for any subcommand",
+    )
+    parser.add_argument("--baseline", help="JSON file written by --save-baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.5,
+        help="import time allowed over the baseline, as a fraction of it",
+    )
+    parser.add_argument("--save-baseline", help="write the import times to this file")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+    with tempfile.TemporaryDirectory() as tmp:
+        head = make_repo(tmp, env, args.files)
+        commands = [
+            [],
+            ["config", "--check"],
+            ["status"],
+            ["log", "-n", "1"],
+            ["cat-file", "-p", head],
+            ["unstage", "missing.txt"],
+            ["restore"],
+        ]
+
+        bare, _ = measure(["-c", "pass"], tmp, env, args.runs)
+        print(f"{'command':<24} {'wall ms':>8} {'over bare':>10} {'import ms':>10}")
+        print(f"{'python -c pass':<24} {bare:>8.1f}")
+
+        results = {}
+        over_budget = []
+        for command in commands:
+            wall, imports = measure(["-m", "cli", *command], tmp, env, args.runs)
+            label = " ".join(command[:2]) or "(usage)"
+            print(f"{label:<24} {wall:>8.1f} {wall - bare:>10.1f} {imports:>10.1f}")
+            results[label] = imports
+            if args.budget_ms is not None and imports > args.budget_ms:
+                over_budget.append(f"{label} (budget {args.budget_ms:g} ms)")
+            if label in baseline and imports > baseline[label] * (1 + args.tolerance):
+                over_budget.append(f"{label} (baseline {baseline[label]:.1f} ms)")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if over_budget:
+        print(f"Import time over budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
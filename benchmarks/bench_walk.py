@@ -0,0 +1,82 @@
+"""Working-tree walk benchmark: os.walk + relpath + lstat versus the scandir walker.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_walk --files 500000 --threads 1 4 16
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from questgit.repository import Repository
+
+CHECK_THREADS = 4
+
+
+# Deep tree: fanout directories per level, files spread over the leaves
+def make_tree(path: str, count: int, depth: int, fanout: int):
+    leaves = [""]
+    for _ in range(depth):
+        leaves = [os.path.join(leaf, f"d{n}") for leaf in leaves for n in range(fanout)]
+    for leaf in leaves:
+        os.makedirs(os.path.join(path, leaf), exist_ok=True)
+    for n in range(count):
+        leaf = leaves[n % len(leaves)]
+        with open(os.path.join(path, leaf, f"f{n}.txt"), "wb") as f:
+            f.write(b"x")
+
+
+# What add and status did before: walk, then relpath and lstat per file
+def os_walk(path: str) -> dict:
+    files = {}
+    for root, dirs, filenames in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in Repository.IGNORED_DIRS]
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            files[os.path.relpath(filepath, path)] = os.lstat(filepath)
+    return files
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=500_000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=6)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_tree(tmp, args.files, args.depth, args.fanout)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            baseline, expected = timed(os_walk, ".")
+            # The serial and the threaded walker have to find the same files
+            for threads in (1, CHECK_THREADS):
+                found = {filepath for filepath, _ in Repository.walk_files(threads=threads)}
+                if found != expected.keys():
+                    raise SystemExit(f"walk with {threads} thread(s) differs from os.walk")
+
+            print(f"{'walker':>14} {'seconds':>9} {'speedup':>8}")
+            print(f"{'os.walk':>14} {baseline:>9.2f} {1:>7.2f}x")
+            for threads in args.threads:
+                elapsed, files = timed(
+                    lambda: dict(Repository.walk_files(threads=threads))
+                )
+                label = f"scandir -t {threads}"
+                print(f"{label:>14} {elapsed:>9.2f} {baseline / elapsed:>7.2f}x")
+                if files.keys() != expected.keys():
+                    print(f"  file list differs from os.walk with {threads} threads")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
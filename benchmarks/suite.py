@@ -0,0 +1,355 @@
+"""End-to-end benchmark suite over a synthetic repository.
+
+Each scenario generates a tree (see benchmarks.synthetic), then times
+init, add ., commit, building the rest of the history, status on a
+modified tree, log, restore of deleted files and cat-file. It runs two
+ways:
+
+    cli      every step is `python -m cli ...` in its own process, like a
+             user would run it, start-up included
+    library  the steps call Index, WorkTree, Staging, Commit, Checkout and
+             ObjectStore directly in one process
+
+Every scenario runs in a fresh interpreter, so no cache carries over
+between repeats or modes. --backends runs each mode once per object
+store backend; results other than the loose backend's are labelled
+"<mode>+<backend>". Results are written as JSON; pass an earlier file to
+--compare to flag steps that got slower than --threshold.
+
+Run from the repository root:
+
+    python -m benchmarks.suite --files 20000 --history 10 --output after.json \\
+        --compare before.json --threshold 0.10
+    python -m benchmarks.suite --backends loose sqlite
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from benchmarks.synthetic import RepoSpec, SyntheticRepo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ["cli", "library"]
+BACKENDS = ["loose", "sqlite"]
+STEPS = ["init", "add", "commit", "history", "status", "log", "restore", "cat-file"]
+# Steps faster than this are not flagged, whatever their ratio
+MIN_REGRESSION_SECONDS = 0.01
+
+
+class CLIRunner:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.env = dict(os.environ, PYTHONPATH=ROOT)
+
+    def _run(self, *args: str, stdin: bytes = b""):
+        subprocess.run(
+            [sys.executable, "-m", "cli", *args],
+            cwd=self.path,
+            env=self.env,
+            input=stdin,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+    def init(self):
+        self._run("init", stdin=b"Bench\nbench@example.com\n")
+
+    def use_backend(self, name: str):
+        self._run("object-store", "migrate", name)
+
+    def add(self):
+        self._run("add", ".")
+
+    def commit(self, message: str):
+        self._run("commit", "-m", message)
+
+    def status(self):
+        self._run("status")
+
+    def log(self, count: int):
+        self._run("log", "-n", str(count))
+
+    def restore(self):
+        self._run("restore")
+
+    def cat_file(self, hashes: List[str]):
+        for blob_hash in hashes:
+            self._run("cat-file", "-p", blob_hash)
+
+
+# The same steps through the library classes, without the CLI's output
+class LibraryRunner:
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def init(self):
+        from questgit.repository import Repository
+
+        stdin = sys.stdin
+        sys.stdin = io.StringIO("Bench\nbench@example.com\n")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                Repository.init()
+        finally:
+            sys.stdin = stdin
+
+    def use_backend(self, name: str):
+        from questgit.objects import ObjectStore
+
+        ObjectStore.migrate(name)
+
+    def add(self):
+        from questgit.index import Index
+        from questgit.staging import Staging
+        from questgit.worktree import WorkTree
+
+        index = Index()
+        scan = WorkTree.scan(index)
+        for filepath in scan.missing:
+            index.remove_entry(filepath)
+
+        to_stage = [
+            filepath
+            for filepath, st in scan.files.items()
+            if not (index.get_entry(filepath) and index.stat_matches(filepath, st))
+        ]
+        failed = set()
+        for filepath, blob_hash, _, _ in Staging.stage_files(
+            sorted(to_stage), Staging.default_jobs()
+        ):
+            if blob_hash is None:
+                failed.add(filepath)
+            else:
+                index.add_entry(filepath, blob_hash, scan.files[filepath])
+        index.save()
+        scan.save_state(index, failed)
+
+    def commit(self, message: str):
+        from questgit.commit import Commit
+
+        Commit.create_commit(message)
+
+    def status(self):
+        from questgit.index import Index
+        from questgit.worktree import WorkTree
+
+        index = Index()
+        scan = WorkTree.scan(index)
+        modified = set()
+        for filepath, st in scan.files.items():
+            staged_hash = index.get_entry(filepath)
+            if staged_hash is not None and index.hash_file(filepath, st) != staged_hash:
+                modified.add(filepath)
+        if index.dirty:
+            index.save()
+        scan.save_state(index, modified | scan.missing)
+
+    def log(self, count: int):
+        from questgit.commit import Commit
+
+        Commit.get_log(max_count=count)
+
+    def restore(self):
+        from questgit.checkout import Checkout
+        from questgit.index import Index
+
+        index = Index()
+        Checkout.restore(index, index.sorted_paths())
+        if index.dirty:
+            index.save()
+
+    def cat_file(self, hashes: List[str]):
+        from questgit.objects import ObjectStore
+
+        with open(os.devnull, "wb") as out:
+            for blob_hash in hashes:
+                ObjectStore.stream_blob(blob_hash, out)
+
+
+def timed(func: Callable, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def sample_blobs(count: int) -> List[str]:
+    from questgit.index import Index
+
+    index = Index()
+    paths = index.sorted_paths()
+    step = max(1, len(paths) // max(1, count))
+    return [index.get_entry(path) for path in paths[::step][:count]]
+
+
+def label(mode: str, backend: str) -> str:
+    return mode if backend == "loose" else f"{mode}+{backend}"
+
+
+# Runs in a fresh interpreter: one full scenario in a new temporary
+# repository, returning seconds per step
+def run_scenario(
+    mode: str, backend: str, spec_dict: dict, cat_file_samples: int
+) -> Dict[str, float]:
+    spec = RepoSpec(**spec_dict)
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = SyntheticRepo(tmp, spec)
+        repo.generate()
+        os.chdir(tmp)
+        runner = CLIRunner(tmp) if mode == "cli" else LibraryRunner(tmp)
+
+        timings = {"init": timed(runner.init)}
+        if backend != "loose":
+            runner.use_backend(backend)
+        timings.update({
+            "add": timed(runner.add),
+            "commit": timed(runner.commit, "commit 0"),
+        })
+
+        history = 0.0
+        for n in range(1, spec.history):
+            repo.modify()
+            history += timed(runner.add)
+            history += timed(runner.commit, f"commit {n}")
+        timings["history"] = history
+
+        repo.modify()
+        timings["status"] = timed(runner.status)
+        timings["log"] = timed(runner.log, spec.history)
+
+        repo.delete()
+        timings["restore"] = timed(runner.restore)
+        timings["cat-file"] = timed(runner.cat_file, sample_blobs(cat_file_samples))
+        os.chdir(ROOT)
+    return timings
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_suite(
+    spec: RepoSpec, modes: List[str], backends: List[str], repeat: int, cat_file_samples: int
+) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for mode in modes:
+        for backend in backends:
+            runs: Dict[str, List[float]] = {step: [] for step in STEPS}
+            for _ in range(repeat):
+                with context.Pool(1) as pool:
+                    timings = pool.apply(
+                        run_scenario, (mode, backend, spec.to_dict(), cat_file_samples)
+                    )
+                for step in STEPS:
+                    runs[step].append(timings[step])
+            results[label(mode, backend)] = {
+                step: {"median": statistics.median(values), "runs": values}
+                for step, values in runs.items()
+            }
+
+    return {
+        "revision": git_revision(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "spec": spec.to_dict(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def print_results(report: dict):
+    modes = list(report["results"])
+    print(f"{'step':<10}" + "".join(f"{mode + ' s':>18}" for mode in modes))
+    for step in STEPS:
+        row = "".join(
+            f"{report['results'][mode][step]['median']:>18.3f}" for mode in modes
+        )
+        print(f"{step:<10}{row}")
+
+
+# Prints each step's ratio to the baseline; returns the regressed steps
+def compare(report: dict, baseline: dict, threshold: float) -> List[str]:
+    if baseline.get("spec") != report["spec"]:
+        print("Warning: baseline was run with a different repository spec")
+
+    regressions = []
+    print(f"\nAgainst {baseline.get('revision', 'baseline')} (threshold {threshold:.0%}):")
+    for mode, steps in report["results"].items():
+        for step, result in steps.items():
+            old = baseline.get("results", {}).get(mode, {}).get(step)
+            if old is None:
+                continue
+            before, after = old["median"], result["median"]
+            ratio = after / before if before else float("inf")
+            regressed = (
+                ratio > 1 + threshold and after - before > MIN_REGRESSION_SECONDS
+            )
+            flag = "  REGRESSION" if regressed else ""
+            print(f"  {mode:<14} {step:<10} {before:>9.3f} -> {after:>9.3f} s {ratio:>6.2f}x{flag}")
+            if regressed:
+                regressions.append(f"{mode} {step}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    RepoSpec.add_arguments(parser)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument(
+        "--backends", nargs="+", choices=BACKENDS, default=["loose"],
+        help="object store backends to run every mode with",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cat-file-samples", type=int, default=20)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument(
+        "--threshold", type=float, default=0.10,
+        help="slowdown over the baseline that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    report = run_suite(
+        RepoSpec.from_args(args), args.modes, args.backends, args.repeat, args.cat_file_samples
+    )
+    print_results(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
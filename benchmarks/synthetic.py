@@ -0,0 +1,153 @@
+"""Synthetic working trees for benchmarks.
+
+A RepoSpec describes the tree: how many files, how their sizes are
+distributed, how deep the directories go, what share is binary, and how
+many commits of history to build with what share of files changing in
+each. The same spec and seed always produce the same files, so runs on
+different commits of questgit see identical input.
+"""
+import math
+import os
+import random
+from typing import List
+
+TEXT_WORDS = [
+    "alpha", "beta", "gamma", "delta", "index", "object", "tree", "commit",
+    "status", "restore", "return", "import", "class", "self", "value", "None",
+]
+
+
+class RepoSpec:
+
+    def __init__(
+        self,
+        files: int = 10_000,
+        size_median: int = 2048,
+        size_sigma: float = 1.5,
+        max_size: int = 4 * 1024 * 1024,
+        depth: int = 3,
+        fanout: int = 8,
+        binary_ratio: float = 0.1,
+        history: int = 5,
+        churn: float = 0.02,
+        seed: int = 0,
+    ):
+        self.files = files
+        # File sizes follow a log-normal distribution around size_median,
+        # like source trees: mostly small files and a long tail
+        self.size_median = size_median
+        self.size_sigma = size_sigma
+        self.max_size = max_size
+        self.depth = depth
+        self.fanout = fanout
+        self.binary_ratio = binary_ratio
+        # Commits to build, and the share of files each one changes
+        self.history = history
+        self.churn = churn
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+    @staticmethod
+    def add_arguments(parser):
+        defaults = RepoSpec()
+        parser.add_argument("--files", type=int, default=defaults.files)
+        parser.add_argument("--size-median", type=int, default=defaults.size_median)
+        parser.add_argument("--size-sigma", type=float, default=defaults.size_sigma)
+        parser.add_argument("--max-size", type=int, default=defaults.max_size)
+        parser.add_argument("--depth", type=int, default=defaults.depth)
+        parser.add_argument("--fanout", type=int, default=defaults.fanout)
+        parser.add_argument("--binary-ratio", type=float, default=defaults.binary_ratio)
+        parser.add_argument("--history", type=int, default=defaults.history)
+        parser.add_argument("--churn", type=float, default=defaults.churn)
+        parser.add_argument("--seed", type=int, default=defaults.seed)
+
+    @staticmethod
+    def from_args(args) -> "RepoSpec":
+        return RepoSpec(
+            files=args.files,
+            size_median=args.size_median,
+            size_sigma=args.size_sigma,
+            max_size=args.max_size,
+            depth=args.depth,
+            fanout=args.fanout,
+            binary_ratio=args.binary_ratio,
+            history=args.history,
+            churn=args.churn,
+            seed=args.seed,
+        )
+
+
+class SyntheticRepo:
+
+    def __init__(self, path: str, spec: RepoSpec):
+        self.path = path
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.paths: List[str] = []
+
+    def _directories(self) -> List[str]:
+        dirs = [""]
+        level = [""]
+        for _ in range(self.spec.depth):
+            level = [
+                os.path.join(parent, f"dir{n}") if parent else f"dir{n}"
+                for parent in level
+                for n in range(self.spec.fanout)
+            ]
+            dirs.extend(level)
+        return dirs
+
+    def _size(self) -> int:
+        size = int(self.rng.lognormvariate(math.log(self.spec.size_median), self.spec.size_sigma))
+        return max(1, min(size, self.spec.max_size))
+
+    def _content(self, binary: bool) -> bytes:
+        size = self._size()
+        if binary:
+            return self.rng.randbytes(size)
+        words = []
+        length = 0
+        while length < size:
+            word = self.rng.choice(TEXT_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words).encode()[:size] + b"\n"
+
+    def _write(self, relpath: str):
+        binary = relpath.endswith(".bin")
+        with open(os.path.join(self.path, relpath), "wb") as f:
+            f.write(self._content(binary))
+
+    # Writes the initial tree
+    def generate(self):
+        dirs = self._directories()
+        for directory in dirs:
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+
+        for n in range(self.spec.files):
+            directory = dirs[self.rng.randrange(len(dirs))]
+            binary = self.rng.random() < self.spec.binary_ratio
+            name = f"file{n}.bin" if binary else f"file{n}.txt"
+            relpath = os.path.join(directory, name) if directory else name
+            self.paths.append(relpath)
+            self._write(relpath)
+
+    def _sample(self) -> List[str]:
+        count = max(1, int(len(self.paths) * self.spec.churn))
+        return sorted(self.rng.sample(self.paths, min(count, len(self.paths))))
+
+    # Rewrites a churn-sized sample of files, as one commit's worth of edits
+    def modify(self) -> List[str]:
+        changed = self._sample()
+        for relpath in changed:
+            self._write(relpath)
+        return changed
+
+    # Deletes a churn-sized sample of files, for restore to bring back
+    def delete(self) -> List[str]:
+        removed = self._sample()
+        for relpath in removed:
+            os.remove(os.path.join(self.path, relpath))
+        return removed
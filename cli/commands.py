@@ -1,16 +1,14 @@
 import sys
 import os
-from typing import Set
+from typing import Dict, List, Optional, Set, Tuple
 
 from questgit.repository import Repository
-from questgit.index import Index
-from utils.file_utils import FileHandler
-from questgit.objects import ObjectStore
-from utils.hash_utils import HashCalculate
-from utils.logger_utils import LoggerUtil
+from utils.logger_utils import LoggerUtil, LEVEL_ENV
+from utils.trace_utils import Tracer
 from questgit.config import Config
-from questgit.commit import Commit
-from utils.constants import MASTER_FILE
+
+# Subsystems are imported by the commands that use them, so a command only
+# pays start-up time for what it runs
 
 logger = LoggerUtil.setup_logger(__name__)
 
@@ -27,81 +25,238 @@ class CLIHandler:
             "config": self.config,
             "commit": self.commit,
             "log": self.log_command,
+            "branch": self.branch_command,
+            "pack-refs": self.pack_refs_command,
+            "diff": self.diff_command,
+            "gc": self.gc_command,
+            "commit-graph": self.commit_graph_command,
+            "fsmonitor": self.fsmonitor_command,
+            "object-store": self.object_store_command,
         }
 
+        # Path for --profile output, "" to print the report, None when off
+        self.profile: Optional[str] = None
+
     def run(self):
+        if not self.parse_global_options():
+            return
         if len(sys.argv) < 2:
             self.show_usage()
             return
 
         command = sys.argv[1]
         action = self.commands.get(command)
+        self.apply_log_level()
 
         if action:
-            action()
+            with Tracer.span(f"command {command}"):
+                if self.profile is None:
+                    action()
+                else:
+                    self.run_profiled(action)
+            self.show_cache_stats()
         else:
             print(f"Unknown command: {command}")
             self.show_usage()
 
+    # Takes --trace[=summary|<file>.json] and --profile[=<file>] off the
+    # front of the arguments, so commands see their own at sys.argv[2:]
+    def parse_global_options(self) -> bool:
+        while len(sys.argv) > 1 and sys.argv[1].startswith("--"):
+            option, _, value = sys.argv[1].partition("=")
+            if option == "--trace":
+                if not Tracer.configure(value or "summary"):
+                    print(f"Invalid trace output: {value} (use summary or a .json file)")
+                    return False
+            elif option == "--profile":
+                self.profile = value
+            else:
+                break
+            del sys.argv[1]
+        return True
+
+    def run_profiled(self, action):
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            action()
+        finally:
+            profiler.disable()
+            if self.profile:
+                profiler.dump_stats(self.profile)
+                print(f"Profile written to {self.profile}", file=sys.stderr)
+            else:
+                stats = pstats.Stats(profiler, stream=sys.stderr)
+                stats.sort_stats("cumulative").print_stats(25)
+
+    # `questgit config log.level debug`; QUESTGIT_LOG_LEVEL takes precedence
+    def apply_log_level(self):
+        if LEVEL_ENV in os.environ or not Repository.is_initialized():
+            return
+        level = Config.get("log.level")
+        if level and not LoggerUtil.set_level(level):
+            print(f"Invalid log.level: {level}", file=sys.stderr)
+
+    # Enabled with `questgit config cache.stats true`
+    def show_cache_stats(self):
+        if not Repository.is_initialized():
+            return
+        if (Config.get("cache.stats") or "").lower() != "true":
+            return
+
+        from questgit.cache import ObjectCache
+
+        stats = ObjectCache.stats()
+        print(
+            "object cache: "
+            + ", ".join(f"{key}={value}" for key, value in stats.items()),
+            file=sys.stderr,
+        )
+
     # For Init command
     def init_repo(self):
         Repository.init()
 
     # For add command
     def add_files(self):
+        from questgit.index import Index
+        from questgit.objects import ObjectStore
+        from questgit.staging import Staging
+        from questgit.worktree import WorkTree
+
         if not Repository.is_initialized():
             print("Not a questgit repository")
             return
 
-        if len(sys.argv) < 3:
-            print("Usage: questgit add <file1> [<file2> ...]")
+        usage = "Usage: questgit add [-j <jobs>] <file1> [<file2> ...]"
+        parsed = self._parse_jobs(sys.argv[2:])
+        if parsed is None or not parsed[1]:
+            print(usage)
             return
 
-        files_to_add = sys.argv[2:]
+        jobs, files_to_add = parsed
         working_dir = Repository.get_working_dir()
         index = Index()
 
+        # The index holds the whole next commit, so paths that are gone
+        # from the working tree are staged as deletions
+        removed = []
+        # (path relative to the working directory, lstat) of each file; the
+        # walker stats files as it lists them, explicit paths are stat'ed
+        # here, in both cases before reading so a concurrent edit
+        # invalidates the entry
+        files: List[Tuple[str, os.stat_result]] = []
+        scan = None
         if files_to_add == ["."]:
-            files = Repository.find_files()
+            scan = WorkTree.scan(index)
+            files = list(scan.files.items())
+            removed = sorted(scan.missing)
         else:
-            files = []
             for pattern in files_to_add:
                 abs_path = os.path.abspath(pattern)
-                if os.path.isfile(abs_path):
-                    files.append(abs_path)
+                relative_path = Repository.get_relative_path(abs_path, working_dir)
+                if (
+                    os.path.isfile(abs_path)
+                    and not index.get_entry(relative_path)
+                    and Repository.is_ignored(relative_path)
+                ):
+                    print(f"Ignored: '{pattern}' matches an ignore pattern")
+                elif os.path.isfile(abs_path):
+                    try:
+                        files.append((relative_path, os.lstat(abs_path)))
+                    except OSError as e:
+                        logger.error("Error processing %s: %s", abs_path, e)
+                elif index.get_entry(relative_path) and not os.path.exists(abs_path):
+                    removed.append(relative_path)
                 else:
                     print(f"Warning: '{pattern}' doesn't match any files")
 
-        changed_files = 0
-        for filepath in files:
-            try:
-                relative_path = Repository.get_relative_path(filepath, working_dir)
-                content = FileHandler.read(filepath)
+        for relative_path in removed:
+            index.remove_entry(relative_path)
+            print(f"Removed {relative_path}")
+
+        # Only files the stat cache can't vouch for are read, hashed and
+        # compressed, possibly across worker processes
+        to_stage = {}
+        for relative_path, st in files:
+            existing_hash = index.get_entry(relative_path)
+            if (
+                existing_hash
+                and index.stat_matches(relative_path, st)
+                and ObjectStore.blob_exists(existing_hash)
+            ):
+                index.skipped += 1
+                continue
+            to_stage[relative_path] = st
 
-                if content is None:
-                    continue
+        staged_paths = sorted(to_stage)
+        index.rehashed += len(staged_paths)
 
-                current_hash = HashCalculate.calculate_sha1(content)
-                existing_hash = index.get_entry(relative_path)
+        changed_files = 0
+        failed = set()
+        for relative_path, blob_hash, _, _ in Staging.stage_files(staged_paths, jobs):
+            if blob_hash is None:
+                failed.add(relative_path)
+                continue
 
-                if existing_hash == current_hash and ObjectStore.blob_exists(
-                    current_hash
-                ):
-                    continue
+            st = to_stage[relative_path]
+            if index.get_entry(relative_path) == blob_hash:
+                index.update_stat(relative_path, st)
+                continue
 
-                blob_hash = ObjectStore.store_blob(filepath)
-                index.add_entry(relative_path, blob_hash)
-                changed_files += 1
-                print(f"Added {relative_path}")
+            index.add_entry(relative_path, blob_hash, st)
+            changed_files += 1
+            print(f"Added {relative_path}")
 
-            except Exception as e:
-                logger.error(f"Error processing {filepath}: {e}")
-                continue
-        if changed_files > 0:
+        changed_files += len(removed)
+        if changed_files > 0 or index.dirty:
             index.save()
+        if scan is not None:
+            scan.save_state(index, failed)
+        if changed_files > 0:
             print(f"Staged {changed_files} file(s)")
         else:
             print("Nothing to stage")
+        print(f"Checked {len(files)} file(s): {index.stat_report()}")
+        stats = ObjectStore.write_stats()
+        print(
+            f"Objects: {stats['written']} written, "
+            f"{stats['deduplicated']} already stored"
+        )
+
+    # Splits "-j N", "--jobs N" and "--jobs=N" off the argument list
+    def _parse_jobs(
+        self, args: List[str], jobs: Optional[int] = None
+    ) -> Optional[Tuple[int, List[str]]]:
+        if jobs is None:
+            from questgit.staging import Staging
+
+            jobs = Staging.default_jobs()
+        rest = []
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            value = None
+            if arg in ("-j", "--jobs"):
+                if i + 1 >= len(args):
+                    return None
+                value = args[i + 1]
+                i += 1
+            elif arg.startswith("--jobs="):
+                value = arg[len("--jobs="):]
+            else:
+                rest.append(arg)
+
+            if value is not None:
+                if not value.isdigit() or int(value) < 1:
+                    print(f"Invalid job count: {value}")
+                    return None
+                jobs = int(value)
+            i += 1
+        return jobs, rest
 
     # For status command
     # def show_status(self):
@@ -126,94 +281,99 @@ class CLIHandler:
     #     for file in sorted(all_files - tracked_files):
     #         print(f"\033[91m  untracked: {file}\033[0m")
     def show_status(self):
+        from questgit.diff import IndexSide, TreeDiff, TreeSide
+        from questgit.index import Index
+        from questgit.worktree import WorkTree
+
         if not Repository.is_initialized():
             print("Not a questgit repository")
             return
 
         index = Index()
-        working_dir = Repository.get_working_dir()
-        all_files = {
-            Repository.get_relative_path(f, working_dir)
-            for f in Repository.find_files()
-        }
-
-        # Get last commit's files
-        last_commit_files = set()
-        if os.path.exists(MASTER_FILE):
-            last_commit_hash = FileHandler.read(MASTER_FILE).strip()
-            if last_commit_hash:
-                last_commit_files = self._get_files_from_commit(last_commit_hash)
+        scan = WorkTree.scan(index)
+
+        # The last commit's tree against the index: only directories whose
+        # hashes differ are looked into, so the cost follows what is staged
+        staged: List[Tuple[str, str]] = []
+        deleted: List[Tuple[str, str]] = []
+        head = self._commit_tree("HEAD")
+        for change in TreeDiff.compare(TreeSide(head), IndexSide(index)):
+            if change.new_hash is None:
+                deleted.append(("deleted", change.path))
+            elif change.old_hash is None:
+                staged.append(("new file", change.path))
+            else:
+                staged.append(("modified", change.path))
+        staged_changes = sorted(staged, key=lambda item: item[1])
+        staged_changes += sorted(deleted, key=lambda item: item[1])
 
-        # Categorize files properly
-        staged_files = set(index.entries.keys())
+        # Files in index but different from working dir
         working_changes = set()
-        untracked_files = set()
-
-        if last_commit_files is None:
-            last_commit_files = []
-
-        # if last_commit_files is not None:
-        for file in all_files:
-            # Files in index but different from working dir
-            if file in index.entries:
-                current_hash = HashCalculate.calculate_sha1(FileHandler.read(file))
-                if current_hash != index.entries[file]:
-                    working_changes.add(file)
-
-            # elif file not in last_commit_files:
-            #     return
-            # Tracked in last commit but not in index
-
-            elif file in last_commit_files:
+        for file, st in scan.files.items():
+            staged_hash = index.get_entry(file)
+            if staged_hash is not None and index.hash_file(file, st) != staged_hash:
                 working_changes.add(file)
-            # Completely new files
-            else:
-                untracked_files.add(file)
+        deleted_files = scan.missing
+        untracked_files = scan.untracked
 
         print("Changes to be committed:")
-        for file in sorted(staged_files):
-            if file in last_commit_files:
-                print(f"\033[92m  modified: {file}\033[0m")
-            else:
-                print(f"\033[92m  new file: {file}\033[0m")
+        for status, file in staged_changes:
+            print(f"\033[92m  {status}: {file}\033[0m")
 
         print("\nChanges not staged for commit:")
         for file in sorted(working_changes):
             print(f"\033[91m  modified: {file}\033[0m")
+        for file in sorted(deleted_files):
+            print(f"\033[91m  deleted: {file}\033[0m")
 
         print("\nUntracked files:")
         for file in sorted(untracked_files):
             print(f"\033[91m  {file}\033[0m")
 
-        # print("\nDeleted files:")
-        # # Show files committed before but now missing
-        # for file in sorted(last_commit_files - all_files):
-        #     print(f"\033[93m  deleted: {file}\033[0m")
-
-    def _get_files_from_commit(self, commit_hash: str) -> set:
-        commit = ObjectStore.read_blob(commit_hash)
-        if not commit:
-            return set()
-
-        # Get tree hash from commit (first line: "tree <hash>")
-        tree_hash = commit.split("\n")[0].split()[1]
-        tree = ObjectStore.read_blob(tree_hash)
-
-        if tree is None:
-            return
+        # Persist refreshed stat data so the next status can skip those files
+        if index.dirty:
+            index.save()
+        scan.save_state(index, working_changes | deleted_files)
+        print(f"\n{index.stat_report()}")
+
+    # Flattened {path: blob hash} of a commit's tree
+    @Tracer.traced("head.files")
+    # Path -> (blob hash, mode) of every file in a commit
+    def _get_files_from_commit(self, commit_hash: str) -> Dict[str, Tuple[str, str]]:
+        from questgit.commit import Commit
+        from questgit.objects import ObjectStore
+
+        files: Dict[str, Tuple[str, str]] = {}
+        commit = Commit._parse_commit(commit_hash)
+        if not commit or not commit.get("tree"):
+            return files
+
+        def walk_tree(tree_hash: str, prefix: str):
+            for mode, obj_type, obj_hash, name in ObjectStore.read_tree(tree_hash) or []:
+                path = os.path.join(prefix, name)
+                if obj_type == "tree":
+                    walk_tree(obj_hash, path)
+                else:
+                    files[path] = (obj_hash, mode)
 
-        return {
-            line.split()[-1]  # Extract filename
-            for line in tree.split("\n")
-            if line.strip()
-        }
+        walk_tree(commit["tree"], "")
+        return files
 
     # For Restore command from staging area
     def restore_staged(self):
+        from questgit.index import Index
+        from questgit.checkout import Checkout
+
         if not Repository.is_initialized():
             print("Not a questgit repository")
             return
 
+        parsed = self._parse_jobs(sys.argv[2:], Checkout.default_jobs())
+        if parsed is None:
+            print("Usage: questgit restore [-j <jobs>] [<file1> ...]")
+            return
+
+        jobs, args = parsed
         index = Index()
         working_dir = Repository.get_working_dir()
 
@@ -221,34 +381,38 @@ class CLIHandler:
             print("No files in staging area")
             return
 
-        files_to_restore = sys.argv[3:] if len(sys.argv) > 3 else None
-
-        restored_files = 0
-        for filepath, blob_hash in index.entries.items():
-            if files_to_restore and filepath not in files_to_restore:
-                continue
-
-            try:
-                content = ObjectStore.read_blob(blob_hash)
-                if content is None:
-                    print(f"Warning: Could not read blob for {filepath}")
-                    continue
-
-                abs_path = os.path.join(working_dir, filepath)
-                FileHandler.write(abs_path, content)
-                print(f"Restored {filepath}")
-                restored_files += 1
+        files_to_restore = [
+            Repository.get_relative_path(os.path.abspath(arg), working_dir)
+            for arg in args
+            if arg != "--staged"
+        ]
+        if files_to_restore:
+            paths = [path for path in files_to_restore if index.get_entry(path)]
+            for path in sorted(set(files_to_restore) - set(paths)):
+                print(f"File not in staging area: {path}")
+        else:
+            paths = index.sorted_paths()
 
-            except Exception as e:
-                logger.error(f"Error restoring {filepath}: {e}")
+        restored, stats = Checkout.restore(index, paths, jobs)
+        for filepath in restored:
+            print(f"Restored {filepath}")
+        if index.dirty:
+            index.save()
 
-        if restored_files > 0:
-            print(f"Restored {restored_files} file(s) from staging area")
+        if stats["written"] > 0:
+            print(f"Restored {stats['written']} file(s) from staging area")
         else:
             print("No files restored")
+        print(
+            f"{stats['written']} written, {stats['skipped']} already up to date"
+            + (f", {stats['failed']} failed" if stats["failed"] else "")
+        )
 
     # For unstage command from staging area
     def unstage(self):
+        from questgit.index import Index
+        from questgit.commit import Commit
+
         if not Repository.is_initialized():
             print("Not a questgit repository")
             return
@@ -261,6 +425,11 @@ class CLIHandler:
         files_to_unstage = sys.argv[2:]
         working_dir = Repository.get_working_dir()
 
+        head_files: Dict[str, Tuple[str, str]] = {}
+        head_hash = Commit._resolve_ref("HEAD")
+        if head_hash:
+            head_files = self._get_files_from_commit(head_hash)
+
         removed_files = 0
         for filepath in files_to_unstage:
             if os.path.isabs(filepath):
@@ -268,7 +437,20 @@ class CLIHandler:
             else:
                 rel_path = filepath
 
-            if rel_path in index.entries:
+            # Unstaging puts back what the last commit had for the path,
+            # executable bit included
+            if rel_path in head_files:
+                head_hash, head_mode = head_files[rel_path]
+                if (
+                    index.get_entry(rel_path) == head_hash
+                    and index.file_mode(rel_path) == head_mode
+                ):
+                    print(f"No staged changes for {rel_path}")
+                    continue
+                index.add_entry(rel_path, head_hash, mode=head_mode)
+                print(f"Reset {rel_path} to the last commit")
+                removed_files += 1
+            elif rel_path in index.entries:
                 index.remove_entry(rel_path)
                 print(f"Removed {rel_path} from staging area")
                 removed_files += 1
@@ -283,15 +465,71 @@ class CLIHandler:
 
     # For cat-file command
     def cat_file_command(self):
+        from questgit.objects import ObjectStore
+
+        args = sys.argv[2:]
+        if args and args[0] in ("--batch", "--batch-check") and set(args[1:]) <= {"--buffer"}:
+            self._cat_file_batch(args[0] == "--batch", "--buffer" in args)
+            return
+
         if len(sys.argv) != 4 or sys.argv[2] != "-p":
             print("Usage: questgit cat-file -p <blob_hash>")
+            print("       questgit cat-file (--batch | --batch-check) [--buffer] < <hashes>")
             return
 
-        obj_hash = sys.argv[3]
-        content = ObjectStore.read_blob(obj_hash)
-
-        if content:
-            print(content, end="\n")
+        name = sys.argv[3]
+        try:
+            obj_hash = ObjectStore.resolve_name(name)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if obj_hash is None or not ObjectStore.blob_exists(obj_hash):
+            print(f"Not a valid object name {name}", file=sys.stderr)
+            sys.exit(1)
+
+        # Stream raw bytes so large and binary objects are never held in memory
+        sys.stdout.flush()
+        out = sys.stdout.buffer
+        if ObjectStore.stream_blob(obj_hash, out):
+            out.write(b"\n")
+            out.flush()
+
+    # One object per line of stdin, answered with "<hash> <type> <size>"
+    # and, for --batch, the content and a newline; unknown names get
+    # "<name> missing" and ambiguous short ones "<name> ambiguous".
+    # Output is flushed after every answer so a tool can wait for it
+    # before writing the next name; --buffer flushes only when the
+    # buffer fills, for tools that send every name up front.
+    def _cat_file_batch(self, contents: bool, buffered: bool):
+        from questgit.objects import ObjectStore
+
+        sys.stdout.flush()
+        out = sys.stdout.buffer
+        try:
+            for line in sys.stdin.buffer:
+                name = line.strip().decode("utf-8", "replace")
+                try:
+                    obj_hash = ObjectStore.resolve_name(name)
+                except ValueError:
+                    out.write(f"{name} ambiguous\n".encode("utf-8"))
+                    if not buffered:
+                        out.flush()
+                    continue
+                obj = ObjectStore.read_object(obj_hash) if obj_hash else None
+                if obj is None:
+                    out.write(f"{name} missing\n".encode("utf-8"))
+                else:
+                    obj_type, content = obj
+                    out.write(f"{obj_hash} {obj_type} {len(content)}\n".encode())
+                    if contents:
+                        out.write(content)
+                        out.write(b"\n")
+                if not buffered:
+                    out.flush()
+            out.flush()
+        except BrokenPipeError:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
 
     # For config command
     def validate_config(self):
@@ -317,12 +555,18 @@ class CLIHandler:
             print("Usage: questgit config <key> <value>")
             return
 
+        if sys.argv[2] == "core.objectstore":
+            # Objects already stored would be left behind in the old backend
+            print(f"Use: questgit object-store migrate {sys.argv[3]}")
+            return
+
         Config.set(sys.argv[2], sys.argv[3])
         print(f"Set {sys.argv[2]}={sys.argv[3]}")
 
     # For commit command
     def commit(self):
-        index = Index()
+        from questgit.commit import Commit
+
         if not Repository.is_initialized():
             print("Not a questgit repository")
             return
@@ -337,14 +581,6 @@ class CLIHandler:
 
         message = args[args.index("-m") + 1]
 
-        missing_files = [f for f in index.entries.keys() if not os.path.exists(f)]
-        if missing_files:
-            print("Error: Missing files:")
-            for f in missing_files:
-                print(f"  - {f}")
-            print("Use 'questgit add' to re-stage files")
-            return
-
         commit_hash = Commit.create_commit(message)
 
         if commit_hash:
@@ -353,26 +589,330 @@ class CLIHandler:
             print("Commit failed (no changes staged?)")
 
     def log_command(self):
+        from questgit.commit import Commit
+        from questgit.objects import ObjectStore, DEFAULT_ABBREV
+
         if not Repository.is_initialized():
             print("\033[91mNot a questgit repository\033[0m")
             return
 
-        commits = Commit.get_log()
+        max_count = 10
+        # Minimum length of abbreviated hashes, None for full ones
+        abbrev = None
+        ref = None
+        args = sys.argv[2:]
+        try:
+            while args:
+                arg = args.pop(0)
+                if arg in ("-n", "--max-count") and args:
+                    max_count = int(args.pop(0))
+                elif arg.startswith("--max-count="):
+                    max_count = int(arg[len("--max-count="):])
+                elif arg == "--abbrev" or arg.startswith("--abbrev="):
+                    abbrev = int(arg.partition("=")[2] or DEFAULT_ABBREV)
+                elif ref is None and not arg.startswith("-"):
+                    ref = arg
+                else:
+                    raise ValueError
+        except ValueError:
+            print(
+                "Usage: questgit log [-n <count> | --max-count=<count>] [--abbrev[=<n>]] [<branch>]"
+            )
+            return
+
+        start = "HEAD"
+        if ref is not None:
+            try:
+                start = Commit._resolve_ref(ref)
+            except ValueError as e:
+                print(e)
+                return
+            if start is None:
+                print(f"Unknown revision: {ref}")
+                return
+
+        commits = Commit.get_log(start, max_count=max_count)
 
         if not commits:
             print("No commits yet")
             return
 
+        names = {}
+        if abbrev is not None:
+            names = ObjectStore.abbreviate([commit["hash"] for commit in commits], abbrev)
+
         for commit in commits:
-            print(f"\033[33mcommit {commit['hash']}\033[0m")
+            print(f"\033[33mcommit {names.get(commit['hash'], commit['hash'])}\033[0m")
             print(f"Author: {commit['author']} <{commit['email']}>")
             print(f"Date:   {commit['date'].strftime('%a %b %d %H:%M:%S %Y %z')}")
             print()
             print(f"    {commit['message']}")
             print()
 
+    # For diff command: working tree against the index, the index against
+    # the last commit (--cached), or two commits
+    def diff_command(self):
+        from questgit.diff import IndexSide, PatchWriter, TreeDiff, TreeSide
+        from questgit.index import Index
+        from questgit.worktree import WorkTree
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        args = sys.argv[2:]
+        pathspec: List[str] = []
+        if "--" in args:
+            pathspec = args[args.index("--") + 1:]
+            args = args[:args.index("--")]
+        working_dir = Repository.get_working_dir()
+        pathspec = [
+            "" if path == "." else path
+            for path in (
+                Repository.get_relative_path(os.path.abspath(arg), working_dir)
+                for arg in pathspec
+            )
+        ]
+
+        cached = bool(args) and args[0] in ("--cached", "--staged")
+        if (cached and len(args) != 1) or (not cached and len(args) not in (0, 2)):
+            print("Usage: questgit diff [--cached] [-- <path>...]")
+            print("       questgit diff <commit> <commit> [-- <path>...]")
+            return
+
+        sys.stdout.flush()
+        writer = PatchWriter(sys.stdout.buffer, color=sys.stdout.isatty())
+        try:
+            if len(args) == 2:
+                try:
+                    trees = [self._commit_tree(arg) for arg in args]
+                except ValueError as e:
+                    print(e)
+                    return
+                for arg, tree in zip(args, trees):
+                    if tree is None:
+                        print(f"Unknown commit: {arg}")
+                if None in trees:
+                    return
+                for change in TreeDiff.compare(TreeSide(trees[0]), TreeSide(trees[1]), pathspec):
+                    writer.write(change)
+            elif cached:
+                index = Index()
+                head = self._commit_tree("HEAD")
+                for change in TreeDiff.compare(TreeSide(head), IndexSide(index), pathspec):
+                    writer.write(change)
+            else:
+                index = Index()
+                scan = WorkTree.scan(index)
+                changes = TreeDiff.compare_worktree(index, scan, pathspec)
+                for change in changes:
+                    writer.write(change, worktree=True)
+
+                # Keep the refreshed stat data, as status does. Files outside
+                # the pathspec weren't checked, so they stay dirty.
+                if index.dirty:
+                    index.save()
+                unchecked = {
+                    path for path in scan.files if not TreeDiff.in_pathspec(path, pathspec)
+                }
+                scan.save_state(
+                    index, {change.path for change in changes} | unchecked | scan.missing
+                )
+            sys.stdout.buffer.flush()
+        except BrokenPipeError:
+            # The reader (head, a pager) went away; stop quietly
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+
+    # Tree hash of a commit given by hash, short hash, branch name or HEAD.
+    # Raises ValueError for an ambiguous short hash.
+    def _commit_tree(self, name: str) -> Optional[str]:
+        from questgit.commit import Commit
+
+        commit_hash = Commit._resolve_ref(name)
+        commit = Commit._parse_commit(commit_hash) if commit_hash else None
+        return commit.get("tree") if commit else None
+
+    # For gc command
+    def gc_command(self):
+        from questgit.commit import Commit
+        from questgit.gc import GarbageCollector, DEFAULT_PRUNE_EXPIRE
+        from questgit.refs import RefStore
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        args = sys.argv[2:]
+        if len(args) > 1 or (args and args[0].partition("=")[0] != "--prune"):
+            print("Usage: questgit gc [--prune[=<age>]]")
+            return
+
+        try:
+            RefStore.pack_refs()
+        except ValueError as e:
+            print(f"Not packing refs: {e}")
+
+        # Unreachable objects are removed before packing, so they don't
+        # end up in the new pack
+        if args:
+            value = args[0].partition("=")[2] or Config.get(
+                "gc.pruneexpire", DEFAULT_PRUNE_EXPIRE
+            )
+            try:
+                pruned = GarbageCollector.prune(GarbageCollector.parse_expire(value))
+            except ValueError as e:
+                print(f"Not pruning: {e}")
+                return
+            print(f"Pruned {pruned['pruned']} unreachable object(s)")
+
+        stats = GarbageCollector.repack()
+        added = Commit.write_commit_graph()
+        if added:
+            print(f"Added {added} commit(s) to the commit-graph")
+        if not stats["objects"]:
+            print("Nothing to pack")
+            return
+
+        print(
+            f"Packed {stats['objects']} object(s) "
+            f"({stats['loose']} loose, {stats['packs']} existing pack(s)), "
+            f"{stats['deltas']} stored as deltas"
+        )
+
+    # For branch command: list the branches, create one at a commit (HEAD
+    # by default), or delete them: -d only when merged into HEAD, -D always
+    def branch_command(self):
+        from questgit.commit import Commit
+        from questgit.objects import ObjectStore
+        from questgit.refs import RefStore, HEADS_PREFIX
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        args = sys.argv[2:]
+        try:
+            if not args:
+                head_ref, _ = RefStore.head()
+                for name, _ in RefStore.list():
+                    branch = name[len(HEADS_PREFIX):]
+                    if name == head_ref:
+                        print(f"* \033[92m{branch}\033[0m")
+                    else:
+                        print(f"  {branch}")
+            elif args[0] in ("-d", "-D") and len(args) > 1:
+                head_ref, head_hash = RefStore.head()
+                for branch in args[1:]:
+                    name = HEADS_PREFIX + branch
+                    commit_hash = RefStore.read(name)
+                    if commit_hash is None:
+                        print(f"Branch not found: {branch}")
+                    elif name == head_ref:
+                        print(f"Cannot delete the current branch: {branch}")
+                    elif args[0] == "-d" and not (
+                        head_hash and Commit.is_ancestor(commit_hash, head_hash)
+                    ):
+                        print(f"Branch {branch} is not merged into HEAD (use -D to delete it)")
+                    else:
+                        RefStore.delete(name, commit_hash)
+                        short = ObjectStore.abbreviate([commit_hash])[commit_hash]
+                        print(f"Deleted branch {branch} (was {short})")
+            elif len(args) <= 2 and not args[0].startswith("-"):
+                start = args[1] if len(args) == 2 else "HEAD"
+                commit_hash = Commit._resolve_ref(start)
+                commit = Commit._parse_commit(commit_hash) if commit_hash else None
+                if not commit or not commit.get("tree"):
+                    print(f"Not a valid commit: {start}")
+                    return
+                RefStore.create_branch(args[0], commit_hash)
+                short = ObjectStore.abbreviate([commit_hash])[commit_hash]
+                print(f"Created branch {args[0]} at {short}")
+            else:
+                print("Usage: questgit branch [<name> [<start>]]")
+                print("       questgit branch (-d | -D) <name>...")
+        except ValueError as e:
+            print(e)
+
+    # For pack-refs command
+    def pack_refs_command(self):
+        from questgit.refs import RefStore
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        try:
+            print(f"Packed {RefStore.pack_refs()} ref(s)")
+        except ValueError as e:
+            print(e)
+
+    # For commit-graph command
+    def commit_graph_command(self):
+        from questgit.commit import Commit
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        if sys.argv[2:] != ["write"]:
+            print("Usage: questgit commit-graph write")
+            return
+
+        added = Commit.write_commit_graph()
+        print(f"Added {added} commit(s) to the commit-graph")
+
+    # For fsmonitor command
+    def fsmonitor_command(self):
+        from questgit.fsmonitor import FSMonitor, FSMonitorDaemon
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        action = sys.argv[2] if len(sys.argv) == 3 else None
+        if action == "run":
+            FSMonitorDaemon().serve()
+        elif action == "start":
+            if not FSMonitor.enabled():
+                print("Enable it first: questgit config core.fsmonitor true")
+            elif FSMonitor.start():
+                print("fsmonitor is running")
+            else:
+                print("fsmonitor failed to start, see logs/app.log")
+        elif action == "stop":
+            print("fsmonitor stopped" if FSMonitor.stop() else "fsmonitor is not running")
+        elif action == "status":
+            print("fsmonitor is running" if FSMonitor.is_running() else "fsmonitor is not running")
+        else:
+            print("Usage: questgit fsmonitor start|stop|status|run")
+
+    # For object-store command
+    def object_store_command(self):
+        from questgit.backends import ObjectBackends
+        from questgit.objects import ObjectStore
+
+        if not Repository.is_initialized():
+            print("Not a questgit repository")
+            return
+
+        args = sys.argv[2:]
+        current = ObjectStore.backend().name
+        if not args:
+            print(f"Objects are stored in the {current} backend")
+            return
+        if len(args) != 2 or args[0] != "migrate" or args[1] not in ObjectBackends.names():
+            print(f"Usage: questgit object-store [migrate {'|'.join(ObjectBackends.names())}]")
+            return
+        if args[1] == current:
+            print(f"Objects are already stored in the {current} backend")
+            return
+
+        moved = ObjectStore.migrate(args[1])
+        print(f"Moved {moved} object(s) from the {current} to the {args[1]} backend")
+
     def show_usage(self):
-        print("Usage: questgit <command>")
+        print("Usage: questgit [--trace[=<file>.json]] [--profile[=<file>]] <command>")
         print("Available commands:")
         # for cmd in self.commands.keys():
         #     print(f"  - {cmd}")
@@ -384,3 +924,10 @@ class CLIHandler:
         print("  unstage    - Remove files from staging area")
         print("  commit     - Record changes to the repository")
         print("  log        - Display commit history")
+        print("  branch     - List, create or delete branches")
+        print("  pack-refs  - Move branches into the packed-refs file")
+        print("  diff       - Show changes between the working tree, index and commits")
+        print("  gc         - Pack loose objects (--prune removes unreachable ones)")
+        print("  commit-graph write - Index commit history for faster log")
+        print("  fsmonitor  - Start or stop the file system monitor")
+        print("  object-store migrate loose|sqlite - Move objects to another storage backend")
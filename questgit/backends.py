@@ -0,0 +1,611 @@
+import bisect
+import contextlib
+import hashlib
+import mmap
+import os
+import string
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional, Sequence, Set, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.file_utils import FileHandler
+from utils.compress_utils import CompressUtil
+from utils.trace_utils import Tracer
+from utils.constants import (
+    OBJECTS_DIR,
+    OBJECT_DB_FILE,
+    LOOSE_NAMES_FILE,
+    BLOB_DIR_LEN,
+    BLOB_HASH_LEN,
+)
+
+logger = LoggerUtil.setup_logger(__name__)
+
+BACKEND_CONFIG_KEY = "core.objectstore"
+DEFAULT_BACKEND = "loose"
+# Unix time in seconds, as SQL
+NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+# Names read per query by SQLiteBackend.stale()
+STALE_PAGE = 10000
+
+LOOSE_NAMES_SIGNATURE = b"QLNM"
+LOOSE_NAMES_VERSION = 1
+# signature, version, time written (ns)
+LOOSE_NAMES_HEADER = struct.Struct(">4sIQ")
+# Per shard: directory mtime (ns), end position of its names
+LOOSE_NAMES_SHARDS = struct.Struct(">" + "QI" * 256)
+# Loose names are the hash without its last two digits
+LOOSE_NAME_LEN = BLOB_HASH_LEN // 2
+# A shard directory whose mtime is this close to when the names were
+# written may have changed again within the same mtime tick
+RACY_NS = 2 * 1_000_000_000
+
+# (hash, inflated size, source): the source is the loose file path, or the
+# backend itself where it reads like a pack (read, is_delta, compressed)
+StoredObject = Tuple[str, int, object]
+
+
+# Where ObjectStore keeps objects that are not in a pack. Both backends
+# store zlib compressed content under the object hash; packs are shared
+# and looked up by ObjectStore whichever backend is in use.
+#
+#   contains(hash), read_compressed(hash), iter_compressed(hash)
+#   write(hash, compressed, size)   False when the object already exists
+#   install(tmp path, hash, size)   takes over a temp file of compressed data
+#   batch()                         groups writes, where the backend can
+#   objects(), remove(hashes)       for gc and migration
+#   stale(cutoff), freshen(hash)    write times, for gc --prune
+#   names_from(key, count),         sorted raw names around key, and the
+#   name_before(key), full_hash()   full hash of a name, for short names
+#   discard()                       after migrating away from the backend
+#   multiprocess                    whether worker processes may write
+
+
+# The names of one shard, read from the mapped loose-names file
+class _MappedNames:
+    __slots__ = ("_map", "_start", "_count")
+
+    def __init__(self, mapped: mmap.mmap, start: int, count: int):
+        self._map = mapped
+        self._start = start
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, position: int) -> bytes:
+        if not 0 <= position < self._count:
+            raise IndexError(position)
+        start = self._start + position * LOOSE_NAME_LEN
+        return self._map[start:start + LOOSE_NAME_LEN]
+
+    def raw(self) -> bytes:
+        return self._map[self._start:self._start + self._count * LOOSE_NAME_LEN]
+
+
+# Sorted names of the loose objects, kept in LOOSE_NAMES_FILE so a short
+# name is found by binary search instead of by listing its shard. The
+# file records each shard directory's mtime; a shard whose directory has
+# changed since, or changed just before the file was written, is listed
+# again and the file rewritten. Checked once per process.
+class LooseNameIndex:
+
+    def __init__(self):
+        self._shards: Optional[List[Sequence[bytes]]] = None
+        # Shards holding any names, in order
+        self._filled: List[int] = []
+
+    # After this process adds or removes loose objects
+    def reset(self):
+        self._shards = None
+
+    @staticmethod
+    def _read() -> Optional[Tuple[int, Tuple[int, ...], mmap.mmap]]:
+        try:
+            with open(LOOSE_NAMES_FILE, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        names_pos = LOOSE_NAMES_HEADER.size + LOOSE_NAMES_SHARDS.size
+        if len(mapped) >= names_pos:
+            signature, version, written = LOOSE_NAMES_HEADER.unpack_from(mapped, 0)
+            table = LOOSE_NAMES_SHARDS.unpack_from(mapped, LOOSE_NAMES_HEADER.size)
+            if (
+                signature == LOOSE_NAMES_SIGNATURE
+                and version == LOOSE_NAMES_VERSION
+                and len(mapped) == names_pos + table[-1] * LOOSE_NAME_LEN
+            ):
+                return written, table, mapped
+        mapped.close()
+        logger.warning("Ignoring unreadable %s", LOOSE_NAMES_FILE)
+        return None
+
+    @staticmethod
+    def _list_shard(shard: int, shard_dir: str) -> List[bytes]:
+        try:
+            names = os.listdir(shard_dir)
+        except FileNotFoundError:
+            return []
+        name_len = BLOB_HASH_LEN - BLOB_DIR_LEN
+        return sorted(
+            bytes.fromhex(f"{shard:02x}{name}")
+            for name in names
+            if len(name) == name_len and LooseBackend._is_hex(name)
+        )
+
+    # Sorted raw names per shard
+    def shards(self) -> List[Sequence[bytes]]:
+        if self._shards is not None:
+            return self._shards
+
+        found = LooseNameIndex._read()
+        names_pos = LOOSE_NAMES_HEADER.size + LOOSE_NAMES_SHARDS.size
+        shards: List[Sequence[bytes]] = []
+        mtimes = []
+        listed = 0
+        for shard in range(256):
+            shard_dir = os.path.join(OBJECTS_DIR, f"{shard:02x}")
+            # Stat before listing, so a write in between shows up next time
+            try:
+                mtime = os.stat(shard_dir).st_mtime_ns
+            except FileNotFoundError:
+                mtime = 0
+            mtimes.append(mtime)
+
+            if found is not None:
+                written, table, mapped = found
+                recorded, end = table[2 * shard], table[2 * shard + 1]
+                start = table[2 * shard - 1] if shard else 0
+                if mtime == recorded and (mtime == 0 or recorded < written - RACY_NS):
+                    shards.append(
+                        _MappedNames(mapped, names_pos + start * LOOSE_NAME_LEN, end - start)
+                    )
+                    continue
+
+            shards.append(LooseNameIndex._list_shard(shard, shard_dir))
+            listed += 1
+
+        Tracer.count("loose shards listed", listed)
+        if listed:
+            LooseNameIndex._write(shards, mtimes)
+        self._shards = shards
+        self._filled = [shard for shard in range(256) if shards[shard]]
+        return shards
+
+    # The first count names at or after key, and the last one before it
+    def names_from(self, key: bytes, count: int) -> List[bytes]:
+        shards = self.shards()
+        found: List[bytes] = []
+        for i in range(bisect.bisect_left(self._filled, key[0]), len(self._filled)):
+            shard = self._filled[i]
+            names = shards[shard]
+            position = bisect.bisect_left(names, key) if shard == key[0] else 0
+            end = min(len(names), position + count - len(found))
+            found.extend(names[j] for j in range(position, end))
+            if len(found) == count:
+                break
+        return found
+
+    def name_before(self, key: bytes) -> Optional[bytes]:
+        shards = self.shards()
+        position = bisect.bisect_left(shards[key[0]], key)
+        if position:
+            return shards[key[0]][position - 1]
+        i = bisect.bisect_left(self._filled, key[0])
+        if not i:
+            return None
+        names = shards[self._filled[i - 1]]
+        return names[len(names) - 1]
+
+    @staticmethod
+    def _write(shards: List[Sequence[bytes]], mtimes: List[int]):
+        table = []
+        end = 0
+        for names, mtime in zip(shards, mtimes):
+            end += len(names)
+            table += [mtime, end]
+
+        data = [
+            LOOSE_NAMES_HEADER.pack(LOOSE_NAMES_SIGNATURE, LOOSE_NAMES_VERSION, time.time_ns()),
+            LOOSE_NAMES_SHARDS.pack(*table),
+        ]
+        for names in shards:
+            data.append(names.raw() if isinstance(names, _MappedNames) else b"".join(names))
+
+        info_dir = os.path.dirname(LOOSE_NAMES_FILE)
+        try:
+            FileHandler.ensure_directory_exists(info_dir)
+            fd, tmp_path = tempfile.mkstemp(prefix="loose-names", dir=info_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.writelines(data)
+                os.replace(tmp_path, LOOSE_NAMES_FILE)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning("Could not write %s: %s", LOOSE_NAMES_FILE, e)
+
+
+# One file per object under OBJECTS_DIR/xx/
+class LooseBackend:
+
+    name = "loose"
+    multiprocess = True
+
+    def __init__(self):
+        # Loose object directories already created by this process
+        self.known_dirs: Set[str] = set()
+        self.name_index = LooseNameIndex()
+
+    @staticmethod
+    def object_path(obj_hash: str) -> str:
+        obj_dir = os.path.join(OBJECTS_DIR, obj_hash[:BLOB_DIR_LEN])
+        return os.path.join(obj_dir, obj_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
+
+    def _ensure_object_dir(self, obj_path: str):
+        obj_dir = os.path.dirname(obj_path)
+        if obj_dir not in self.known_dirs:
+            FileHandler.ensure_directory_exists(obj_dir)
+            self.known_dirs.add(obj_dir)
+
+    def contains(self, obj_hash: str) -> bool:
+        return os.path.exists(LooseBackend.object_path(obj_hash))
+
+    def read_compressed(self, obj_hash: str) -> Optional[bytes]:
+        obj_path = LooseBackend.object_path(obj_hash)
+        if not os.path.isfile(obj_path):
+            return None
+        return FileHandler.read_binary(obj_path)
+
+    def iter_compressed(self, obj_hash: str) -> Optional[Iterator[bytes]]:
+        obj_path = LooseBackend.object_path(obj_hash)
+        if not os.path.isfile(obj_path):
+            return None
+        return FileHandler.iter_chunks(obj_path)
+
+    def write(self, obj_hash: str, compressed: bytes, size: int) -> bool:
+        from .objects import ObjectStore
+
+        return self.install(ObjectStore.write_temp([compressed]), obj_hash, size)
+
+    # Moves a fully written temp file into place, so readers never see a
+    # truncated object
+    def install(self, tmp_path: str, obj_hash: str, size: int) -> bool:
+        obj_path = LooseBackend.object_path(obj_hash)
+        try:
+            if self.contains(obj_hash):
+                os.remove(tmp_path)
+                self.freshen(obj_hash)
+                return False
+            self._ensure_object_dir(obj_path)
+            os.replace(tmp_path, obj_path)
+            self.name_index.reset()
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    def batch(self):
+        return contextlib.nullcontext()
+
+    # A write of an object that is already stored counts as a new write,
+    # so gc --prune leaves it alone for another grace period
+    def freshen(self, obj_hash: str):
+        try:
+            os.utime(LooseBackend.object_path(obj_hash))
+        except OSError:
+            pass
+
+    # Paths of loose object files
+    @staticmethod
+    def loose_files() -> Iterator[str]:
+        if not os.path.isdir(OBJECTS_DIR):
+            return
+
+        name_len = BLOB_HASH_LEN - BLOB_DIR_LEN
+        for shard in sorted(os.listdir(OBJECTS_DIR)):
+            shard_dir = os.path.join(OBJECTS_DIR, shard)
+            if len(shard) != BLOB_DIR_LEN or not LooseBackend._is_hex(shard):
+                continue
+            if not os.path.isdir(shard_dir):
+                continue
+
+            for name in sorted(os.listdir(shard_dir)):
+                if len(name) == name_len and LooseBackend._is_hex(name):
+                    yield os.path.join(shard_dir, name)
+
+    @staticmethod
+    def _is_hex(name: str) -> bool:
+        return all(c in string.hexdigits for c in name)
+
+    # Loose file names leave out the end of the hash, so the full hash is
+    # recomputed from the inflated content, which also validates it
+    @staticmethod
+    def _loose_hash(obj_path: str) -> Optional[Tuple[str, int]]:
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            for chunk in CompressUtil.inflate_chunks(FileHandler.iter_chunks(obj_path)):
+                sha1.update(chunk)
+                size += len(chunk)
+        except zlib.error as e:
+            logger.error("Skipping corrupt loose object %s: %s", obj_path, e)
+            return None
+
+        obj_hash = sha1.hexdigest()
+        if LooseBackend.object_path(obj_hash) != obj_path:
+            logger.error("Skipping loose object with wrong name: %s", obj_path)
+            return None
+        return obj_hash, size
+
+    def objects(self) -> Iterator[StoredObject]:
+        for obj_path in LooseBackend.loose_files():
+            found = LooseBackend._loose_hash(obj_path)
+            if found is not None:
+                yield found[0], found[1], obj_path
+
+    # Names of the objects last written before cutoff, a timestamp. Loose
+    # names are the hash without its last two digits, which is enough for
+    # remove().
+    def stale(self, cutoff: float) -> Iterator[str]:
+        for obj_path in LooseBackend.loose_files():
+            try:
+                if os.stat(obj_path).st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            yield os.path.basename(os.path.dirname(obj_path)) + os.path.basename(obj_path)
+
+    def names_from(self, raw_key: bytes, count: int) -> List[bytes]:
+        return self.name_index.names_from(raw_key[:LOOSE_NAME_LEN], count)
+
+    def name_before(self, raw_key: bytes) -> Optional[bytes]:
+        return self.name_index.name_before(raw_key[:LOOSE_NAME_LEN])
+
+    def full_hash(self, name: str) -> Optional[str]:
+        found = LooseBackend._loose_hash(LooseBackend.object_path(name))
+        return found[0] if found else None
+
+    def remove(self, obj_hashes: List[str]):
+        for obj_hash in obj_hashes:
+            obj_path = LooseBackend.object_path(obj_hash)
+            if os.path.exists(obj_path):
+                os.remove(obj_path)
+
+        for shard in os.listdir(OBJECTS_DIR):
+            shard_dir = os.path.join(OBJECTS_DIR, shard)
+            if len(shard) == BLOB_DIR_LEN and os.path.isdir(shard_dir):
+                if not os.listdir(shard_dir):
+                    os.rmdir(shard_dir)
+        # Shard directories have to be recreated by later writes
+        self.known_dirs.clear()
+        self.name_index.reset()
+
+    def discard(self):
+        pass
+
+
+# Every object in one SQLite database, for file systems where thousands
+# of small files are slow or scarce. The table is keyed by the raw 20 byte
+# hash and runs in WAL mode, so readers never wait for a writer. Writes
+# inside batch() share one transaction; outside a batch each write commits
+# on its own. One connection serves all threads of a process, behind a
+# lock; writers in other processes wait on the database's busy timeout.
+class SQLiteBackend:
+
+    name = "sqlite"
+    multiprocess = False
+    BUSY_TIMEOUT_MS = 30_000
+
+    def __init__(self, path: str = OBJECT_DB_FILE):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def _db(self):
+        # A connection must not cross a fork
+        if self._connection is None or self._pid != os.getpid():
+            import sqlite3
+
+            FileHandler.ensure_directory_exists(os.path.dirname(self.path))
+            connection = sqlite3.connect(
+                self.path, timeout=self.BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None, check_same_thread=False,
+            )
+            # auto_vacuum only takes effect before the first table exists
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "hash BLOB PRIMARY KEY, size INTEGER NOT NULL, data BLOB NOT NULL, "
+                f"created INTEGER NOT NULL DEFAULT ({NOW_SQL}))"
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+            self._depth = 0
+        return self._connection
+
+    def _fetch(self, query: str, obj_hash: str):
+        try:
+            raw_hash = bytes.fromhex(obj_hash)
+        except ValueError:
+            return None
+        with self._lock:
+            return self._db().execute(query, (raw_hash,)).fetchone()
+
+    def contains(self, obj_hash: str) -> bool:
+        return self._fetch("SELECT 1 FROM objects WHERE hash = ?", obj_hash) is not None
+
+    def read_compressed(self, obj_hash: str) -> Optional[bytes]:
+        row = self._fetch("SELECT data FROM objects WHERE hash = ?", obj_hash)
+        return row[0] if row else None
+
+    def iter_compressed(self, obj_hash: str) -> Optional[Iterator[bytes]]:
+        data = self.read_compressed(obj_hash)
+        return iter([data]) if data is not None else None
+
+    def write(self, obj_hash: str, compressed: bytes, size: int) -> bool:
+        with self._lock:
+            cursor = self._db().execute(
+                "INSERT OR IGNORE INTO objects (hash, size, data) VALUES (?, ?, ?)",
+                (bytes.fromhex(obj_hash), size, compressed),
+            )
+            return cursor.rowcount == 1
+
+    def install(self, tmp_path: str, obj_hash: str, size: int) -> bool:
+        try:
+            compressed = FileHandler.read_binary(tmp_path)
+            if compressed is None:
+                raise OSError(f"Could not read {tmp_path}")
+            return self.write(obj_hash, compressed, size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Nested batches join the outermost one, which commits when it ends
+    # and rolls back if it raises
+    @contextlib.contextmanager
+    def batch(self):
+        with self._lock:
+            connection = self._db()
+            if self._depth == 0:
+                connection.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self._depth -= 1
+                if self._depth == 0:
+                    connection.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._depth -= 1
+            if self._depth == 0:
+                with Tracer.span("objects.commit"):
+                    connection.execute("COMMIT")
+
+    def freshen(self, obj_hash: str):
+        try:
+            raw_hash = bytes.fromhex(obj_hash)
+        except ValueError:
+            return
+        with self._lock:
+            self._db().execute(
+                f"UPDATE objects SET created = {NOW_SQL} WHERE hash = ?", (raw_hash,)
+            )
+
+    def objects(self) -> Iterator[StoredObject]:
+        with self._lock:
+            rows = self._db().execute("SELECT hash, size FROM objects").fetchall()
+        for raw_hash, size in rows:
+            yield raw_hash.hex(), size, self
+
+    # Read a page at a time along the key, so the names are never all
+    # held at once and gc can remove objects between pages
+    def stale(self, cutoff: float) -> Iterator[str]:
+        last = b""
+        while True:
+            with self._lock:
+                rows = self._db().execute(
+                    "SELECT hash FROM objects WHERE created < ? AND hash > ?"
+                    " ORDER BY hash LIMIT ?",
+                    (cutoff, last, STALE_PAGE),
+                ).fetchall()
+            if not rows:
+                return
+            for (raw_hash,) in rows:
+                yield raw_hash.hex()
+            last = rows[-1][0]
+
+    # Range scans of the primary key
+    def names_from(self, raw_key: bytes, count: int) -> List[bytes]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT hash FROM objects WHERE hash >= ? ORDER BY hash LIMIT ?",
+                (raw_key, count),
+            ).fetchall()
+        return [raw_hash for (raw_hash,) in rows]
+
+    def name_before(self, raw_key: bytes) -> Optional[bytes]:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT hash FROM objects WHERE hash < ? ORDER BY hash DESC LIMIT 1",
+                (raw_key,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def full_hash(self, name: str) -> Optional[str]:
+        return name
+
+    # Read like a pack by gc
+    def read(self, obj_hash: str) -> Optional[bytes]:
+        compressed = self.read_compressed(obj_hash)
+        return zlib.decompress(compressed) if compressed is not None else None
+
+    def is_delta(self, obj_hash: str) -> bool:
+        return False
+
+    def compressed(self, obj_hash: str) -> Tuple[int, int, Iterator[bytes]]:
+        row = self._fetch("SELECT size, data FROM objects WHERE hash = ?", obj_hash)
+        return row[0], len(row[1]), iter([row[1]])
+
+    def remove(self, obj_hashes: List[str]):
+        with self._lock:
+            with self.batch():
+                self._db().executemany(
+                    "DELETE FROM objects WHERE hash = ?",
+                    ((bytes.fromhex(obj_hash),) for obj_hash in obj_hashes),
+                )
+            self._db().execute("PRAGMA incremental_vacuum")
+
+    # Deletes the database once it holds no objects
+    def discard(self):
+        with self._lock:
+            if self._db().execute("SELECT 1 FROM objects LIMIT 1").fetchone():
+                return
+            self._connection.close()
+            self._connection = None
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+
+class ObjectBackends:
+
+    BACKENDS = {"loose": LooseBackend, "sqlite": SQLiteBackend}
+
+    @staticmethod
+    def names() -> List[str]:
+        return list(ObjectBackends.BACKENDS)
+
+    @staticmethod
+    def create(name: str):
+        backend = ObjectBackends.BACKENDS.get(name)
+        if backend is None:
+            raise ValueError(f"Unknown object store backend: {name}")
+        return backend()
+
+    # Copies every object of source into target as stored, without
+    # inflating and deflating it again. Returns the hashes copied.
+    @staticmethod
+    def copy(source, target) -> List[str]:
+        copied = []
+        with target.batch():
+            for obj_hash, size, _ in source.objects():
+                compressed = source.read_compressed(obj_hash)
+                if compressed is None:
+                    continue
+                target.write(obj_hash, compressed, size)
+                copied.append(obj_hash)
+        return copied
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
+from .config import Config
+
+logger = LoggerUtil.setup_logger(__name__)
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+SIZE_SUFFIXES = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+
+
+# In-process LRU cache of inflated objects and their parsed forms, bounded
+# by an approximate byte budget. Entries are keyed by (kind, hash), where
+# kind is "raw" for inflated bytes or "tree"/"commit" for parsed objects.
+# Configured with `cache.enabled` and `cache.size` (e.g. 64m).
+class ObjectCache:
+
+    _entries: "OrderedDict[Tuple[str, str], Tuple[Any, int]]" = OrderedDict()
+    _size = 0
+    _configured = False
+
+    enabled = True
+    max_size = DEFAULT_CACHE_SIZE
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    @staticmethod
+    def parse_size(value: str) -> int:
+        value = value.strip().lower()
+        multiplier = SIZE_SUFFIXES.get(value[-1:], 1)
+        if value[-1:] in SIZE_SUFFIXES:
+            value = value[:-1]
+        return int(value) * multiplier
+
+    @staticmethod
+    def _configure():
+        ObjectCache._configured = True
+        enabled = Config.get("cache.enabled")
+        if enabled is not None:
+            ObjectCache.enabled = enabled.lower() not in ("false", "0", "no", "off")
+
+        size = Config.get("cache.size")
+        if size is not None:
+            try:
+                ObjectCache.max_size = ObjectCache.parse_size(size)
+            except ValueError:
+                logger.warning("Invalid cache.size: %s", size)
+
+    @staticmethod
+    def get(kind: str, obj_hash: str) -> Optional[Any]:
+        if not ObjectCache._configured:
+            ObjectCache._configure()
+        if not ObjectCache.enabled:
+            return None
+
+        key = (kind, obj_hash)
+        entry = ObjectCache._entries.get(key)
+        if entry is None:
+            ObjectCache.misses += 1
+            Tracer.count("cache misses")
+            return None
+
+        ObjectCache._entries.move_to_end(key)
+        ObjectCache.hits += 1
+        Tracer.count("cache hits")
+        return entry[0]
+
+    # size is the approximate memory cost of value in bytes
+    @staticmethod
+    def put(kind: str, obj_hash: str, value: Any, size: int):
+        if not ObjectCache._configured:
+            ObjectCache._configure()
+        # One object may not take over the whole budget
+        if not ObjectCache.enabled or size > ObjectCache.max_size // 8:
+            return
+
+        key = (kind, obj_hash)
+        previous = ObjectCache._entries.pop(key, None)
+        if previous is not None:
+            ObjectCache._size -= previous[1]
+
+        ObjectCache._entries[key] = (value, size)
+        ObjectCache._size += size
+        while ObjectCache._size > ObjectCache.max_size:
+            _, (_, evicted_size) = ObjectCache._entries.popitem(last=False)
+            ObjectCache._size -= evicted_size
+            ObjectCache.evictions += 1
+
+    @staticmethod
+    def clear():
+        ObjectCache._entries.clear()
+        ObjectCache._size = 0
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        lookups = ObjectCache.hits + ObjectCache.misses
+        return {
+            "hits": ObjectCache.hits,
+            "misses": ObjectCache.misses,
+            "evictions": ObjectCache.evictions,
+            "entries": len(ObjectCache._entries),
+            "bytes": ObjectCache._size,
+            "max_bytes": ObjectCache.max_size,
+            "hit_rate_pct": round(100 * ObjectCache.hits / lookups) if lookups else 0,
+        }
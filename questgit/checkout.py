@@ -0,0 +1,138 @@
+import os
+import stat
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
+from .objects import ObjectStore
+
+logger = LoggerUtil.setup_logger(__name__)
+
+DEFAULT_FILE_MODE = 0o644
+
+# (filepath, lstat after writing or None on failure)
+WriteResult = Tuple[str, Optional[os.stat_result]]
+
+
+class Checkout:
+
+    # Writes in flight per worker; the queue of pending blobs stays bounded
+    # however many files are restored
+    QUEUE_PER_WORKER = 4
+
+    @staticmethod
+    def default_jobs() -> int:
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    # Permission bits to give a restored file: those recorded when it was
+    # staged, else those it has now
+    @staticmethod
+    def _file_mode(staged_mode: Optional[int], st: Optional[os.stat_result]) -> int:
+        if staged_mode is not None and stat.S_ISREG(staged_mode):
+            return stat.S_IMODE(staged_mode)
+        if st is not None and stat.S_ISREG(st.st_mode):
+            return stat.S_IMODE(st.st_mode)
+        return DEFAULT_FILE_MODE
+
+    # Runs on worker threads: streams one blob into a temporary file next
+    # to filepath and moves it into place, so a failed write never leaves
+    # a truncated file behind
+    @staticmethod
+    def write_file(filepath: str, blob_hash: str, mode: int) -> WriteResult:
+        directory = os.path.dirname(filepath)
+        tmp_path = None
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".questgit_tmp_", dir=directory or ".")
+            with os.fdopen(fd, "wb") as f:
+                for chunk in ObjectStore.iter_blob(blob_hash):
+                    f.write(chunk)
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, filepath)
+            return filepath, os.lstat(filepath)
+        except (OSError, zlib.error) as e:
+            logger.error("Error restoring %s: %s", filepath, e)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return filepath, None
+
+    # Brings the working tree files for paths back to their index content.
+    # Files whose stat data or content already match are left alone; the
+    # rest are written by a pool of threads, since inflating and writing
+    # release the GIL. Returns the restored paths and counts of written,
+    # skipped and failed files.
+    @staticmethod
+    @Tracer.traced("restore")
+    def restore(
+        index, paths: List[str], jobs: int = None
+    ) -> Tuple[List[str], Dict[str, int]]:
+        if jobs is None:
+            jobs = Checkout.default_jobs()
+        stats = {"written": 0, "skipped": 0, "failed": 0}
+        restored = []
+
+        # filepath -> (blob hash, permission bits)
+        to_write: Dict[str, Tuple[str, int]] = {}
+        for filepath in paths:
+            blob_hash, staged_stat = index._find(filepath)
+            if blob_hash is None:
+                continue
+
+            try:
+                st = os.lstat(filepath)
+            except FileNotFoundError:
+                st = None
+            except OSError as e:
+                logger.error("Error reading %s: %s", filepath, e)
+                stats["failed"] += 1
+                continue
+
+            mode = Checkout._file_mode(staged_stat and staged_stat[4], st)
+            if st is not None and stat.S_ISREG(st.st_mode):
+                if index.hash_file(filepath, st) == blob_hash:
+                    if stat.S_IMODE(st.st_mode) != mode:
+                        os.chmod(filepath, mode)
+                        index.update_stat(filepath, os.lstat(filepath))
+                    stats["skipped"] += 1
+                    continue
+            to_write[filepath] = (blob_hash, mode)
+
+        for filepath, new_st in Checkout._write_all(to_write, jobs):
+            if new_st is None:
+                stats["failed"] += 1
+                continue
+            # Restored files match the index, so the next status can skip them
+            index.update_stat(filepath, new_st)
+            stats["written"] += 1
+            restored.append(filepath)
+
+        return restored, stats
+
+    @staticmethod
+    @Tracer.traced("restore.write")
+    def _write_all(to_write: Dict[str, Tuple[str, int]], jobs: int) -> List[WriteResult]:
+        if jobs <= 1 or len(to_write) <= 1:
+            return [
+                Checkout.write_file(filepath, blob_hash, mode)
+                for filepath, (blob_hash, mode) in sorted(to_write.items())
+            ]
+
+        slots = threading.BoundedSemaphore(jobs * Checkout.QUEUE_PER_WORKER)
+
+        def write(filepath: str, blob_hash: str, mode: int) -> WriteResult:
+            try:
+                return Checkout.write_file(filepath, blob_hash, mode)
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for filepath, (blob_hash, mode) in sorted(to_write.items()):
+                slots.acquire()
+                futures.append(executor.submit(write, filepath, blob_hash, mode))
+        return [future.result() for future in futures]
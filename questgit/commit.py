@@ -1,129 +1,78 @@
+import bisect
 import os
-import zlib
 from datetime import datetime
-from typing import Optional, List, Dict
+from itertools import islice
+from typing import Optional, List, Dict, Iterator, Tuple
 
 from utils.file_utils import FileHandler
-from utils.hash_utils import HashCalculate
-from utils.constants import (
-    OBJECTS_DIR,
-    MASTER_FILE,
-    BLOB_DIR_LEN,
-    BLOB_HASH_LEN,
-    GIT_DIR,
-    REFS_DIR,
-)
 from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
 from .objects import ObjectStore
+from .cache import ObjectCache
 from .index import Index
 from .config import Config
+from .commit_graph import CommitGraph
+from .refs import RefStore, ZERO_HASH
 
 logger = LoggerUtil.setup_logger(__name__)
 
-index = Index()
-
 
 class Commit:
 
-    IGNORED_DIRS = {
-        ".venv",
-        "__pycache__",
-        ".git",
-        GIT_DIR,
-        "questgit.egg-info",
-        ".idea",
-        ".vscode",
-    }
-
-    @staticmethod
-    def _store_object(content: str) -> str:
-        obj_hash = HashCalculate.calculate_sha1(content)
-        obj_dir = os.path.join(OBJECTS_DIR, obj_hash[:BLOB_DIR_LEN])
-        obj_path = os.path.join(obj_dir, obj_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
-
-        FileHandler.ensure_directory_exists(obj_dir)
-        FileHandler.write_binary(obj_path, zlib.compress(content.encode()))
-        return obj_hash
-
+    # Builds the tree for dir_path from paths[start:end], the sorted index
+    # paths under that directory. Subtrees whose cached hash is still valid
+    # are reused without looking at their entries.
     @staticmethod
-    def _create_tree_object(directory: str = ".", ignore_dirs: List[str] = None) -> str:
-        if ignore_dirs is None:
-            ignore_dirs = Commit.IGNORED_DIRS
-
+    def _build_tree(
+        index: Index, paths: List[str], start: int, end: int, dir_path: str
+    ) -> str:
+        cached = index.get_cached_tree(dir_path)
+        if cached and cached[1] == end - start:
+            return cached[0]
+
+        prefix = dir_path + os.sep if dir_path else ""
         entries = []
-
-        # Process files in the index (already staged files)
-        for filepath, blob_hash in list(index.entries.items()):
-            try:
-                # Verify file still exists
-                if not os.path.exists(filepath):
-                    logger.warning(f"File not found, removing from index: {filepath}")
-                    index.remove_entry(filepath)
-                    continue
-
-                # Read file content
-                # print("=================read==================")
-                content = FileHandler.read(filepath)
-                if content is None:
-                    continue
-                # print("=============", content)
-
-                # Verify content hasn't changed since staging
-                current_hash = HashCalculate.calculate_sha1(content)
-                if current_hash != blob_hash:
-                    # print("=================Hash==================")
-                    logger.warning(f"File modified since staging: {filepath}")
-                    continue
-
-                # Add to tree entries
-                filename = os.path.basename(filepath)
-                dirname = os.path.dirname(filepath)
-                # print("=========", filename,"\n===========", dirname,"\n==============", directory)
-
-                # Handle nested directory structure
-                if dirname and dirname != directory:
-                    # This will create subtrees automatically through recursion
-                    continue
-
-                entries.append(f"100644 blob {blob_hash}    {filename}")
-                # print("=========", entries)
-
-            except Exception as e:
-                logger.error(f"Error processing {filepath}: {e}")
+        i = start
+        while i < end:
+            name = paths[i][len(prefix):]
+            if os.sep not in name:
+                blob_hash = index.entries[paths[i]]
+                entries.append(f"{index.file_mode(paths[i])} blob {blob_hash}    {name}")
+                i += 1
                 continue
 
-        # Process directories (for nested structure)
-        for item in sorted(os.listdir(directory)):
-            if item in ignore_dirs:
-                continue
-
-            full_path = os.path.join(directory, item)
-            # print("=====full_path===", full_path)
-            # print("=====full_path===", type(full_path))
-            if os.path.isdir(full_path):
-                # Recursively create subtree
-                # print("============", entries)
-                try:
-                    subtree_hash = Commit._create_tree_object(full_path, ignore_dirs)
-                    # print("----------subtree-----------",subtree_hash)
-                    entries.append(f"040000 tree {subtree_hash}    {item}")
-                except Exception as e:
-                    logger.error(f"Error processing directory {full_path}: {e}")
-                    print(f"Error processing directory {full_path}: {e}")
-                    continue
-
-        # print("=======entries=====", entries)
-
-        if not entries:
-            raise ValueError(f"No valid files to commit in {directory}")
-
-        tree_content = "\n".join(entries)
-        return ObjectStore.store_tree(tree_content)
+            # Everything under sub_dir sorts between "sub_dir/" and the
+            # next character after the separator
+            sub_name = name.split(os.sep, 1)[0]
+            sub_dir = prefix + sub_name
+            group_end = bisect.bisect_left(paths, sub_dir + chr(ord(os.sep) + 1), i, end)
+            subtree_hash = Commit._build_tree(index, paths, i, group_end, sub_dir)
+            entries.append(f"040000 tree {subtree_hash}    {sub_name}")
+            i = group_end
+
+        tree_hash = ObjectStore.store_tree("\n".join(entries))
+        index.set_cached_tree(dir_path, tree_hash, end - start)
+        return tree_hash
+
+    # The index holds the whole next tree, so it is built in a single pass
+    # over the sorted entries, with no working tree scan or rehashing
+    @staticmethod
+    @Tracer.traced("commit.tree")
+    def _create_tree_object(index: Index) -> str:
+        paths = index.sorted_paths()
+        if not paths:
+            raise ValueError("No valid files to commit")
+        # Every new tree goes into one transaction of the object store
+        with ObjectStore.batch():
+            return Commit._build_tree(index, paths, 0, len(paths), "")
 
     @staticmethod
+    @Tracer.traced("commit")
     def create_commit(message: str) -> Optional[str]:
         try:
-
+            # Loaded here rather than at import, so commands that never
+            # commit don't pay for reading the index
+            index = Index()
             if not index.entries:
                 logger.error("Nothing to commit (index is empty)")
                 return None
@@ -133,22 +82,24 @@ class Commit:
             email = config.get("user.email", "Anonymous")
 
             try:
-                tree_hash = Commit._create_tree_object()
-                # print("======tree_hash===============", tree_hash)
+                tree_hash = Commit._create_tree_object(index)
             except ValueError as e:
                 logger.error(str(e))
                 return None
 
-            parent_hash = None
-            if os.path.exists(MASTER_FILE):
-                # print("=======master=========", MASTER_FILE)
-                parent_hash = FileHandler.read(MASTER_FILE).strip()
-                # print("=======parent=========", parent_hash)
-                # if not parent_hash or not ObjectStore.blob_exists(parent_hash):
-                #     parent_hash = None
-            else:
-                logger.info("MASTER_FILE not found, treating as first commit.")
-                parent_hash = None
+            # HEAD names the branch to commit on; a branch without
+            # commits yet gets the first one
+            head_ref, parent_hash = RefStore.head()
+            if not parent_hash:
+                logger.info("%s has no commits yet, treating as first commit.", head_ref)
+
+            if parent_hash:
+                parent = Commit._parse_commit(parent_hash)
+                if parent and parent.get("tree") == tree_hash:
+                    if index.dirty:
+                        index.save()
+                    logger.error("Nothing to commit (tree matches the last commit)")
+                    return None
 
             timestamp = int(datetime.now().timestamp())
             commit_content = (
@@ -158,63 +109,139 @@ class Commit:
                 + f"committer {author} <{email}> {timestamp}\n\n"
                 + f"{message}\n"
             )
-            # commit_hash = Commit._store_object(commit_content)
             commit_hash = ObjectStore.write_blob(commit_content, "commit")
-            # print("==========commit_hash==========", commit_hash)
 
-            # FileHandler.write(MASTER_FILE, commit_hash)
+            # The branch only moves if no other commit landed on it since
+            # it was read
             if commit_hash:
-                FileHandler.write(MASTER_FILE, commit_hash)
-                logger.info(f"Updated MASTER_FILE with new commit hash: {commit_hash}")
+                try:
+                    RefStore.update(head_ref or "HEAD", commit_hash, parent_hash or ZERO_HASH)
+                except ValueError as e:
+                    logger.error("Could not update %s: %s", head_ref or "HEAD", e)
+                    return None
             else:
-                logger.error("Commit hash generation failed, MASTER_FILE not updated.")
+                logger.error("Commit hash generation failed, %s not updated.", head_ref)
 
-            # Only remove if file matches current state
-            for file in list(index.entries.keys()):
-                current_hash = HashCalculate.calculate_sha1(FileHandler.read(file))
-                if current_hash == index.entries[file]:
-                    index.remove_entry(file)
+            # The index stays as the base of the next commit; saving keeps
+            # the cached trees computed above. The commit stands without
+            # it; the trees are only built again next time.
+            try:
+                index.save()
+            except ValueError as e:
+                logger.warning("Could not save the index: %s", e)
 
-            index.save()
+            try:
+                Commit.write_commit_graph([commit_hash])
+            except OSError as e:
+                logger.error("Could not update commit-graph: %s", e)
 
-            logger.info(f"Created commit {commit_hash[:8]}")
+            logger.info("Created commit %s", commit_hash[:8])
             return commit_hash
 
         except Exception as e:
-            logger.error(f"Commit failed: {str(e)}")
+            logger.error("Commit failed: %s", e)
             return None
 
     # For log history
     @staticmethod
-    def get_log(ref: str = "master", max_count: int = 10) -> List[Dict]:
+    @Tracer.traced("log")
+    def get_log(ref: str = "HEAD", max_count: Optional[int] = 10) -> List[Dict]:
         commits = []
-        current_hash = Commit._resolve_ref(ref)
-
-        while current_hash and len(commits) < max_count:
-            commit = Commit._parse_commit(current_hash)
+        # The walk itself comes from the commit-graph; only the commits
+        # being shown are read for their author and message
+        for commit_hash, _, _ in islice(Commit.iter_history(ref), max_count):
+            commit = Commit._parse_commit(commit_hash)
             if not commit:
                 break
-
             commits.append(commit)
-            current_hash = commit.get("parent")
 
         return commits
 
+    # Yields (hash, tree hash, generation or None) from ref back to the
+    # root commit. Commits in the commit-graph are read from it; newer ones
+    # fall back to parsing commit objects.
+    @staticmethod
+    def iter_history(ref: str = "HEAD") -> Iterator[Tuple[str, str, Optional[int]]]:
+        graph = CommitGraph.load()
+        current = Commit._resolve_ref(ref)
+        while current:
+            if graph is not None and current in graph:
+                for commit_hash, tree, generation, _ in graph.iter_ancestry(current):
+                    yield commit_hash, tree, generation
+                return
+
+            commit = Commit._parse_commit(current)
+            if not commit:
+                return
+            yield current, commit.get("tree"), None
+            current = commit.get("parent")
+
+    # Generation numbers end the walk as soon as it passes below the
+    # ancestor, instead of going all the way to the root
+    @staticmethod
+    def is_ancestor(ancestor: str, descendant: str) -> bool:
+        graph = CommitGraph.load()
+        target = graph.lookup(ancestor) if graph is not None else None
+        for commit_hash, _, generation in Commit.iter_history(descendant):
+            if commit_hash == ancestor:
+                return True
+            if target and generation is not None and generation <= target["generation"]:
+                return False
+        return False
+
+    # Adds every commit reachable from the given refs, or from every
+    # branch and HEAD, that the graph does not have yet. Returns the number
+    # of commits added.
+    @staticmethod
+    @Tracer.traced("commit-graph.write")
+    def write_commit_graph(refs: List[str] = None) -> int:
+        graph = CommitGraph.load()
+        records = graph.records() if graph is not None else {}
+
+        if refs is None:
+            tips = [commit_hash for _, commit_hash in RefStore.list()]
+            tips.append(RefStore.resolve("HEAD"))
+        else:
+            tips = [Commit._resolve_ref(ref) for ref in refs]
+
+        added = 0
+        for current in tips:
+            while current and current not in records:
+                commit = Commit._parse_commit(current)
+                if not commit or not commit.get("tree"):
+                    logger.error("Cannot read commit %s, commit-graph not updated", current)
+                    return 0
+                parent = commit.get("parent")
+                records[current] = (commit["tree"], parent, int(commit["date"].timestamp()))
+                added += 1
+                current = parent
+
+        if added:
+            CommitGraph.write(records)
+        return added
+
+    # HEAD, a branch or full ref name, or a full or unique short commit
+    # hash. Raises ValueError for an ambiguous short hash.
     @staticmethod
     def _resolve_ref(ref: str) -> Optional[str]:
-        ref_path = os.path.join(REFS_DIR, "heads", ref)
-        if os.path.exists(ref_path):
-            return FileHandler.read(ref_path).strip()
-        return ref if ObjectStore.blob_exists(ref) else None
+        commit_hash = RefStore.resolve(ref)
+        if commit_hash is not None:
+            return commit_hash
+        obj_hash = ObjectStore.resolve_name(ref)
+        return obj_hash if ObjectStore.blob_exists(obj_hash) else None
 
     @staticmethod
     def _parse_commit(commit_hash: str) -> Optional[Dict]:
+        cached = ObjectCache.get("commit", commit_hash)
+        if cached is not None:
+            return dict(cached)
+
         content = ObjectStore.read_blob(commit_hash)
         if not content:
             return None
 
         commit = {"hash": commit_hash}
-        lines = content.split("\n")
+        lines = ObjectStore.strip_header(content, "commit").split("\n")
 
         for line in lines:
             if line.startswith("tree "):
@@ -231,4 +258,5 @@ class Commit:
                 commit["message"] = "\n".join(lines[lines.index("") + 1:])
                 break
 
-        return commit
+        ObjectCache.put("commit", commit_hash, commit, 2 * len(content))
+        return dict(commit)
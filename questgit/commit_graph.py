@@ -0,0 +1,213 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict, Iterator, Optional, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.file_utils import FileHandler
+from utils.constants import COMMIT_GRAPH_FILE
+
+logger = LoggerUtil.setup_logger(__name__)
+
+# Commit-graph layout:
+#   header   signature, version, commit count
+#   fanout   256 cumulative counts of hashes by first byte
+#   hashes   sorted raw commit hashes
+#   data     per commit: raw tree hash, position of the parent in the hash
+#            table, generation number, commit timestamp
+#   trailer  SHA-1 of everything above
+GRAPH_SIGNATURE = b"QCGR"
+GRAPH_VERSION = 1
+GRAPH_HEADER = struct.Struct(">4sII")
+FANOUT = struct.Struct(">256I")
+COMMIT_DATA = struct.Struct(">20sIIQ")
+HASH_LEN = 20
+NO_PARENT = 0xFFFFFFFF
+
+# hash -> (tree hash, parent hash or None, timestamp)
+CommitRecord = Tuple[str, Optional[str], int]
+
+
+# Fixed-width tables describing every commit reachable when the graph was
+# written, so history walks don't have to inflate and parse commit objects.
+# Generation numbers are 1 for a root commit and one more than the parent
+# otherwise; a commit can only be an ancestor of commits with a higher one.
+class CommitGraph:
+
+    # Graph opened by this process, loaded on first use
+    _graph: Optional["CommitGraph"] = None
+    _loaded = False
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count = GRAPH_HEADER.unpack_from(self._map, 0)
+        self._fanout = FANOUT.unpack_from(self._map, GRAPH_HEADER.size)
+        self._hashes_pos = GRAPH_HEADER.size + FANOUT.size
+        self._data_pos = self._hashes_pos + self.count * HASH_LEN
+        expected_size = self._data_pos + self.count * COMMIT_DATA.size + HASH_LEN
+        if (
+            signature != GRAPH_SIGNATURE
+            or version != GRAPH_VERSION
+            or self._fanout[255] != self.count
+            or len(self._map) != expected_size
+        ):
+            self.close()
+            raise ValueError(f"Not a commit-graph file: {path}")
+
+    def close(self):
+        self._map.close()
+
+    @staticmethod
+    def load() -> Optional["CommitGraph"]:
+        if not CommitGraph._loaded:
+            CommitGraph._loaded = True
+            if os.path.exists(COMMIT_GRAPH_FILE):
+                try:
+                    CommitGraph._graph = CommitGraph(COMMIT_GRAPH_FILE)
+                except (OSError, ValueError) as e:
+                    logger.error("Ignoring unreadable commit-graph: %s", e)
+        return CommitGraph._graph
+
+    @staticmethod
+    def reload():
+        if CommitGraph._graph is not None:
+            CommitGraph._graph.close()
+        CommitGraph._graph = None
+        CommitGraph._loaded = False
+
+    def _hash_at(self, position: int) -> bytes:
+        start = self._hashes_pos + position * HASH_LEN
+        return self._map[start:start + HASH_LEN]
+
+    def _find(self, raw_hash: bytes) -> Optional[int]:
+        first = raw_hash[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        position = bisect.bisect_left(range(hi), raw_hash, lo=lo, key=self._hash_at)
+        if position < hi and self._hash_at(position) == raw_hash:
+            return position
+        return None
+
+    def position_of(self, commit_hash: str) -> Optional[int]:
+        if len(commit_hash) != 2 * HASH_LEN:
+            return None
+        try:
+            return self._find(bytes.fromhex(commit_hash))
+        except ValueError:
+            return None
+
+    def __contains__(self, commit_hash: str) -> bool:
+        return self.position_of(commit_hash) is not None
+
+    # (hash, tree hash, parent position or None, generation, timestamp)
+    def commit_at(self, position: int) -> Tuple[str, str, Optional[int], int, int]:
+        tree, parent, generation, timestamp = COMMIT_DATA.unpack_from(
+            self._map, self._data_pos + position * COMMIT_DATA.size
+        )
+        return (
+            self._hash_at(position).hex(),
+            tree.hex(),
+            None if parent == NO_PARENT else parent,
+            generation,
+            timestamp,
+        )
+
+    def lookup(self, commit_hash: str) -> Optional[Dict]:
+        position = self.position_of(commit_hash)
+        if position is None:
+            return None
+
+        _, tree, parent, generation, timestamp = self.commit_at(position)
+        commit = {
+            "hash": commit_hash,
+            "tree": tree,
+            "generation": generation,
+            "timestamp": timestamp,
+        }
+        if parent is not None:
+            commit["parent"] = self._hash_at(parent).hex()
+        return commit
+
+    # Follows parent positions from commit_hash without leaving the graph
+    def iter_ancestry(self, commit_hash: str) -> Iterator[Tuple[str, str, int, int]]:
+        position = self.position_of(commit_hash)
+        while position is not None:
+            obj_hash, tree, parent, generation, timestamp = self.commit_at(position)
+            yield obj_hash, tree, generation, timestamp
+            position = parent
+
+    def records(self) -> Dict[str, CommitRecord]:
+        records: Dict[str, CommitRecord] = {}
+        for position in range(self.count):
+            obj_hash, tree, parent, _, timestamp = self.commit_at(position)
+            parent_hash = None if parent is None else self._hash_at(parent).hex()
+            records[obj_hash] = (tree, parent_hash, timestamp)
+        return records
+
+    # Writes a new graph holding exactly the given commits. Parents outside
+    # of records are treated as missing.
+    @staticmethod
+    def write(records: Dict[str, CommitRecord]) -> str:
+        hashes = sorted(records)
+        positions = {obj_hash: position for position, obj_hash in enumerate(hashes)}
+
+        # Generations are filled in walking down to the first commit whose
+        # generation is known, which keeps long histories off the stack
+        generations: Dict[str, int] = {}
+        for obj_hash in hashes:
+            chain = []
+            current = obj_hash
+            while current in positions and current not in generations:
+                chain.append(current)
+                current = records[current][1]
+            generation = generations.get(current, 0)
+            for pending in reversed(chain):
+                generation += 1
+                generations[pending] = generation
+
+        fanout = [0] * 256
+        for obj_hash in hashes:
+            fanout[int(obj_hash[:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        data = [GRAPH_HEADER.pack(GRAPH_SIGNATURE, GRAPH_VERSION, len(hashes))]
+        data.append(FANOUT.pack(*fanout))
+        data.extend(bytes.fromhex(obj_hash) for obj_hash in hashes)
+        for obj_hash in hashes:
+            tree, parent, timestamp = records[obj_hash]
+            data.append(
+                COMMIT_DATA.pack(
+                    bytes.fromhex(tree),
+                    positions.get(parent, NO_PARENT),
+                    generations[obj_hash],
+                    timestamp,
+                )
+            )
+        content = b"".join(data)
+        content += hashlib.sha1(content).digest()
+
+        graph_dir = os.path.dirname(COMMIT_GRAPH_FILE)
+        FileHandler.ensure_directory_exists(graph_dir)
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_graph_", dir=graph_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            # The old graph stays mapped until it is closed
+            CommitGraph.reload()
+            os.replace(tmp_path, COMMIT_GRAPH_FILE)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logger.info("Wrote commit-graph with %s commits", len(hashes))
+        return COMMIT_GRAPH_FILE
@@ -1,5 +1,5 @@
 import os
-from typing import Dict
+from typing import Dict, Optional
 from utils.file_utils import FileHandler
 from utils.constants import GIT_DIR
 from utils.logger_utils import LoggerUtil
@@ -19,7 +19,29 @@ class Config:
         )
         config[key] = value
         FileHandler.write_config(Config.CONFIG_PATH, config)
-        logger.info(f"Config set: {key}={value}")
+        logger.info("Config set: %s=%s", key, value)
+
+    @staticmethod
+    def get(key: str, default: Optional[str] = None) -> Optional[str]:
+        if not os.path.exists(Config.CONFIG_PATH):
+            return default
+        return FileHandler.read_config(Config.CONFIG_PATH).get(key, default)
+
+    @staticmethod
+    def get_int(key: str, default: int) -> int:
+        value = Config.get(key)
+        try:
+            return int(value) if value is not None else default
+        except ValueError:
+            logger.warning("Invalid integer for %s: %s", key, value)
+            return default
+
+    @staticmethod
+    def get_bool(key: str, default: bool) -> bool:
+        value = Config.get(key)
+        if value is None:
+            return default
+        return value.strip().lower() not in ("false", "0", "no", "off")
 
     @staticmethod
     def validate_required() -> bool:
@@ -36,7 +58,7 @@ class Config:
             )
 
         except Exception as e:
-            logger.error(f"Config validation failed: {str(e)}")
+            logger.error("Config validation failed: %s", e)
             return False
 
     @staticmethod
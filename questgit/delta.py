@@ -0,0 +1,177 @@
+from typing import Optional, Tuple
+
+# Delta layout, as in git: base size and target size as varints, then a
+# list of instructions. A copy instruction has its high bit set; its low
+# bits say which offset (4) and size (3) bytes follow, little endian. Any
+# other non-zero byte n inserts the next n literal bytes.
+COPY_OP = 0x80
+MAX_INSERT = 0x7F
+MAX_COPY = 0xFFFFFF
+BLOCK_SIZE = 16
+SAMPLE_BLOCKS = 64
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+class Delta:
+
+    @staticmethod
+    def _emit_insert(out: bytearray, data: bytes):
+        for start in range(0, len(data), MAX_INSERT):
+            chunk = data[start:start + MAX_INSERT]
+            out.append(len(chunk))
+            out += chunk
+
+    @staticmethod
+    def _emit_copy(out: bytearray, offset: int, size: int):
+        op = COPY_OP
+        args = bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xFF
+            if byte:
+                op |= 1 << i
+                args.append(byte)
+        for i in range(3):
+            byte = (size >> (8 * i)) & 0xFF
+            if byte:
+                op |= 0x10 << i
+                args.append(byte)
+        out.append(op)
+        out += args
+
+    # Length of the common run of base[b:] and target[t:], compared in
+    # shrinking slices rather than byte by byte
+    @staticmethod
+    def _match_length(base: bytes, b: int, target: bytes, t: int) -> int:
+        limit = min(len(base) - b, len(target) - t, MAX_COPY)
+        length = 0
+        step = 4096
+        while length < limit:
+            size = min(step, limit - length)
+            if base[b + length:b + length + size] == target[t + length:t + length + size]:
+                length += size
+            elif size == 1:
+                break
+            else:
+                step = max(1, size // 2)
+        return length
+
+    @staticmethod
+    def _index(base: bytes) -> dict:
+        index = {}
+        for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+            index.setdefault(base[offset:offset + BLOCK_SIZE], offset)
+        return index
+
+    # Cheap similarity test: look for a few target blocks in the base at
+    # any alignment before paying for a full scan
+    @staticmethod
+    def _looks_similar(index: dict, target: bytes) -> bool:
+        positions = len(target) - 2 * BLOCK_SIZE
+        if positions <= 0:
+            return bool(index)
+
+        samples = min(SAMPLE_BLOCKS, positions // BLOCK_SIZE or 1)
+        hits = 0
+        for n in range(samples):
+            start = n * positions // samples
+            for t in range(start, start + BLOCK_SIZE):
+                if target[t:t + BLOCK_SIZE] in index:
+                    hits += 1
+                    break
+        return hits * 4 >= samples
+
+    # Returns a delta that rebuilds target from base, or None when it
+    # would not be smaller than max_size
+    @staticmethod
+    def create(base: bytes, target: bytes, max_size: int) -> Optional[bytes]:
+        index = Delta._index(base)
+        if not Delta._looks_similar(index, target):
+            return None
+
+        out = bytearray(encode_varint(len(base)) + encode_varint(len(target)))
+        literal_start = 0
+        t = 0
+        last = len(target) - BLOCK_SIZE
+        while t <= last:
+            b = index.get(target[t:t + BLOCK_SIZE])
+            if b is None:
+                t += 1
+                if t - literal_start > max_size:
+                    return None
+                continue
+
+            # Grow the match backwards into the pending literal run
+            while b > 0 and t > literal_start and base[b - 1] == target[t - 1]:
+                b -= 1
+                t -= 1
+
+            length = Delta._match_length(base, b, target, t)
+            Delta._emit_insert(out, target[literal_start:t])
+            Delta._emit_copy(out, b, length)
+            t += length
+            literal_start = t
+            if len(out) >= max_size:
+                return None
+
+        Delta._emit_insert(out, target[literal_start:])
+        if len(out) >= max_size:
+            return None
+        return bytes(out)
+
+    @staticmethod
+    def apply(base: bytes, delta: bytes) -> bytes:
+        base_size, pos = decode_varint(delta, 0)
+        target_size, pos = decode_varint(delta, pos)
+        if base_size != len(base):
+            raise ValueError("Delta base size mismatch")
+
+        out = bytearray()
+        while pos < len(delta):
+            op = delta[pos]
+            pos += 1
+            if op & COPY_OP:
+                offset = 0
+                size = 0
+                for i in range(4):
+                    if op & (1 << i):
+                        offset |= delta[pos] << (8 * i)
+                        pos += 1
+                for i in range(3):
+                    if op & (0x10 << i):
+                        size |= delta[pos] << (8 * i)
+                        pos += 1
+                if size == 0:
+                    size = 0x10000
+                out += base[offset:offset + size]
+            elif op:
+                out += delta[pos:pos + op]
+                pos += op
+            else:
+                raise ValueError("Invalid delta instruction")
+
+        if len(out) != target_size:
+            raise ValueError("Delta target size mismatch")
+        return bytes(out)
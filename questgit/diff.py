@@ -0,0 +1,603 @@
+import bisect
+import os
+from collections import Counter
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
+from .objects import ObjectStore
+
+logger = LoggerUtil.setup_logger(__name__)
+
+TREE_MODE = "040000"
+NULL_HASH = "0" * 40
+# Lines seen more often than this on the old side are never used as
+# anchors; regions with nothing rarer in common fall back to Myers
+MAX_CHAIN = 64
+# Edit distance beyond which Myers gives up and reports the region as
+# replaced, so a pathological region can't take quadratic time
+MYERS_MAX_COST = 1000
+# Files with a NUL byte in their first 8000 bytes are treated as binary
+BINARY_PROBE = 8000
+DEFAULT_CONTEXT = 3
+
+# (a start, b start, length) of lines that match, as difflib
+Block = Tuple[int, int, int]
+# (tag, a start, a end, b start, b end), tag "equal" or "change"
+HunkOp = Tuple[str, int, int, int, int]
+
+# (mode, blob hash or None, subtree node or None) of a directory entry
+Child = Tuple[str, Optional[str], object]
+
+
+# Line diff: common prefix and suffix are trimmed, then the rest is
+# matched with histogram diff, splitting around the longest run anchored
+# on the rarest common line. Each line is interned to an int first, so the
+# matching compares ints and never looks at line contents twice.
+class LineDiff:
+
+    @staticmethod
+    def split_lines(data: bytes) -> List[bytes]:
+        lines = data.split(b"\n")
+        last = lines.pop()
+        lines = [line + b"\n" for line in lines]
+        if last:
+            lines.append(last)
+        return lines
+
+    # Matching blocks in order, ending with (len(a), len(b), 0)
+    @staticmethod
+    @Tracer.traced("diff.lines")
+    def matching_blocks(a: Sequence[bytes], b: Sequence[bytes]) -> List[Block]:
+        ids: Dict[bytes, int] = {}
+        a_ids = [ids.setdefault(line, len(ids)) for line in a]
+        b_ids = [ids.setdefault(line, len(ids)) for line in b]
+        n, m = len(a_ids), len(b_ids)
+
+        prefix = 0
+        limit = min(n, m)
+        while prefix < limit and a_ids[prefix] == b_ids[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and a_ids[n - 1 - suffix] == b_ids[m - 1 - suffix]:
+            suffix += 1
+
+        blocks: List[Block] = []
+        if prefix:
+            blocks.append((0, 0, prefix))
+        i, j = prefix, prefix
+        for anchor_a, anchor_b in LineDiff._unique_matches(
+            a_ids, b_ids, prefix, n - suffix, prefix, m - suffix
+        ):
+            if i < anchor_a and j < anchor_b:
+                LineDiff._histogram(a_ids, b_ids, i, anchor_a, j, anchor_b, blocks)
+            blocks.append((anchor_a, anchor_b, 1))
+            i, j = anchor_a + 1, anchor_b + 1
+        LineDiff._histogram(a_ids, b_ids, i, n - suffix, j, m - suffix, blocks)
+        if suffix:
+            blocks.append((n - suffix, m - suffix, suffix))
+
+        merged: List[Block] = []
+        for block in blocks:
+            if merged:
+                last_a, last_b, last_size = merged[-1]
+                if last_a + last_size == block[0] and last_b + last_size == block[1]:
+                    merged[-1] = (last_a, last_b, last_size + block[2])
+                    continue
+            merged.append(block)
+        merged.append((n, m, 0))
+        return merged
+
+    # Lines found exactly once on each side, paired up and reduced to the
+    # longest sequence in the same order on both sides (patience sorting).
+    # They split a long file into small regions in one pass, where
+    # histogram alone would rescan the file once per level of splitting.
+    @staticmethod
+    def _unique_matches(
+        a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int
+    ) -> List[Tuple[int, int]]:
+        a_counts = Counter(a[alo:ahi])
+        b_counts = Counter(b[blo:bhi])
+        a_position = dict(zip(a[alo:ahi], range(alo, ahi)))
+        pairs = [
+            (a_position[line], j)
+            for j, line in zip(range(blo, bhi), b[blo:bhi])
+            if b_counts[line] == 1 and a_counts.get(line) == 1
+        ]
+
+        # tails[k]: smallest a position ending an increasing run of k + 1
+        # pairs, and the pair that ends it
+        tails: List[int] = []
+        tail_pairs: List[int] = []
+        previous: List[Optional[int]] = []
+        for n, (i, _) in enumerate(pairs):
+            # Mostly the pairs are already in order
+            if tails and i > tails[-1]:
+                k = len(tails)
+            else:
+                k = bisect.bisect_left(tails, i)
+            if k == len(tails):
+                tails.append(i)
+                tail_pairs.append(n)
+            else:
+                tails[k] = i
+                tail_pairs[k] = n
+            previous.append(tail_pairs[k - 1] if k else None)
+
+        matches = []
+        n = tail_pairs[-1] if tail_pairs else None
+        while n is not None:
+            matches.append(pairs[n])
+            n = previous[n]
+        matches.reverse()
+        return matches
+
+    # Regions are kept on a stack rather than recursed into, so long files
+    # with many changes can't hit the recursion limit
+    @staticmethod
+    def _histogram(
+        a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int, blocks: List[Block]
+    ):
+        # Regions to diff and matches found, to be handled in reverse order
+        stack: List[tuple] = [(alo, ahi, blo, bhi)]
+        while stack:
+            item = stack.pop()
+            if len(item) == 3:
+                blocks.append(item)
+                continue
+
+            alo, ahi, blo, bhi = item
+            if alo == ahi or blo == bhi:
+                continue
+            anchor = LineDiff._find_anchor(a, b, alo, ahi, blo, bhi)
+            if anchor is None:
+                blocks.extend(LineDiff._myers(a, b, alo, ahi, blo, bhi))
+                continue
+
+            i, j, size = anchor
+            stack.append((i + size, ahi, j + size, bhi))
+            stack.append(anchor)
+            stack.append((alo, i, blo, j))
+
+    # The longest run of equal lines around an occurrence of the rarest
+    # line the two regions share, or None if every shared line is too
+    # common
+    @staticmethod
+    def _find_anchor(
+        a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int
+    ) -> Optional[Block]:
+        occurrences: Dict[int, List[int]] = {}
+        for i in range(alo, ahi):
+            positions = occurrences.get(a[i])
+            if positions is None:
+                occurrences[a[i]] = [i]
+            else:
+                positions.append(i)
+
+        best = None
+        best_count = MAX_CHAIN + 1
+        best_size = 0
+        j = blo
+        while j < bhi:
+            next_j = j + 1
+            positions = occurrences.get(b[j])
+            if positions is not None and len(positions) <= best_count:
+                for i in positions:
+                    # A run is only as rare as its most common line
+                    count = len(positions)
+                    start_a, start_b = i, j
+                    while start_a > alo and start_b > blo and a[start_a - 1] == b[start_b - 1]:
+                        start_a -= 1
+                        start_b -= 1
+                        if len(occurrences[a[start_a]]) < count:
+                            count = len(occurrences[a[start_a]])
+                    end_a, end_b = i + 1, j + 1
+                    while end_a < ahi and end_b < bhi and a[end_a] == b[end_b]:
+                        if len(occurrences[a[end_a]]) < count:
+                            count = len(occurrences[a[end_a]])
+                        end_a += 1
+                        end_b += 1
+
+                    size = end_a - start_a
+                    if count < best_count or (count == best_count and size > best_size):
+                        best = (start_a, start_b, size)
+                        best_count = count
+                        best_size = size
+                    # Lines inside the run can't start a longer one
+                    next_j = max(next_j, end_b)
+            j = next_j
+        return best
+
+    # Greedy Myers over one region, for when histogram finds no anchor.
+    # Keeps the furthest-reaching x per diagonal for each edit distance
+    # and walks them back to recover the matches.
+    @staticmethod
+    def _myers(a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int) -> List[Block]:
+        if not set(a[alo:ahi]).intersection(b[blo:bhi]):
+            return []
+
+        n, m = ahi - alo, bhi - blo
+        max_cost = min(n + m, MYERS_MAX_COST)
+        offset = max_cost + 1
+        v = [0] * (2 * max_cost + 3)
+        # trace[d][k + d]: furthest x on diagonal k after d edits
+        trace: List[List[int]] = []
+        found = None
+        for d in range(max_cost + 1):
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                    x = v[offset + k + 1]
+                else:
+                    x = v[offset + k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[alo + x] == b[blo + y]:
+                    x += 1
+                    y += 1
+                v[offset + k] = x
+                if x >= n and y >= m:
+                    found = d
+                    break
+            if found is not None:
+                break
+            trace.append(v[offset - d:offset + d + 1])
+
+        if found is None:
+            logger.debug("Diff region %d-%d too costly for Myers, shown as replaced", alo, ahi)
+            return []
+
+        blocks: List[Block] = []
+        x, y = n, m
+        for d in range(found, 0, -1):
+            previous = trace[d - 1]
+            k = x - y
+            if k == -d or (k != d and previous[k - 1 + d - 1] < previous[k + 1 + d - 1]):
+                prev_k = k + 1
+                prev_x = previous[prev_k + d - 1]
+                mid_x, mid_y = prev_x, prev_x - prev_k + 1
+            else:
+                prev_k = k - 1
+                prev_x = previous[prev_k + d - 1]
+                mid_x, mid_y = prev_x + 1, prev_x - prev_k
+            if x > mid_x:
+                blocks.append((alo + mid_x, blo + mid_y, x - mid_x))
+            x, y = prev_x, prev_x - prev_k
+        if x > 0:
+            blocks.append((alo, blo, x))
+        blocks.reverse()
+        return blocks
+
+    # Hunks as (a start, a end, b start, b end, ops). Changes closer than
+    # twice the context share a hunk.
+    @staticmethod
+    def hunks(
+        blocks: List[Block], context: int = DEFAULT_CONTEXT
+    ) -> Iterator[Tuple[int, int, int, int, List[HunkOp]]]:
+        hunk = None  # [a start, b start, a end, b end, ops]
+        i = j = 0
+        equal = 0  # length of the equal run ending at i, j
+        for block_a, block_b, size in blocks:
+            if i < block_a or j < block_b:
+                if hunk is not None and i - hunk[2] <= 2 * context:
+                    if i > hunk[2]:
+                        hunk[4].append(("equal", hunk[2], i, hunk[3], j))
+                else:
+                    if hunk is not None:
+                        yield LineDiff._close_hunk(hunk, hunk[2] + min(context, equal))
+                    before = min(context, equal)
+                    hunk = [i - before, j - before, i, j, []]
+                    if before:
+                        hunk[4].append(("equal", i - before, i, j - before, j))
+                hunk[4].append(("change", i, block_a, j, block_b))
+                hunk[2], hunk[3] = block_a, block_b
+            equal = size
+            i, j = block_a + size, block_b + size
+
+        if hunk is not None:
+            yield LineDiff._close_hunk(hunk, min(hunk[2] + context, i))
+
+    @staticmethod
+    def _close_hunk(hunk: list, a_end: int) -> Tuple[int, int, int, int, List[HunkOp]]:
+        a_start, b_start, change_a, change_b, ops = hunk
+        b_end = change_b + a_end - change_a
+        if a_end > change_a:
+            ops.append(("equal", change_a, a_end, change_b, b_end))
+        return a_start, a_end, b_start, b_end, ops
+
+    # "start,length" as in unified diff headers: the length is left out
+    # when it is 1, and an empty range gives the line before it
+    @staticmethod
+    def format_range(start: int, end: int) -> str:
+        length = end - start
+        if length == 1:
+            return str(start + 1)
+        if length == 0:
+            return f"{start},0"
+        return f"{start + 1},{length}"
+
+
+# One changed path, with blob hash and mode on each side; hash and mode
+# are None on the side where the path does not exist
+class FileChange:
+    __slots__ = ("path", "old_hash", "new_hash", "old_mode", "new_mode")
+
+    def __init__(
+        self,
+        path: str,
+        old_hash: Optional[str],
+        new_hash: Optional[str],
+        old_mode: Optional[str],
+        new_mode: Optional[str],
+    ):
+        self.path = path
+        self.old_hash = old_hash
+        self.new_hash = new_hash
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+
+
+# A committed tree. Nodes are tree hashes.
+class TreeSide:
+
+    def __init__(self, tree_hash: Optional[str]):
+        self.root = tree_hash
+
+    def tree_hash(self, node) -> Optional[str]:
+        return node
+
+    def children(self, node, dir_path: str) -> Dict[str, Child]:
+        entries = ObjectStore.read_tree(node)
+        if entries is None:
+            logger.error("Cannot read tree %s for %s", node, dir_path or ".")
+            return {}
+        return {
+            name: (mode, None, obj_hash) if obj_type == "tree" else (mode, obj_hash, None)
+            for mode, obj_type, obj_hash, name in entries
+        }
+
+
+# The index, seen as the tree the next commit would record. Nodes are
+# (start, end, directory) ranges of the sorted paths, as when the commit
+# tree is built; a directory's hash comes from the cached trees and is
+# None when it has not been computed since the directory last changed.
+# The paths are only listed once a directory has to be looked into, so
+# comparing against a tree the cache already matches reads no entries.
+class IndexSide:
+
+    def __init__(self, index):
+        self.index = index
+        self._paths: Optional[List[str]] = None
+        count = index.entry_count()
+        self.root = (0, count, "") if count else None
+
+    @property
+    def paths(self) -> List[str]:
+        if self._paths is None:
+            self._paths = self.index.sorted_paths()
+        return self._paths
+
+    def tree_hash(self, node) -> Optional[str]:
+        start, end, dir_path = node
+        cached = self.index.get_cached_tree(dir_path)
+        if cached and cached[1] == end - start:
+            return cached[0]
+        return None
+
+    def children(self, node, dir_path: str) -> Dict[str, Child]:
+        start, end, _ = node
+        prefix = dir_path + os.sep if dir_path else ""
+        children: Dict[str, Child] = {}
+        i = start
+        while i < end:
+            path = self.paths[i]
+            name = path[len(prefix):]
+            if os.sep not in name:
+                children[name] = (self.index.file_mode(path), self.index.entries[path], None)
+                i += 1
+                continue
+
+            sub_name = name.split(os.sep, 1)[0]
+            sub_dir = prefix + sub_name
+            group_end = bisect.bisect_left(self.paths, sub_dir + chr(ord(os.sep) + 1), i, end)
+            children[sub_name] = (TREE_MODE, None, (i, group_end, sub_dir))
+            i = group_end
+        return children
+
+
+class TreeDiff:
+
+    # Paths in pathspec and everything below them; an empty pathspec
+    # matches everything. Directories above a pathspec entry also match,
+    # so the walk can reach it.
+    @staticmethod
+    def in_pathspec(path: str, pathspec: List[str], is_dir: bool = False) -> bool:
+        if not pathspec:
+            return True
+        for spec in pathspec:
+            if not spec or path == spec or path.startswith(spec + os.sep):
+                return True
+            if is_dir and spec.startswith(path + os.sep):
+                return True
+        return False
+
+    # Walks two trees side by side. Subtrees with the same hash on both
+    # sides are skipped without being read, and blobs are only compared
+    # by hash, so the cost follows the size of the change rather than of
+    # the trees.
+    @staticmethod
+    @Tracer.traced("diff.trees")
+    def compare(old_side, new_side, pathspec: List[str] = None) -> Iterator[FileChange]:
+        pathspec = pathspec or []
+        yield from TreeDiff._compare_nodes(old_side, old_side.root, new_side, new_side.root, "", pathspec)
+
+    @staticmethod
+    def _compare_nodes(
+        old_side, old_node, new_side, new_node, dir_path: str, pathspec: List[str]
+    ) -> Iterator[FileChange]:
+        old_hash = old_side.tree_hash(old_node) if old_node is not None else None
+        new_hash = new_side.tree_hash(new_node) if new_node is not None else None
+        if old_hash is not None and old_hash == new_hash:
+            Tracer.count("trees skipped")
+            return
+
+        old_children = old_side.children(old_node, dir_path) if old_node is not None else {}
+        new_children = new_side.children(new_node, dir_path) if new_node is not None else {}
+        for name in sorted(old_children.keys() | new_children.keys()):
+            path = os.path.join(dir_path, name) if dir_path else name
+            old_mode, old_blob, old_tree = old_children.get(name, (None, None, None))
+            new_mode, new_blob, new_tree = new_children.get(name, (None, None, None))
+
+            if old_tree is not None or new_tree is not None:
+                if TreeDiff.in_pathspec(path, pathspec, True):
+                    yield from TreeDiff._compare_nodes(
+                        old_side, old_tree, new_side, new_tree, path, pathspec
+                    )
+                # A file replaced by a directory, or the other way round
+                if old_blob is None and new_blob is None:
+                    continue
+                if old_tree is not None:
+                    old_mode = None
+                if new_tree is not None:
+                    new_mode = None
+
+            if old_blob == new_blob and old_mode == new_mode:
+                continue
+            if TreeDiff.in_pathspec(path, pathspec):
+                yield FileChange(path, old_blob, new_blob, old_mode, new_mode)
+
+    # Tracked files whose working tree content differs from the index.
+    # Files that look untouched by their stat data are not read; the new
+    # hash of a changed file is what it hashes to now.
+    @staticmethod
+    @Tracer.traced("diff.worktree")
+    def compare_worktree(index, scan, pathspec: List[str] = None) -> List[FileChange]:
+        pathspec = pathspec or []
+        changes = []
+        for path, st in scan.files.items():
+            staged_hash = index.get_entry(path)
+            if staged_hash is None or not TreeDiff.in_pathspec(path, pathspec):
+                continue
+            # Read before hash_file, which may refresh the stat data
+            staged_mode = index.file_mode(path)
+            current_hash = index.hash_file(path, st)
+            current_mode = "100755" if st.st_mode & 0o111 else "100644"
+            if current_hash is None:
+                continue
+            if current_hash != staged_hash or current_mode != staged_mode:
+                changes.append(FileChange(path, staged_hash, current_hash, staged_mode, current_mode))
+
+        for path in scan.missing:
+            if TreeDiff.in_pathspec(path, pathspec):
+                changes.append(
+                    FileChange(path, index.get_entry(path), None, index.file_mode(path), None)
+                )
+        changes.sort(key=lambda change: change.path)
+        return changes
+
+
+# Writes changes as a unified diff, one hunk at a time, so output starts
+# before the last file is compared and is never held in full
+class PatchWriter:
+
+    COLORS = {
+        "meta": b"\033[1m",
+        "frag": b"\033[36m",
+        "old": b"\033[31m",
+        "new": b"\033[32m",
+        "reset": b"\033[0m",
+    }
+
+    def __init__(self, out: BinaryIO, context: int = DEFAULT_CONTEXT, color: bool = False):
+        self.out = out
+        self.context = context
+        self.color = color
+
+    def _paint(self, kind: str, line: bytes) -> bytes:
+        if not self.color:
+            return line
+        return self.COLORS[kind] + line + self.COLORS["reset"]
+
+    # old_content and new_content are read only when the hashes differ,
+    # so a mode-only change never touches the blobs. worktree means the
+    # new side is the file at change.path rather than a stored blob.
+    def write(self, change: FileChange, worktree: bool = False):
+        old_path = f"a/{change.path}".encode("utf-8")
+        new_path = f"b/{change.path}".encode("utf-8")
+        header = [self._paint("meta", b"diff --questgit " + old_path + b" " + new_path) + b"\n"]
+        if change.old_mode is None:
+            header.append(self._paint("meta", f"new file mode {change.new_mode}".encode()) + b"\n")
+        elif change.new_mode is None:
+            header.append(self._paint("meta", f"deleted file mode {change.old_mode}".encode()) + b"\n")
+        elif change.old_mode != change.new_mode:
+            header.append(self._paint("meta", f"old mode {change.old_mode}".encode()) + b"\n")
+            header.append(self._paint("meta", f"new mode {change.new_mode}".encode()) + b"\n")
+
+        if change.old_hash == change.new_hash:
+            self.out.write(b"".join(header))
+            return
+
+        index_line = f"index {(change.old_hash or NULL_HASH)[:7]}..{(change.new_hash or NULL_HASH)[:7]}"
+        if change.old_mode is not None and change.old_mode == change.new_mode:
+            index_line += f" {change.old_mode}"
+        header.append(self._paint("meta", index_line.encode()) + b"\n")
+
+        old = self._read(change.old_hash, change.path, False)
+        new = self._read(change.new_hash, change.path, worktree)
+        if old is None or new is None:
+            self.out.write(b"".join(header))
+            return
+
+        old_label = old_path if change.old_hash else b"/dev/null"
+        new_label = new_path if change.new_hash else b"/dev/null"
+        if b"\0" in old[:BINARY_PROBE] or b"\0" in new[:BINARY_PROBE]:
+            header.append(b"Binary files " + old_label + b" and " + new_label + b" differ\n")
+            self.out.write(b"".join(header))
+            return
+
+        header.append(self._paint("meta", b"--- " + old_label) + b"\n")
+        header.append(self._paint("meta", b"+++ " + new_label) + b"\n")
+        self.out.write(b"".join(header))
+
+        a = LineDiff.split_lines(old)
+        b = LineDiff.split_lines(new)
+        for hunk in LineDiff.hunks(LineDiff.matching_blocks(a, b), self.context):
+            self.out.write(self._format_hunk(a, b, hunk))
+
+    def _read(self, blob_hash: Optional[str], path: str, worktree: bool) -> Optional[bytes]:
+        if blob_hash is None:
+            return b""
+        if not worktree:
+            return ObjectStore.read_blob_bytes(blob_hash)
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError as e:
+            logger.error("Error reading %s: %s", path, e)
+            return None
+
+    def _format_hunk(self, a: List[bytes], b: List[bytes], hunk) -> bytes:
+        a_start, a_end, b_start, b_end, ops = hunk
+        lines = [
+            self._paint(
+                "frag",
+                f"@@ -{LineDiff.format_range(a_start, a_end)} "
+                f"+{LineDiff.format_range(b_start, b_end)} @@".encode(),
+            )
+            + b"\n"
+        ]
+        for tag, i1, i2, j1, j2 in ops:
+            if tag == "equal":
+                lines.extend(self._line(b" ", "", line) for line in a[i1:i2])
+                continue
+            lines.extend(self._line(b"-", "old", line) for line in a[i1:i2])
+            lines.extend(self._line(b"+", "new", line) for line in b[j1:j2])
+        return b"".join(lines)
+
+    def _line(self, marker: bytes, kind: str, line: bytes) -> bytes:
+        if line.endswith(b"\n"):
+            text, end = line[:-1], b"\n"
+        else:
+            text, end = line, b"\n\\ No newline at end of file\n"
+        if kind:
+            return self._paint(kind, marker + text) + end
+        return marker + text + end
@@ -0,0 +1,448 @@
+import errno
+import os
+import socket
+import struct
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.file_utils import FileHandler
+from utils.constants import (
+    GIT_DIR,
+    EXCLUDE_FILE,
+    IGNORE_FILE,
+    FSMONITOR_SOCKET,
+    FSMONITOR_STATE_FILE,
+)
+from .config import Config
+from .ignore import IgnoreMatcher
+from .refs import RefLock
+from .repository import Repository
+
+logger = LoggerUtil.setup_logger(__name__)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+# Beyond this many distinct dirty paths the journal is dropped and every
+# client falls back to a full scan once
+MAX_JOURNAL_PATHS = 1 << 20
+CLIENT_TIMEOUT = 2.0
+STATE_SIGNATURE = "questgit-fsmonitor 1"
+
+
+# Linux inotify through ctypes. Only the daemon needs it, so ctypes is
+# imported here rather than by every command that loads this module.
+class Inotify:
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    # (wd, mask, name) of every queued event
+    def read_events(self) -> Iterator[Tuple[int, int, str]]:
+        while True:
+            try:
+                data = os.read(self.fd, 256 * 1024)
+            except BlockingIOError:
+                return
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, name_len = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                name = data[pos:pos + name_len].rstrip(b"\0")
+                pos += name_len
+                yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Local daemon watching the working tree. It keeps a journal of paths that
+# changed, each stamped with a sequence number; a token names a daemon
+# instance and a point in its journal, so a client can ask for everything
+# that changed since its last token. Tokens from another instance, or from
+# before an overflow, get "full" back and the client scans everything.
+class FSMonitorDaemon:
+
+    def __init__(self):
+        self.instance = os.urandom(8).hex()
+        self.seq = 0
+        # Tokens older than this predate a reset of the journal
+        self.reset_seq = 0
+        self.journal: Dict[str, int] = {}
+        self.watches: Dict[int, str] = {}  # wd -> directory, "" for the root
+        self.inotify = Inotify()
+        self.running = True
+
+    def _token(self) -> str:
+        return f"{self.instance}:{self.seq}"
+
+    def _reset(self):
+        self.journal.clear()
+        self.seq += 1
+        self.reset_seq = self.seq
+
+    def _record(self, path: str):
+        self.seq += 1
+        self.journal[path] = self.seq
+        if len(self.journal) > MAX_JOURNAL_PATHS:
+            logger.warning("fsmonitor journal full, clients will rescan")
+            self._reset()
+
+    def _watch(self, directory: str) -> bool:
+        try:
+            wd = self.inotify.add_watch(directory or ".")
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logger.error(
+                    "Out of inotify watches, raise fs.inotify.max_user_watches; "
+                    "clients will rescan"
+                )
+                self._reset()
+            return False
+        self.watches[wd] = directory
+        return True
+
+    # Watches directory and every directory below it that isn't ignored
+    def _watch_tree(self, directory: str, matcher: IgnoreMatcher):
+        pending = [(directory, matcher)]
+        while pending:
+            directory, matcher = pending.pop()
+            if not self._watch(directory):
+                continue
+            try:
+                with os.scandir(directory or ".") as it:
+                    entries = list(it)
+            except OSError:
+                continue
+
+            if any(entry.name == IGNORE_FILE for entry in entries):
+                matcher = matcher.enter(directory)
+            for entry in entries:
+                if entry.name in Repository.IGNORED_DIRS:
+                    continue
+                path = os.path.join(directory, entry.name) if directory else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False) and not matcher.is_ignored(path, True):
+                        pending.append((path, matcher))
+                except OSError:
+                    continue
+
+    def _unwatch_tree(self, directory: str):
+        prefix = directory + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _watch_all(self):
+        self._watch_tree("", IgnoreMatcher.root())
+        # .questgit itself is never watched, except where exclude lives
+        info_dir = os.path.dirname(EXCLUDE_FILE)
+        if os.path.isdir(info_dir):
+            self._watch(info_dir)
+
+    def _process_events(self):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, clients will rescan")
+                self._reset()
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # The parent's watch reports the directory itself
+                if directory == "":
+                    logger.info("Working tree went away, fsmonitor stopping")
+                    self.running = False
+                continue
+            if not name or (directory == "" and name == GIT_DIR):
+                continue
+
+            path = os.path.join(directory, name) if directory else name
+            self._record(path)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    matcher = IgnoreMatcher.for_parent(path)
+                    if name not in Repository.IGNORED_DIRS and not matcher.is_ignored(
+                        path, True
+                    ):
+                        self._watch_tree(path, matcher)
+                elif mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+            elif name == IGNORE_FILE or path == EXCLUDE_FILE:
+                # Directories that just stopped being ignored need watches
+                self._watch_all()
+
+    def answer(self, token: str) -> str:
+        # Anything that happened before the request is already queued
+        self._process_events()
+
+        instance, _, seq = token.partition(":")
+        since = int(seq) if seq.isdigit() else -1
+        full = instance != self.instance or since < self.reset_seq
+
+        lines = [self._token(), "full" if full else "changes"]
+        if not full:
+            lines.extend(
+                sorted(path for path, path_seq in self.journal.items() if path_seq > since)
+            )
+        return "\n".join(lines) + "\n"
+
+    def _handle(self, conn: socket.socket):
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            request = b""
+            while not request.endswith(b"\n"):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+
+            command, _, argument = request.decode("utf-8").strip().partition(" ")
+            if command == "query":
+                conn.sendall(self.answer(argument).encode("utf-8"))
+            elif command == "stop":
+                self.running = False
+                conn.sendall(b"ok\n")
+        except OSError as e:
+            logger.warning("fsmonitor client error: %s", e)
+        finally:
+            conn.close()
+
+    def serve(self):
+        import selectors
+
+        if os.path.exists(FSMONITOR_SOCKET):
+            if FSMonitor.is_running():
+                print("fsmonitor is already running")
+                return
+            os.remove(FSMONITOR_SOCKET)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(FSMONITOR_SOCKET)
+        server.listen()
+        self._watch_all()
+        logger.info("fsmonitor watching %s directories", len(self.watches))
+
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        selector.register(self.inotify.fd, selectors.EVENT_READ)
+        try:
+            while self.running:
+                for key, _ in selector.select():
+                    if key.fileobj is server:
+                        conn, _ = server.accept()
+                        self._handle(conn)
+                    else:
+                        self._process_events()
+        finally:
+            selector.close()
+            server.close()
+            self.inotify.close()
+            if os.path.exists(FSMONITOR_SOCKET):
+                os.remove(FSMONITOR_SOCKET)
+            logger.info("fsmonitor stopped")
+
+
+# Client side of the daemon, enabled with `questgit config core.fsmonitor true`
+class FSMonitor:
+
+    @staticmethod
+    def enabled() -> bool:
+        return Config.get_bool("core.fsmonitor", False) and sys.platform.startswith("linux")
+
+    @staticmethod
+    def _request(command: str) -> Optional[List[str]]:
+        if not os.path.exists(FSMONITOR_SOCKET):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(CLIENT_TIMEOUT)
+                client.connect(FSMONITOR_SOCKET)
+                client.sendall(f"{command}\n".encode("utf-8"))
+                chunks = []
+                while True:
+                    chunk = client.recv(256 * 1024)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+        except OSError as e:
+            logger.warning("fsmonitor not reachable: %s", e)
+            return None
+        return b"".join(chunks).decode("utf-8").splitlines()
+
+    @staticmethod
+    def is_running() -> bool:
+        return FSMonitor._request("query -") is not None
+
+    # (new token, paths changed since token) or (new token, None) when the
+    # caller has to scan everything. None if the daemon isn't running.
+    @staticmethod
+    def query(token: Optional[str]) -> Optional[Tuple[str, Optional[List[str]]]]:
+        reply = FSMonitor._request(f"query {token or '-'}")
+        if not reply or len(reply) < 2:
+            return None
+        if reply[1] != "changes":
+            return reply[0], None
+        return reply[0], reply[2:]
+
+    @staticmethod
+    def start() -> bool:
+        import subprocess
+
+        if FSMonitor.is_running():
+            return True
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        python_path = os.pathsep.join(
+            filter(None, [package_root, os.environ.get("PYTHONPATH")])
+        )
+        subprocess.Popen(
+            [sys.executable, "-m", "cli", "fsmonitor", "run"],
+            cwd=os.getcwd(),
+            env=dict(os.environ, PYTHONPATH=python_path),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if FSMonitor.is_running():
+                return True
+            time.sleep(0.05)
+        return False
+
+    @staticmethod
+    def stop() -> bool:
+        return FSMonitor._request("stop") is not None
+
+
+# What the last scan learned, kept next to the index: the daemon token it
+# is valid from, the index file it was checked against, tracked paths that
+# did not match the index, and untracked paths. A later scan only looks at
+# these plus whatever the daemon reports as changed since the token.
+class FSMonitorState:
+
+    def __init__(
+        self,
+        token: str,
+        index_stamp: Optional[Tuple[int, int, int]],
+        dirty: Set[str],
+        untracked: Set[str],
+    ):
+        self.token = token
+        self.index_stamp = index_stamp
+        self.dirty = dirty
+        self.untracked = untracked
+
+    @staticmethod
+    def load() -> Optional["FSMonitorState"]:
+        if not os.path.exists(FSMONITOR_STATE_FILE):
+            return None
+        content = FileHandler.read_binary(FSMONITOR_STATE_FILE)
+        if not content:
+            return None
+
+        lines = content.decode("utf-8").split("\n")
+        if lines[0] != STATE_SIGNATURE or len(lines) < 3:
+            return None
+        token = lines[1]
+        stamp = tuple(int(part) for part in lines[2].split()) or None
+        dirty: Set[str] = set()
+        untracked: Set[str] = set()
+        for line in lines[3:]:
+            kind, _, path = line.partition("\t")
+            if kind == "dirty":
+                dirty.add(path)
+            elif kind == "untracked":
+                untracked.add(path)
+        return FSMonitorState(token, stamp, dirty, untracked)
+
+    def save(self):
+        lines = [
+            STATE_SIGNATURE,
+            self.token,
+            " ".join(str(part) for part in self.index_stamp or ()),
+        ]
+        lines.extend(f"dirty\t{path}" for path in sorted(self.dirty))
+        lines.extend(f"untracked\t{path}" for path in sorted(self.untracked))
+        with RefLock(FSMONITOR_STATE_FILE) as lock:
+            lock.commit("\n".join(lines).encode("utf-8"))
+
+    @staticmethod
+    def invalidate():
+        if os.path.exists(FSMONITOR_STATE_FILE):
+            os.remove(FSMONITOR_STATE_FILE)
+
+    # Called when the index is saved outside of a scan: the entries that
+    # changed have to be checked again by the next scan. If the index was
+    # replaced by anything else in between, the state can't be trusted.
+    @staticmethod
+    def index_saved(
+        previous_stamp: Optional[Tuple[int, int, int]],
+        new_stamp: Tuple[int, int, int],
+        touched: Optional[Set[str]],
+    ):
+        if not os.path.exists(FSMONITOR_STATE_FILE):
+            return
+        state = FSMonitorState.load()
+        if state is None or touched is None or state.index_stamp != previous_stamp:
+            FSMonitorState.invalidate()
+            return
+        state.dirty |= touched
+        state.index_stamp = new_stamp
+        state.save()
@@ -0,0 +1,295 @@
+import os
+import re
+import time
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Set, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
+from utils.file_utils import FileHandler
+from utils.compress_utils import CompressUtil
+from utils.constants import OBJECTS_DIR
+from .objects import ObjectStore, TEMP_PREFIX
+from .pack import PackStore, PackWriter
+from .delta import Delta
+from .index import Index
+from .commit import Commit
+from .config import Config
+from .commit_graph import CommitGraph
+from .refs import RefStore
+
+logger = LoggerUtil.setup_logger(__name__)
+
+DEFAULT_WINDOW = 10
+DEFAULT_DEPTH = 50
+
+# Tiny objects don't gain from deltas; big ones would make the window too
+# costly to hold in memory
+MIN_DELTA_SIZE = 64
+MAX_DELTA_SIZE = 8 * 1024 * 1024
+
+# Unreachable objects younger than this are kept by gc --prune, so a
+# command still writing objects it will reference doesn't lose them
+DEFAULT_PRUNE_EXPIRE = "2w"
+# Stale objects checked per walk of the history by gc --prune
+PRUNE_BATCH = 200_000
+EXPIRE_PATTERN = re.compile(r"(\d+)([smhdw]?)")
+EXPIRE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+class GarbageCollector:
+
+    # Blob hash -> a path it was stored under, from the index and from the
+    # trees of every commit on the current branch. Used to put versions of
+    # the same file next to each other when looking for delta bases.
+    @staticmethod
+    def _path_hints() -> Dict[str, str]:
+        hints: Dict[str, str] = {}
+        for filepath, blob_hash in Index().entries.items():
+            hints.setdefault(blob_hash, filepath)
+
+        seen_trees: Set[str] = set()
+
+        def walk_tree(tree_hash: str, prefix: str):
+            if tree_hash in seen_trees:
+                return
+            seen_trees.add(tree_hash)
+            for _, obj_type, obj_hash, name in ObjectStore.read_tree(tree_hash) or []:
+                path = f"{prefix}{name}"
+                if obj_type == "tree":
+                    walk_tree(obj_hash, f"{path}/")
+                else:
+                    hints.setdefault(obj_hash, path)
+
+        for _, tree_hash, _ in Commit.iter_history("HEAD"):
+            if tree_hash:
+                walk_tree(tree_hash, "")
+
+        return hints
+
+    @staticmethod
+    def _add_full(writer: PackWriter, obj_hash: str, size: int, source, content):
+        if isinstance(source, str):
+            writer.add_compressed(
+                obj_hash, size, os.path.getsize(source), FileHandler.iter_chunks(source)
+            )
+        elif not source.is_delta(obj_hash):
+            writer.add_compressed(obj_hash, *source.compressed(obj_hash))
+        else:
+            writer.add_object(obj_hash, content or source.read(obj_hash))
+
+    # Packs every object of the object store backend (loose files or the
+    # SQLite database) and every existing pack into a single new pack, then
+    # removes what it replaced. Objects are sorted so that
+    # versions of the same path with similar sizes sit together, and each
+    # one is delta encoded against the best of the previous `pack.window`
+    # objects, keeping chains at most `pack.depth` long.
+    @staticmethod
+    @Tracer.traced("gc.repack")
+    def repack() -> Dict[str, int]:
+        backend = ObjectStore.backend()
+        loose = list(backend.objects())
+        old_packs = list(PackStore.packs())
+        stats = {"loose": len(loose), "packs": len(old_packs), "objects": 0, "deltas": 0}
+
+        if not loose and len(old_packs) <= 1:
+            logger.info("Nothing to pack")
+            return stats
+
+        window_size = Config.get_int("pack.window", DEFAULT_WINDOW)
+        max_depth = Config.get_int("pack.depth", DEFAULT_DEPTH)
+
+        # hash -> (inflated size, loose path, or a pack or backend to read it from)
+        objects: Dict[str, Tuple[int, object]] = {}
+        packed_loose = []
+        for obj_hash, size, source in loose:
+            objects.setdefault(obj_hash, (size, source))
+            packed_loose.append(obj_hash)
+        for pack in old_packs:
+            for obj_hash in pack.iter_hashes():
+                if obj_hash not in objects:
+                    objects[obj_hash] = (pack.size_of(obj_hash), pack)
+
+        hints = GarbageCollector._path_hints()
+
+        def sort_key(obj_hash: str):
+            path = hints.get(obj_hash, "")
+            return os.path.basename(path), path, -objects[obj_hash][0]
+
+        writer = PackWriter()
+        try:
+            # (hash, content, chain depth) of recent delta candidates
+            window: Deque[Tuple[str, bytes, int]] = deque(maxlen=window_size)
+            for obj_hash in sorted(objects, key=sort_key):
+                size, source = objects[obj_hash]
+                if not MIN_DELTA_SIZE <= size <= MAX_DELTA_SIZE or window_size < 1:
+                    GarbageCollector._add_full(writer, obj_hash, size, source, None)
+                    continue
+
+                if isinstance(source, str):
+                    content = b"".join(
+                        CompressUtil.inflate_chunks(FileHandler.iter_chunks(source))
+                    )
+                else:
+                    content = source.read(obj_hash)
+
+                best = None
+                for base_hash, base, base_depth in reversed(window):
+                    if base_depth >= max_depth or abs(len(base) - size) >= size // 2:
+                        continue
+                    max_size = len(best[1]) if best else size // 2
+                    delta = Delta.create(base, content, max_size)
+                    if delta is not None:
+                        best = (base_hash, delta, base_depth + 1)
+
+                if best:
+                    writer.add_delta(obj_hash, size, best[0], best[1])
+                    stats["deltas"] += 1
+                    window.append((obj_hash, content, best[2]))
+                else:
+                    GarbageCollector._add_full(writer, obj_hash, size, source, content)
+                    window.append((obj_hash, content, 0))
+
+            idx_path = writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+        stats["objects"] = len(writer)
+        PackStore.reload()
+
+        for pack in old_packs:
+            if pack.idx_path == idx_path:
+                continue
+            os.remove(pack.idx_path)
+            os.remove(pack.pack_path)
+
+        backend.remove(packed_loose)
+
+        logger.info(
+            "Packed %s objects (%s deltas) from %s loose objects and %s packs into %s",
+            stats["objects"], stats["deltas"], len(packed_loose), len(old_packs), idx_path,
+        )
+        return stats
+
+    # "now", or a number of seconds with an optional unit: 90s, 30m, 12h,
+    # 3d, 2w
+    @staticmethod
+    def parse_expire(value: str) -> int:
+        value = value.strip().lower()
+        if value == "now":
+            return 0
+        match = EXPIRE_PATTERN.fullmatch(value)
+        if not match:
+            raise ValueError(f"Invalid expiry: {value} (use now or e.g. 2w, 3d, 12h)")
+        return int(match.group(1)) * EXPIRE_UNITS[match.group(2)]
+
+    # Commit hashes of every branch and of HEAD
+    @staticmethod
+    def _branch_heads() -> List[str]:
+        refs = RefStore.list()
+        refs.append(("HEAD", RefStore.resolve("HEAD")))
+        heads = []
+        for name, commit_hash in refs:
+            if commit_hash is None:
+                continue
+            if not ObjectStore.is_full_hash(commit_hash):
+                raise ValueError(f"Invalid ref {name}: {commit_hash!r}")
+            heads.append(commit_hash)
+        return heads
+
+    # Mark phase: drops from candidates every object reachable from the
+    # branches and the index. Candidates are raw object names of key_len
+    # bytes. Commits and trees already walked are remembered so that each
+    # is read once however many commits share it; blobs are never
+    # remembered, so besides the candidates memory grows with the number
+    # of distinct trees, not with the size of the repository.
+    @staticmethod
+    @Tracer.traced("gc.mark")
+    def _mark(candidates: Set[bytes], key_len: int):
+        seen: Set[bytes] = set()
+
+        def walk_tree(root_hash: str):
+            stack = [root_hash]
+            while stack:
+                tree_hash = stack.pop()
+                raw_hash = bytes.fromhex(tree_hash)
+                if raw_hash in seen:
+                    continue
+                seen.add(raw_hash)
+                candidates.discard(raw_hash[:key_len])
+
+                entries = ObjectStore.read_tree(tree_hash)
+                if entries is None:
+                    raise ValueError(f"Cannot read tree {tree_hash}")
+                Tracer.count("trees marked")
+                for _, obj_type, obj_hash, _ in entries:
+                    if obj_type == "tree":
+                        stack.append(obj_hash)
+                    else:
+                        candidates.discard(bytes.fromhex(obj_hash)[:key_len])
+
+        index = Index()
+        for blob_hash in index.entries.values():
+            candidates.discard(bytes.fromhex(blob_hash)[:key_len])
+        for tree_hash, _ in index.cache_tree.values():
+            walk_tree(tree_hash)
+
+        graph = CommitGraph.load()
+        for current in GarbageCollector._branch_heads():
+            while current:
+                raw_hash = bytes.fromhex(current)
+                if raw_hash in seen:
+                    break
+                seen.add(raw_hash)
+                candidates.discard(raw_hash[:key_len])
+
+                commit = graph.lookup(current) if graph is not None else None
+                if commit is None:
+                    commit = Commit._parse_commit(current)
+                if not commit or not commit.get("tree"):
+                    raise ValueError(f"Cannot read commit {current}")
+                Tracer.count("commits marked")
+                walk_tree(commit["tree"])
+                current = commit.get("parent")
+
+    # Removes the objects outside packs that nothing references and that
+    # were last written more than expire seconds ago, along with temp
+    # files left behind by interrupted writes. Stale objects are taken
+    # PRUNE_BATCH at a time, each batch marked and swept before the next
+    # is read, so memory stays bounded however many there are; only a
+    # repository with more than that walks its history more than once.
+    # Raises ValueError when a ref, commit or tree cannot be read. Every
+    # batch walks the same objects, so that happens before anything is
+    # removed.
+    @staticmethod
+    @Tracer.traced("gc.prune")
+    def prune(expire: int) -> Dict[str, int]:
+        cutoff = time.time() - expire
+        backend = ObjectStore.backend()
+        stats = {"candidates": 0, "pruned": 0, "temp": 0}
+
+        stale = backend.stale(cutoff)
+        while True:
+            candidates = {bytes.fromhex(name) for name in islice(stale, PRUNE_BATCH)}
+            if not candidates:
+                break
+            stats["candidates"] += len(candidates)
+            GarbageCollector._mark(candidates, len(next(iter(candidates))))
+            if candidates:
+                with Tracer.span("gc.sweep"):
+                    backend.remove([raw_name.hex() for raw_name in candidates])
+                stats["pruned"] += len(candidates)
+
+        for name in os.listdir(OBJECTS_DIR):
+            tmp_path = os.path.join(OBJECTS_DIR, name)
+            if name.startswith(TEMP_PREFIX) and os.path.getmtime(tmp_path) < cutoff:
+                os.remove(tmp_path)
+                stats["temp"] += 1
+
+        logger.info(
+            "Pruned %s of %s stale objects and %s temp files",
+            stats["pruned"], stats["candidates"], stats["temp"],
+        )
+        return stats
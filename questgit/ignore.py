@@ -0,0 +1,293 @@
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+from utils.file_utils import FileHandler
+from utils.constants import IGNORE_FILE, EXCLUDE_FILE
+
+GLOB_CHARS = "*?[\\"
+SUFFIX_PATTERN = re.compile(r"\*(\.[^*?\[\\/]+)")
+
+
+# Translates one gitignore glob into a regex over "/" separated paths
+def _translate(pattern: str) -> str:
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == n:
+            out.append("/.*")
+            i += 3
+        elif c == "*":
+            # Other runs of asterisks act like a single one
+            while i < n and pattern[i] == "*":
+                i += 1
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 2 if pattern[i + 1:i + 2] in ("!", "]") else i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+                i += 1
+                continue
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+# Key that every name matched by a basename glob ends with: the extension
+# of its literal tail, or "" when there is none
+def _glob_extension(pattern: str) -> str:
+    tail_start = max(pattern.rfind(c) for c in GLOB_CHARS + "]") + 1
+    dot = pattern.rfind(".", tail_start)
+    return pattern[dot:] if dot != -1 else ""
+
+
+def _name_extension(name: str) -> str:
+    dot = name.rfind(".")
+    return name[dot:] if dot != -1 else ""
+
+
+# Key that every path matched by an anchored glob starts with: its first
+# component when that is literal, or ""
+def _glob_first_component(pattern: str) -> str:
+    first = pattern.split("/", 1)[0]
+    return "" if any(c in first for c in GLOB_CHARS) else first
+
+
+# The patterns of one ignore file, compiled for matching. The last pattern
+# that matches decides, as in gitignore, yet lookups stay flat as the file
+# grows: plain names and "*.ext" patterns are dictionary lookups, and the
+# remaining globs are bucketed by the extension (basename patterns) or
+# first directory (anchored patterns) they require. Each bucket is one
+# regex whose alternatives are in reverse order, so the first one to match
+# is the last pattern in the file.
+class IgnoreRules:
+
+    def __init__(self, lines: Iterable[str], base: str = ""):
+        # Directory holding the file, "/" separated, "" for the root
+        self.base = base
+        self.negated: List[bool] = []
+        # Each lookup is split in two: patterns for any path, and those
+        # ending in "/" that only apply to directories
+        self._names: Tuple[Dict[str, int], Dict[str, int]] = ({}, {})
+        self._suffixes: Tuple[Dict[str, int], Dict[str, int]] = ({}, {})
+        name_globs: Tuple[Dict[str, List[str]], Dict[str, List[str]]] = ({}, {})
+        path_globs: Tuple[Dict[str, List[str]], Dict[str, List[str]]] = ({}, {})
+
+        for line in lines:
+            parsed = IgnoreRules._parse(line)
+            if parsed is None:
+                continue
+
+            pattern, negated, dir_only, anchored = parsed
+            position = len(self.negated)
+            self.negated.append(negated)
+
+            group = f"(?P<p{position}>{_translate(pattern)})"
+            suffix = SUFFIX_PATTERN.fullmatch(pattern)
+            if anchored:
+                key = _glob_first_component(pattern)
+                path_globs[dir_only].setdefault(key, []).append(group)
+            elif not any(c in pattern for c in GLOB_CHARS):
+                self._names[dir_only][pattern] = position
+            elif suffix:
+                self._suffixes[dir_only][suffix.group(1)] = position
+            else:
+                key = _glob_extension(pattern)
+                name_globs[dir_only].setdefault(key, []).append(group)
+
+        self._name_globs = tuple(IgnoreRules._compile(b) for b in name_globs)
+        self._path_globs = tuple(IgnoreRules._compile(b) for b in path_globs)
+
+    @staticmethod
+    def _compile(buckets: Dict[str, List[str]]) -> Dict[str, Pattern]:
+        return {
+            key: re.compile("|".join(reversed(groups)))
+            for key, groups in buckets.items()
+        }
+
+    @staticmethod
+    def _best(regex: Optional[Pattern], value: str, best: int) -> int:
+        if regex is None:
+            return best
+        found = regex.fullmatch(value)
+        if found is None:
+            return best
+        return max(best, int(found.lastgroup[1:]))
+
+    # (pattern, negated, directories only, anchored) or None for blank
+    # lines and comments
+    @staticmethod
+    def _parse(line: str) -> Optional[Tuple[str, bool, bool, bool]]:
+        line = line.rstrip("\r\n")
+        if not line or line.startswith("#"):
+            return None
+        # Trailing spaces are dropped unless escaped
+        while line.endswith(" ") and not line.endswith("\\ "):
+            line = line[:-1]
+
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A slash anywhere but at the end ties the pattern to this directory
+        anchored = "/" in line
+        line = line.lstrip("/")
+        if not line:
+            return None
+        return line, negated, dir_only, anchored
+
+    @staticmethod
+    def load(filepath: str, base: str = "") -> Optional["IgnoreRules"]:
+        content = FileHandler.read_binary(filepath)
+        if content is None:
+            return None
+        rules = IgnoreRules(content.decode("utf-8", errors="replace").splitlines(), base)
+        return rules if rules.negated else None
+
+    # True if ignored, False if re-included by a negated pattern, None if
+    # no pattern matches
+    def match(self, path: str, is_dir: bool) -> Optional[bool]:
+        if self.base:
+            if not path.startswith(self.base + "/"):
+                return None
+            path = path[len(self.base) + 1:]
+        name = path.rsplit("/", 1)[-1]
+        extension = _name_extension(name)
+        first = path.split("/", 1)[0]
+
+        best = -1
+        for dir_only in (False, True) if is_dir else (False,):
+            position = self._names[dir_only].get(name, -1)
+            if position > best:
+                best = position
+
+            suffixes = self._suffixes[dir_only]
+            if suffixes:
+                dot = name.find(".")
+                while dot != -1:
+                    position = suffixes.get(name[dot:], -1)
+                    if position > best:
+                        best = position
+                    dot = name.find(".", dot + 1)
+
+            name_globs = self._name_globs[dir_only]
+            if name_globs:
+                best = IgnoreRules._best(name_globs.get(extension), name, best)
+                if extension:
+                    best = IgnoreRules._best(name_globs.get(""), name, best)
+
+            path_globs = self._path_globs[dir_only]
+            if path_globs:
+                best = IgnoreRules._best(path_globs.get(first), path, best)
+                if first:
+                    best = IgnoreRules._best(path_globs.get(""), path, best)
+
+        if best < 0:
+            return None
+        return not self.negated[best]
+
+
+# The ignore files in effect for one directory, from .questgit/info/exclude
+# up to the directory's own .questgitignore. Deeper files take precedence.
+# Matchers are immutable, so walker threads can share them.
+class IgnoreMatcher:
+
+    def __init__(self, rules: List[IgnoreRules]):
+        self.rules = rules
+
+    @staticmethod
+    def _to_posix(path: str) -> str:
+        return path.replace(os.sep, "/") if os.sep != "/" else path
+
+    @staticmethod
+    def root() -> "IgnoreMatcher":
+        rules = []
+        if os.path.isfile(EXCLUDE_FILE):
+            exclude = IgnoreRules.load(EXCLUDE_FILE)
+            if exclude is not None:
+                rules.append(exclude)
+        return IgnoreMatcher(rules)
+
+    # Adds the ignore file of directory, if it has one
+    def enter(self, directory: str) -> "IgnoreMatcher":
+        filepath = os.path.join(directory, IGNORE_FILE) if directory else IGNORE_FILE
+        if not os.path.isfile(filepath):
+            return self
+        rules = IgnoreRules.load(filepath, IgnoreMatcher._to_posix(directory))
+        if rules is None:
+            return self
+        return IgnoreMatcher(self.rules + [rules])
+
+    # Matcher with every ignore file in the directories above path
+    @staticmethod
+    def for_parent(path: str) -> "IgnoreMatcher":
+        matcher = IgnoreMatcher.root()
+        if not path:
+            return matcher
+
+        matcher = matcher.enter("")
+        directory = ""
+        for part in os.path.normpath(path).split(os.sep)[:-1]:
+            directory = os.path.join(directory, part) if directory else part
+            matcher = matcher.enter(directory)
+        return matcher
+
+    def is_ignored(self, path: str, is_dir: bool) -> bool:
+        path = IgnoreMatcher._to_posix(path)
+        for rules in reversed(self.rules):
+            decision = rules.match(path, is_dir)
+            if decision is not None:
+                return decision
+        return False
+
+
+# Ignore decisions for arbitrary paths, remembering per directory whether
+# it is ignored and which matcher applies inside it
+class IgnoreCache:
+
+    def __init__(self, ignore_dirs: Iterable[str]):
+        self.ignore_dirs = set(ignore_dirs)
+        self._dirs: Dict[str, Tuple[bool, IgnoreMatcher]] = {
+            "": (False, IgnoreMatcher.root().enter(""))
+        }
+
+    def _directory(self, directory: str) -> Tuple[bool, IgnoreMatcher]:
+        found = self._dirs.get(directory)
+        if found is not None:
+            return found
+
+        parent_ignored, matcher = self._directory(os.path.dirname(directory))
+        ignored = (
+            parent_ignored
+            or os.path.basename(directory) in self.ignore_dirs
+            or matcher.is_ignored(directory, True)
+        )
+        found = (ignored, matcher if ignored else matcher.enter(directory))
+        self._dirs[directory] = found
+        return found
+
+    # Whether path, or any directory above it, is ignored
+    def is_ignored(self, path: str, is_dir: bool) -> bool:
+        path = os.path.normpath(path)
+        if is_dir:
+            return self._directory(path)[0]
+        ignored, matcher = self._directory(os.path.dirname(path))
+        return ignored or matcher.is_ignored(path, False)
@@ -1,65 +1,482 @@
+import bisect
+import hashlib
+import mmap
 import os
+import struct
 import zlib
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 from utils.logger_utils import LoggerUtil
-from utils.file_utils import FileHandler
+from utils.trace_utils import Tracer
+from utils.hash_utils import HashCalculate
 from utils.constants import INDEX_FILE
 from questgit.objects import ObjectStore
+from questgit.fsmonitor import FSMonitorState
+from questgit.refs import RefLock
 
 logger = LoggerUtil.setup_logger(__name__)
 
+# Index v1 was a zlib compressed text file; it is still read and upgraded
+TEXT_INDEX_SIGNATURE = "questgit-index 1"
+
+# Index v2 layout:
+#   header      signature, version, entry count
+#   offsets     one uint32 per entry, pointing at its record
+#   records     sorted by path: stat data, raw hash, flags, path length, path
+#   extensions  optional: signature, uint32 length, data
+#   trailer     SHA-1 of everything above
+INDEX_SIGNATURE = b"QIDX"
+INDEX_VERSION = 2
+HEADER = struct.Struct(">4sII")
+OFFSET = struct.Struct(">I")
+RECORD = struct.Struct(">qqQQI20sHH")
+RECORD_PATH_LEN_POS = 58
+CHECKSUM_LEN = 20
+EXTENSION = struct.Struct(">4sI")
+
+# Cached tree extension: for each directory whose tree is still valid,
+# its path, a NUL, the number of index entries below it and its tree hash
+TREE_EXTENSION = b"TREE"
+TREE_RECORD = struct.Struct(">I20s")
+
+FLAG_STAT_VALID = 0x0001
+
+# (mtime_ns, ctime_ns, size, inode, mode)
+StatData = Tuple[int, int, int, int, int]
+EMPTY_STAT: StatData = (0, 0, 0, 0, 0)
+
 
 class Index:
     def __init__(self):
-        self.entries: Dict[str, str] = {}  # filepath, hash
+        self._entries: Optional[Dict[str, str]] = {}  # filepath, hash
+        self._stat_cache: Optional[Dict[str, StatData]] = {}  # filepath, stat data
+        self._map: Optional[mmap.mmap] = None
+        self._count = 0
+        # directory path ("" for the root) -> (tree hash, entries below it)
+        self.cache_tree: Dict[str, Tuple[str, int]] = {}
+        self.timestamp_ns = 0  # mtime of the index file when it was loaded
+        # (inode, mtime_ns, size) of the index file as loaded or last saved
+        self.file_stamp: Optional[Tuple[int, int, int]] = None
+        # Paths whose entry changed since loading; None after clear()
+        self.touched: Optional[Set[str]] = set()
+        # Set while a work tree scan keeps the fsmonitor state itself
+        self.fsmonitor_managed = False
+        self.dirty = False
+        self.skipped = 0  # files trusted from the stat cache
+        self.rehashed = 0  # files that had to be read and hashed
         self.load()
 
+    # Entries are parsed from the mapped file only when first needed
+    @property
+    def entries(self) -> Dict[str, str]:
+        self._materialize()
+        return self._entries
+
+    @entries.setter
+    def entries(self, value: Dict[str, str]):
+        self._close_map()
+        self._entries = value
+        if self._stat_cache is None:
+            self._stat_cache = {}
+
+    @property
+    def stat_cache(self) -> Dict[str, StatData]:
+        self._materialize()
+        return self._stat_cache
+
+    @Tracer.traced("index.load")
     def load(self):
-        self.entries = {}
+        self._close_map()
+        self._entries = {}
+        self._stat_cache = {}
+        self.cache_tree = {}
+        self.timestamp_ns = 0
+        self.file_stamp = None
+        self.touched = set()
+        self.dirty = False
 
         if not os.path.exists(INDEX_FILE):
             return
 
-        compressed_content = FileHandler.read_binary(INDEX_FILE)
-        if not compressed_content:
+        st = os.stat(INDEX_FILE)
+        self.file_stamp = Index.file_stamp_of(st)
+        if st.st_size == 0:
             return
+        self.timestamp_ns = st.st_mtime_ns
+
+        with open(INDEX_FILE, "rb") as f:
+            signature = f.read(len(INDEX_SIGNATURE))
+            if signature != INDEX_SIGNATURE:
+                f.seek(0)
+                self._load_text(f.read())
+                return
+            index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if not self._verify(index_map):
+            index_map.close()
+            return
+
+        self._map = index_map
+        self._count = HEADER.unpack_from(index_map, 0)[2]
+        self._entries = None
+        self._stat_cache = None
+        self._load_extensions()
+
+    def _load_extensions(self):
+        if self._count:
+            last = self._record_offset(self._count - 1)
+            pos = last + RECORD.size + len(self._record_path(last))
+        else:
+            pos = HEADER.size
+        body_len = len(self._map) - CHECKSUM_LEN
+
+        while pos + EXTENSION.size <= body_len:
+            signature, length = EXTENSION.unpack_from(self._map, pos)
+            pos += EXTENSION.size
+            data = self._map[pos:pos + length]
+            pos += length
+            if signature == TREE_EXTENSION:
+                self._parse_tree_extension(data)
+
+    def _parse_tree_extension(self, data: bytes):
+        pos = 0
+        while pos < len(data):
+            nul = data.index(b"\0", pos)
+            dir_path = data[pos:nul].decode("utf-8")
+            count, raw_hash = TREE_RECORD.unpack_from(data, nul + 1)
+            self.cache_tree[dir_path] = (raw_hash.hex(), count)
+            pos = nul + 1 + TREE_RECORD.size
+
+    def _verify(self, index_map: mmap.mmap) -> bool:
+        if len(index_map) < HEADER.size + CHECKSUM_LEN:
+            logger.error("Index file corruption: truncated file")
+            return False
 
+        _, version, count = HEADER.unpack_from(index_map, 0)
+        if version != INDEX_VERSION:
+            logger.error("Unsupported index version: %s", version)
+            return False
+
+        body_len = len(index_map) - CHECKSUM_LEN
+        with memoryview(index_map) as view:
+            checksum = hashlib.sha1(view[:body_len]).digest()
+        if checksum != index_map[body_len:]:
+            logger.error("Index file corruption: checksum mismatch")
+            return False
+
+        if HEADER.size + count * OFFSET.size > body_len:
+            logger.error("Index file corruption: bad entry count")
+            return False
+        return True
+
+    def _load_text(self, compressed_content: bytes):
         try:
             data = zlib.decompress(compressed_content).decode("utf-8")
-            for line in data.splitlines():
+        except zlib.error as e:
+            logger.error("Index file corruption: %s", e)
+            return
+
+        lines = data.splitlines()
+        if lines and lines[0] == TEXT_INDEX_SIGNATURE:
+            for line in lines[1:]:
+                parts = line.split(" ", 6)
+                if len(parts) == 7:
+                    hash_val, *stat_fields, file_path = parts
+                    self._entries[file_path] = hash_val
+                    stat_data = tuple(int(f) for f in stat_fields)
+                    if stat_data != EMPTY_STAT:
+                        self._stat_cache[file_path] = stat_data
+        else:
+            # Oldest format, without stat data
+            for line in lines:
                 if line.strip():
                     parts = line.split(" ", 1)
                     if len(parts) == 2:
                         hash_val, file_path = parts
-                        self.entries[file_path] = hash_val
-        except zlib.error as e:
-            logger.error(f"Index file corruption: {e}")
-            self.entries = {}
+                        self._entries[file_path] = hash_val
+
+        # Rewritten in the binary format on the next save
+        self.dirty = True
+        logger.info("Upgrading text index to binary format")
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._count = 0
+
+    def _record_offset(self, position: int) -> int:
+        return OFFSET.unpack_from(self._map, HEADER.size + position * OFFSET.size)[0]
+
+    def _record_path(self, offset: int) -> bytes:
+        path_len = struct.unpack_from(">H", self._map, offset + RECORD_PATH_LEN_POS)[0]
+        start = offset + RECORD.size
+        return self._map[start:start + path_len]
+
+    def _parse_record(self, offset: int) -> Tuple[str, str, Optional[StatData]]:
+        mtime, ctime, size, ino, mode, raw_hash, flags, path_len = (
+            RECORD.unpack_from(self._map, offset)
+        )
+        start = offset + RECORD.size
+        file_path = self._map[start:start + path_len].decode("utf-8")
+        stat_data = (mtime, ctime, size, ino, mode) if flags & FLAG_STAT_VALID else None
+        return file_path, raw_hash.hex(), stat_data
+
+    @Tracer.traced("index.materialize")
+    def _materialize(self):
+        if self._entries is not None:
+            return
+
+        entries: Dict[str, str] = {}
+        stat_cache: Dict[str, StatData] = {}
+        # Records are contiguous, so walk them in order instead of through
+        # the offset table
+        data = self._map[:]
+        offset = HEADER.size + self._count * OFFSET.size
+        unpack_from = RECORD.unpack_from
+        for _ in range(self._count):
+            mtime, ctime, size, ino, mode, raw_hash, flags, path_len = unpack_from(
+                data, offset
+            )
+            start = offset + RECORD.size
+            offset = start + path_len
+            file_path = data[start:offset].decode("utf-8")
+            entries[file_path] = raw_hash.hex()
+            if flags & FLAG_STAT_VALID:
+                stat_cache[file_path] = (mtime, ctime, size, ino, mode)
+
+        self._close_map()
+        self._entries = entries
+        self._stat_cache = stat_cache
 
+    # Binary search over the sorted records of the mapped file
+    def _lookup(self, filepath: str) -> Optional[Tuple[str, Optional[StatData]]]:
+        key = filepath.encode("utf-8")
+        positions = range(self._count)
+        position = bisect.bisect_left(
+            positions, key, key=lambda p: self._record_path(self._record_offset(p))
+        )
+        if position == self._count:
+            return None
+
+        offset = self._record_offset(position)
+        if self._record_path(offset) != key:
+            return None
+        _, hash_val, stat_data = self._parse_record(offset)
+        return hash_val, stat_data
+
+    @Tracer.traced("index.save")
     def save(self):
-        data = "\n".join(
-            f"{hash_val} {file_path}" for file_path, hash_val in self.entries.items()
+        records: List[bytes] = []
+        for file_path in sorted(self.entries, key=lambda p: p.encode("utf-8")):
+            path_bytes = file_path.encode("utf-8")
+            stat_data = self._stat_cache.get(file_path)
+            flags = FLAG_STAT_VALID if stat_data is not None else 0
+            records.append(
+                RECORD.pack(
+                    *(stat_data or EMPTY_STAT),
+                    bytes.fromhex(self._entries[file_path]),
+                    flags,
+                    len(path_bytes),
+                )
+                + path_bytes
+            )
+
+        offsets = []
+        offset = HEADER.size + len(records) * OFFSET.size
+        for record in records:
+            offsets.append(OFFSET.pack(offset))
+            offset += len(record)
+
+        tree_data = b"".join(
+            dir_path.encode("utf-8")
+            + b"\0"
+            + TREE_RECORD.pack(count, bytes.fromhex(tree_hash))
+            for dir_path, (tree_hash, count) in sorted(self.cache_tree.items())
         )
+        extensions = []
+        if tree_data:
+            extensions = [EXTENSION.pack(TREE_EXTENSION, len(tree_data)), tree_data]
 
-        compressed_content = zlib.compress(data.encode("utf-8"))
-        FileHandler.write_binary(INDEX_FILE, compressed_content)
+        body = b"".join(
+            [HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(records))]
+            + offsets
+            + records
+            + extensions
+        )
+
+        # Replace atomically so readers never map a half written index
+        with RefLock(INDEX_FILE) as lock:
+            lock.commit(body + hashlib.sha1(body).digest())
+        self.dirty = False
+
+        previous_stamp = self.file_stamp
+        self.file_stamp = Index.file_stamp_of(os.stat(INDEX_FILE))
+        if not self.fsmonitor_managed:
+            FSMonitorState.index_saved(previous_stamp, self.file_stamp, self.touched)
+        self.touched = set()
         logger.info("Index save successfully")
 
-    def add_entry(self, filepath: str, hash_val: str):
+    @staticmethod
+    def file_stamp_of(st: os.stat_result) -> Tuple[int, int, int]:
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _touch(self, filepath: str):
+        if self.touched is not None:
+            self.touched.add(filepath)
+
+    # mode is the tree mode to keep for an entry taken from a commit
+    # rather than from a file; its stat data then never matches a file,
+    # so the file is hashed again when next checked
+    def add_entry(
+        self, filepath: str, hash_val: str, st: os.stat_result = None, mode: str = None
+    ):
         self.entries[filepath] = hash_val
+        self._touch(filepath)
+        if st is not None:
+            self._stat_cache[filepath] = Index.stat_data(st)
+        elif mode is not None:
+            self._stat_cache[filepath] = (0, 0, 0, 0, int(mode, 8))
+        else:
+            self._stat_cache.pop(filepath, None)
+        self.invalidate_tree(filepath)
+        self.dirty = True
 
     def get_entry(self, filepath: str) -> Optional[str]:
-        return self.entries.get(filepath)
+        return self._find(filepath)[0]
 
     def clear(self):
         self.entries = {}
+        self._stat_cache = {}
+        self.cache_tree = {}
+        self.touched = None
+        self.dirty = True
 
     def remove_entry(self, filepath: str):
         if filepath in self.entries:
-            del self.entries[filepath]
+            del self._entries[filepath]
+            self._stat_cache.pop(filepath, None)
+            self._touch(filepath)
+            self.invalidate_tree(filepath)
+            self.dirty = True
+
+    # Cached trees: only the directories on the path of a changed entry
+    # lose their tree hash, every other subtree can be reused as is
+    def invalidate_tree(self, filepath: str):
+        dir_path = os.path.dirname(filepath)
+        while True:
+            self.cache_tree.pop(dir_path, None)
+            if not dir_path:
+                break
+            dir_path = os.path.dirname(dir_path)
+
+    def get_cached_tree(self, dir_path: str) -> Optional[Tuple[str, int]]:
+        return self.cache_tree.get(dir_path)
+
+    def set_cached_tree(self, dir_path: str, tree_hash: str, count: int):
+        if self.cache_tree.get(dir_path) != (tree_hash, count):
+            self.cache_tree[dir_path] = (tree_hash, count)
+            self.dirty = True
+
+    # Tracked paths inside dir_path, found by binary search over the
+    # mapped records when the entries haven't been parsed
+    def paths_under(self, dir_path: str) -> List[str]:
+        prefix = dir_path + os.sep
+        if self._entries is not None:
+            return sorted(path for path in self._entries if path.startswith(prefix))
+
+        def path_at(position: int) -> bytes:
+            return self._record_path(self._record_offset(position))
+
+        positions = range(self._count)
+        lo = bisect.bisect_left(positions, prefix.encode("utf-8"), key=path_at)
+        end_key = (dir_path + chr(ord(os.sep) + 1)).encode("utf-8")
+        hi = bisect.bisect_left(positions, end_key, lo=lo, key=path_at)
+        return [path_at(position).decode("utf-8") for position in range(lo, hi)]
+
+    def entry_count(self) -> int:
+        return len(self._entries) if self._entries is not None else self._count
+
+    # Paths in the order trees are built: by code point, which matches the
+    # byte order of the saved records, so each directory stays contiguous
+    def sorted_paths(self) -> List[str]:
+        return sorted(self.entries)
+
+    def file_mode(self, filepath: str) -> str:
+        stat_data = self._find(filepath)[1]
+        if stat_data is not None and stat_data[4] & 0o111:
+            return "100755"
+        return "100644"
 
     def get_file_contents(self, filepath: str) -> Optional[str]:
         blob_hash = self.get_entry(filepath)
 
         return ObjectStore.read_blob(blob_hash) if blob_hash else None
+
+    # Stat cache
+    @staticmethod
+    def stat_data(st: os.stat_result) -> StatData:
+        return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode)
+
+    def is_racy(self, stat_data: StatData) -> bool:
+        # A file modified in the same tick the index was written may have
+        # changed after its stat was recorded, so its stat data is not proof
+        # that the content is unchanged.
+        return stat_data[0] >= self.timestamp_ns
+
+    # Hash and stat data of an entry, without parsing the whole index
+    def _find(self, filepath: str) -> Tuple[Optional[str], Optional[StatData]]:
+        if self._entries is not None:
+            return self._entries.get(filepath), self._stat_cache.get(filepath)
+
+        return self._lookup(filepath) or (None, None)
+
+    def _stat_is_clean(self, cached: Optional[StatData], st: os.stat_result) -> bool:
+        if cached is None or cached != Index.stat_data(st):
+            return False
+        return not self.is_racy(cached)
+
+    def stat_matches(self, filepath: str, st: os.stat_result) -> bool:
+        return self._stat_is_clean(self._find(filepath)[1], st)
+
+    def update_stat(self, filepath: str, st: os.stat_result):
+        # Also rewrites racily clean entries, so the next index timestamp
+        # is newer than the file and the entry can be trusted again
+        previous = self.stat_cache.get(filepath)
+        self.stat_cache[filepath] = Index.stat_data(st)
+        if previous is None or (previous[4] ^ st.st_mode) & 0o111:
+            # Tree entries carry the executable bit
+            self.invalidate_tree(filepath)
+        self.dirty = True
+
+    # Blob hash of a working tree file, trusting the stat cache when the
+    # file looks untouched since it was staged
+    def hash_file(self, filepath: str, st: os.stat_result = None) -> Optional[str]:
+        if st is None:
+            try:
+                st = os.lstat(filepath)
+            except OSError:
+                return None
+
+        cached_hash, cached_stat = self._find(filepath)
+        if cached_hash and self._stat_is_clean(cached_stat, st):
+            self.skipped += 1
+            return cached_hash
+
+        try:
+            current_hash = HashCalculate.calculate_file_sha1(filepath)
+        except OSError as e:
+            logger.error("Error reading file %s: %s", filepath, e)
+            return None
+        self.rehashed += 1
+
+        # Refresh stat data so the next run can skip this file
+        if current_hash == cached_hash:
+            self.update_stat(filepath, st)
+        return current_hash
+
+    def stat_report(self) -> str:
+        return (
+            f"{self.skipped} file(s) unchanged by stat, "
+            f"{self.rehashed} file(s) rehashed"
+        )
@@ -1,102 +1,414 @@
+import hashlib
+import re
+import string
+import tempfile
 import zlib
 import os
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, BinaryIO, Iterable, Iterator, Tuple
 
 from utils.logger_utils import LoggerUtil
 from utils.file_utils import FileHandler
 from utils.hash_utils import HashCalculate
-from utils.constants import OBJECTS_DIR, BLOB_DIR_LEN, BLOB_HASH_LEN
+from utils.compress_utils import CompressUtil
+from utils.trace_utils import Tracer
+from utils.constants import (
+    OBJECTS_DIR,
+    BLOB_HASH_LEN,
+    STREAM_CHUNK_SIZE,
+)
+
+from .pack import PackStore
+from .cache import ObjectCache
+from .config import Config
+from .backends import BACKEND_CONFIG_KEY, DEFAULT_BACKEND, ObjectBackends
 
 logger = LoggerUtil.setup_logger(__name__)
 
+# "tree <size>" runs straight into the first entry's six digit mode
+TREE_HEADER = re.compile(rb"tree (\d+)\d{6} (?:blob|tree) [0-9a-f]{40}")
+COMMIT_HEADER = re.compile(rb"commit \d+\0")
+# Objects are written to temp files with this prefix in OBJECTS_DIR first
+TEMP_PREFIX = "tmp_obj_"
+
+# Shortest prefix accepted as an object name, and the length log --abbrev
+# starts from
+MIN_ABBREV = 4
+DEFAULT_ABBREV = 7
+
 
 class ObjectStore:
 
+    # Backend holding objects outside packs, chosen by core.objectstore
+    _backend = None
+
+    objects_written = 0
+    objects_deduplicated = 0
+
     @staticmethod
-    def store_blob(filepath: str) -> str:
-        content = FileHandler.read(filepath)
-        if content is None:
+    def backend():
+        if ObjectStore._backend is None:
+            name = Config.get(BACKEND_CONFIG_KEY, DEFAULT_BACKEND)
+            try:
+                ObjectStore._backend = ObjectBackends.create(name)
+            except ValueError as e:
+                logger.error("%s, using %s", e, DEFAULT_BACKEND)
+                ObjectStore._backend = ObjectBackends.create(DEFAULT_BACKEND)
+        return ObjectStore._backend
+
+    # Groups the writes made inside it into one transaction, for backends
+    # that have them
+    @staticmethod
+    def batch():
+        return ObjectStore.backend().batch()
+
+    # Moves every object outside packs to the named backend and makes it
+    # the repository's. The config is switched before the old copies are
+    # removed, so every object stays reachable. Returns the number moved.
+    @staticmethod
+    @Tracer.traced("objects.migrate")
+    def migrate(name: str) -> int:
+        source = ObjectStore.backend()
+        target = ObjectBackends.create(name)
+        copied = ObjectBackends.copy(source, target)
+        Config.set(BACKEND_CONFIG_KEY, name)
+        source.remove(copied)
+        source.discard()
+        ObjectStore._backend = target
+        logger.info("Moved %s objects from %s to %s", len(copied), source.name, name)
+        return len(copied)
+
+    @staticmethod
+    def write_temp(chunks: Iterable[bytes]) -> str:
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=OBJECTS_DIR)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                for chunk in chunks:
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    # Hands a fully written temp file of compressed content to the
+    # backend. Returns False when the object was already stored.
+    @staticmethod
+    def _install_temp(tmp_path: str, obj_hash: str, size: int) -> bool:
+        if PackStore.contains(obj_hash):
+            os.remove(tmp_path)
+            installed = False
+        else:
+            installed = ObjectStore.backend().install(tmp_path, obj_hash, size)
+        ObjectStore._count_write(installed)
+        return installed
+
+    @staticmethod
+    def _count_write(written: bool):
+        if written:
+            ObjectStore.objects_written += 1
+            LoggerUtil.count("objects written")
+        else:
+            ObjectStore.objects_deduplicated += 1
+            LoggerUtil.count("objects deduplicated")
+
+    # Stores uncompressed object content under obj_hash, unless it exists
+    @staticmethod
+    def write_object(obj_hash: str, content: bytes) -> bool:
+        if ObjectStore.blob_exists(obj_hash):
+            ObjectStore.backend().freshen(obj_hash)
+            ObjectStore._count_write(False)
+            return False
+
+        Tracer.count("bytes deflated", len(content))
+        written = ObjectStore.backend().write(obj_hash, zlib.compress(content), len(content))
+        ObjectStore._count_write(written)
+        return written
+
+    @staticmethod
+    def write_stats() -> Dict[str, int]:
+        return {
+            "written": ObjectStore.objects_written,
+            "deduplicated": ObjectStore.objects_deduplicated,
+        }
+
+    # Large files are hashed and compressed in streaming passes, so memory
+    # use does not depend on the file size and binary files are stored
+    # as-is. Pass blob_hash when it is already known to skip hashing.
+    @staticmethod
+    def store_blob(filepath: str, blob_hash: Optional[str] = None) -> str:
+        if not os.path.isfile(filepath):
             raise ValueError(f"Could not read file: {filepath}")
 
-        blob_hash = HashCalculate.calculate_sha1(content)
-        compressed_content = zlib.compress(content.encode("utf-8"))
+        if os.path.getsize(filepath) <= STREAM_CHUNK_SIZE:
+            content = FileHandler.read_binary(filepath)
+            if content is None:
+                raise ValueError(f"Could not read file: {filepath}")
+
+            blob_hash = HashCalculate.calculate_sha1_bytes(content)
+            ObjectStore.write_object(blob_hash, content)
+            logger.debug("Stored blob %s for %s", blob_hash, filepath)
+            return blob_hash
+
+        # Hashing is much cheaper than deflating, so find out first whether
+        # the object is already stored
+        if blob_hash is None:
+            blob_hash = HashCalculate.calculate_file_sha1(filepath)
+        if ObjectStore.blob_exists(blob_hash):
+            ObjectStore.backend().freshen(blob_hash)
+            ObjectStore._count_write(False)
+            return blob_hash
+
+        sha1 = hashlib.sha1()
+        compressor = zlib.compressobj()
+        size = 0
+
+        def compressed_chunks() -> Iterator[bytes]:
+            nonlocal size
+            for chunk in FileHandler.iter_chunks(filepath):
+                sha1.update(chunk)
+                size += len(chunk)
+                Tracer.count("bytes deflated", len(chunk))
+                yield compressor.compress(chunk)
+            yield compressor.flush()
 
-        obj_dir = os.path.join(OBJECTS_DIR, blob_hash[:BLOB_DIR_LEN])
-        obj_path = os.path.join(obj_dir, blob_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
+        tmp_path = ObjectStore.write_temp(compressed_chunks())
 
-        FileHandler.ensure_directory_exists(obj_dir)
-        FileHandler.write_binary(obj_path, compressed_content)
+        # The file may have changed since it was hashed; store what was read
+        blob_hash = sha1.hexdigest()
+        ObjectStore._install_temp(tmp_path, blob_hash, size)
 
-        logger.info(f"Stored blob {blob_hash} for {filepath}")
+        logger.debug("Stored blob %s for %s", blob_hash, filepath)
         return blob_hash
 
     @staticmethod
-    def read_blob(blob_hash: str) -> Optional[str]:
-        obj_dir = os.path.join(OBJECTS_DIR, blob_hash[:BLOB_DIR_LEN])
-        obj_path = os.path.join(obj_dir, blob_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
+    def iter_blob(blob_hash: str) -> Iterator[bytes]:
+        Tracer.count("objects read")
+        chunks = ObjectStore.backend().iter_compressed(blob_hash)
+        if chunks is None:
+            pack = PackStore.find(blob_hash)
+            if pack is None:
+                raise FileNotFoundError(f"Blob object not found: {blob_hash}")
+            yield from pack.iter_object(blob_hash)
+            return
 
-        compressed_content = FileHandler.read_binary(obj_path)
-        if compressed_content is None:
-            logger.error(f"Blob object not found: {blob_hash}")
-            return None
+        yield from CompressUtil.inflate_chunks(chunks)
 
+    @staticmethod
+    def stream_blob(blob_hash: str, out: BinaryIO) -> bool:
         try:
-            return zlib.decompress(compressed_content).decode("utf-8")
+            for chunk in ObjectStore.iter_blob(blob_hash):
+                out.write(chunk)
+            return True
+        except FileNotFoundError as e:
+            logger.error(str(e))
         except zlib.error as e:
-            logger.error(f"Decompossing error for blob {blob_hash}: {e}")
+            logger.error("Decompossing error for blob %s: %s", blob_hash, e)
+        return False
+
+    @staticmethod
+    def read_blob_bytes(blob_hash: str) -> Optional[bytes]:
+        content = ObjectCache.get("raw", blob_hash)
+        if content is not None:
+            return content
+
+        Tracer.count("objects read")
+        try:
+            compressed_content = ObjectStore.backend().read_compressed(blob_hash)
+            if compressed_content is None:
+                content = PackStore.read(blob_hash)
+                if content is None:
+                    logger.error("Blob object not found: %s", blob_hash)
+                    return None
+            else:
+                content = zlib.decompress(compressed_content)
+                Tracer.count("bytes inflated", len(content))
+        except zlib.error as e:
+            logger.error("Decompossing error for blob %s: %s", blob_hash, e)
             return None
 
+        ObjectCache.put("raw", blob_hash, content, len(content))
+        return content
+
+    @staticmethod
+    def read_blob(blob_hash: str) -> Optional[str]:
+        content = ObjectStore.read_blob_bytes(blob_hash)
+        if content is None:
+            return None
+
+        try:
+            return content.decode("utf-8")
+        except UnicodeDecodeError as e:
+            logger.error("Blob %s is not UTF-8 text: %s", blob_hash, e)
+            return None
+
+    # Objects carry no type field: commits start with "commit <size>" and
+    # a NUL, trees with "tree <size>" followed directly by their entries,
+    # and anything else is a blob. Returns the type and the content after
+    # the header, without copying it.
+    @staticmethod
+    def read_object(obj_hash: str) -> Optional[Tuple[str, memoryview]]:
+        content = ObjectStore.read_blob_bytes(obj_hash)
+        if content is None:
+            return None
+
+        match = COMMIT_HEADER.match(content)
+        if match:
+            return "commit", memoryview(content)[match.end():]
+        match = TREE_HEADER.match(content)
+        if match:
+            return "tree", memoryview(content)[match.end(1):]
+        return "blob", memoryview(content)
+
+    # Only full hex hashes name objects, so a name can never point outside
+    # the object directory
+    @staticmethod
+    def is_full_hash(name: str) -> bool:
+        return len(name) == 40 and all(c in string.hexdigits for c in name)
+
+    # Where short names are looked up: the backend and every pack, each
+    # searched in O(log n) through its sorted names
+    @staticmethod
+    def _name_sources() -> list:
+        return [ObjectStore.backend(), *PackStore.packs()]
+
+    # Full hash of an object named by a unique prefix of at least
+    # MIN_ABBREV hex digits. A full hash is returned as it is; None when no
+    # object matches. Raises ValueError when the prefix is ambiguous.
+    @staticmethod
+    def resolve_name(name: str) -> Optional[str]:
+        name = name.lower()
+        if not MIN_ABBREV <= len(name) <= 40 or not all(c in string.hexdigits for c in name):
+            return None
+        if len(name) == 40:
+            return name
+
+        # The lowest name the prefix can match; loose names are shorter
+        # than a full hash, so only the digits both have are compared
+        key = bytes.fromhex(name + "0" * (len(name) % 2))
+        matches: Dict[str, str] = {}
+        for source in ObjectStore._name_sources():
+            for raw_name in source.names_from(key, 2):
+                found = raw_name.hex()
+                if found[:len(name)] != name[:len(found)]:
+                    break
+                if len(found) > len(matches.get(found[:BLOB_HASH_LEN], "")):
+                    matches[found[:BLOB_HASH_LEN]] = found
+        Tracer.count("names resolved")
+
+        backend = ObjectStore.backend()
+        found_hashes = sorted(
+            found if len(found) == 40 else backend.full_hash(found) or found
+            for found in matches.values()
+        )
+        if len(found_hashes) > 1:
+            raise ValueError(
+                f"Short object name {name} is ambiguous: {', '.join(found_hashes)}"
+            )
+        return found_hashes[0] if found_hashes else None
+
+    # Shortest prefix, at least min_len digits long, that names each of
+    # the hashes uniquely. That is one digit more than the longest prefix
+    # a hash shares with the names sorted next to it, so every backend and
+    # pack is searched once per hash rather than prefix by prefix.
+    @staticmethod
+    def abbreviate(hashes: Iterable[str], min_len: int = DEFAULT_ABBREV) -> Dict[str, str]:
+        sources = ObjectStore._name_sources()
+        abbreviations = {}
+        for obj_hash in sorted(set(hashes)):
+            raw_hash = bytes.fromhex(obj_hash)
+            length = max(min_len, MIN_ABBREV)
+            for source in sources:
+                for raw_name in [source.name_before(raw_hash), *source.names_from(raw_hash, 2)]:
+                    # The object itself, in full or as a loose name
+                    if raw_name is None or raw_hash[:len(raw_name)] == raw_name:
+                        continue
+                    common = len(os.path.commonprefix([obj_hash, raw_name.hex()]))
+                    length = max(length, common + 1)
+            abbreviations[obj_hash] = obj_hash[:length]
+        return abbreviations
+
+    # Drops the "<type> <size>" header written in front of commits and
+    # trees. Commits separate it with a NUL; trees are written without a
+    # separator, so the size that matches the remaining length is found.
+    @staticmethod
+    def strip_header(content: str, obj_type: str) -> str:
+        prefix = f"{obj_type} "
+        if not content.startswith(prefix):
+            return content
+
+        rest = content[len(prefix):]
+        nul = rest.find("\0")
+        if nul > 0 and rest[:nul].isdigit():
+            return rest[nul + 1:]
+
+        for digits in range(1, len(rest) + 1):
+            if not rest[digits - 1].isdigit():
+                break
+            if int(rest[:digits]) == len(rest) - digits:
+                return rest[digits:]
+        return rest
+
+    # Tree entries as (mode, type, hash, name)
+    @staticmethod
+    def read_tree(tree_hash: str) -> Optional[List[Tuple[str, str, str, str]]]:
+        entries = ObjectCache.get("tree", tree_hash)
+        if entries is not None:
+            return entries
+
+        content = ObjectStore.read_blob(tree_hash)
+        if content is None:
+            return None
+
+        entries = []
+        for line in ObjectStore.strip_header(content, "tree").split("\n"):
+            if not line.strip():
+                continue
+            mode, obj_type, rest = line.split(" ", 2)
+            entries.append((mode, obj_type, rest[:40], rest[40:].lstrip(" ")))
+
+        # Parsed entries take roughly twice the memory of the raw text
+        ObjectCache.put("tree", tree_hash, entries, 2 * len(content))
+        return entries
+
     @staticmethod
     def write_blob(content: str, obj_type: str = "blob") -> str:
         header = f"{obj_type} {len(content)}\0"
         full_content = header.encode() + content.encode()
-        # print("========full_content=========", full_content)
 
         # Calculate hash and store
         blob_hash = HashCalculate.calculate_sha1(full_content.decode("utf-8"))
-        obj_dir = os.path.join(OBJECTS_DIR, blob_hash[:BLOB_DIR_LEN])
-        obj_path = os.path.join(obj_dir, blob_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
-
-        FileHandler.ensure_directory_exists(obj_dir)
-        compressed = zlib.compress(full_content)
-        FileHandler.write_binary(obj_path, compressed)
-        # print("=====blob======",blob_hash)
+        ObjectStore.write_object(blob_hash, full_content)
 
         return blob_hash
 
     @staticmethod
     def store_tree(tree_content: str) -> str:
         header = f"tree {len(tree_content)}"
-        # print("=========Header======", header)
         full_content = header + tree_content
-        # print("======full===", full_content)
 
         # Calculate hash (needs to be on the encoded bytes)
         full_content_bytes = full_content.encode("utf-8")
-        # print("=======full_byte======", full_content_bytes)
-        # print("=======full======", type(full_content_bytes))
 
         tree_hash = HashCalculate.calculate_sha1(full_content_bytes.decode("utf-8"))
-        # print("=========tree_hash=====", tree_hash)
-
-        # Prepare storage path
-        obj_dir = os.path.join(OBJECTS_DIR, tree_hash[:BLOB_DIR_LEN])
-        obj_path = os.path.join(obj_dir, tree_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
 
         # Store compressed content
-        FileHandler.ensure_directory_exists(obj_dir)
-        # print("=============empty==================")
-        FileHandler.write_binary(obj_path, zlib.compress(full_content_bytes))
+        ObjectStore.write_object(tree_hash, full_content_bytes)
 
-        logger.info(f"Stored tree {tree_hash}")
-        # print(f"Stored tree {tree_hash}")
+        logger.debug("Stored tree %s", tree_hash)
         return tree_hash
 
+    # Also takes a unique short name
     @staticmethod
     def blob_exists(blob_hash: str) -> bool:
         if not blob_hash:
             return False
-        obj_dir = os.path.join(OBJECTS_DIR, blob_hash[:BLOB_DIR_LEN])
-        obj_path = os.path.join(obj_dir, blob_hash[BLOB_DIR_LEN:BLOB_HASH_LEN])
+        if len(blob_hash) < 40:
+            try:
+                blob_hash = ObjectStore.resolve_name(blob_hash)
+            except ValueError:
+                return False
+            if blob_hash is None:
+                return False
 
-        return os.path.exists(obj_path)
+        return ObjectStore.backend().contains(blob_hash) or PackStore.contains(blob_hash)
@@ -0,0 +1,400 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.file_utils import FileHandler
+from utils.compress_utils import CompressUtil
+from utils.trace_utils import Tracer
+from utils.constants import PACK_DIR, STREAM_CHUNK_SIZE
+from .delta import Delta, encode_varint, decode_varint
+
+logger = LoggerUtil.setup_logger(__name__)
+
+# Pack layout:
+#   header   signature, version, object count
+#   entries  type, inflated size (varint), compressed size (varint),
+#            base hash (delta entries only), zlib data
+#   trailer  SHA-1 of everything above
+PACK_SIGNATURE = b"QPCK"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct(">4sII")
+
+# Pack index layout:
+#   header   signature, version
+#   fanout   256 cumulative counts of hashes by first byte
+#   hashes   sorted raw hashes
+#   offsets  uint64 pack offset per hash
+#   trailer  pack checksum, SHA-1 of everything above
+IDX_SIGNATURE = b"QPIX"
+IDX_VERSION = 1
+IDX_HEADER = struct.Struct(">4sI")
+FANOUT = struct.Struct(">256I")
+OFFSET = struct.Struct(">Q")
+HASH_LEN = 20
+
+OBJ_FULL = 1
+OBJ_REF_DELTA = 2  # zlib data is a delta against the object named by base hash
+
+DEFAULT_DELTA_CACHE_SIZE = 32 * 1024 * 1024
+
+
+# Recently reconstructed objects, so walking a delta chain doesn't rebuild
+# the same bases over and over
+class DeltaBaseCache:
+
+    _entries: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+    _size = 0
+    # Objects may be read from several threads, e.g. by restore
+    _lock = threading.Lock()
+    max_size = DEFAULT_DELTA_CACHE_SIZE
+
+    @staticmethod
+    def get(key: Tuple[str, int]) -> Optional[bytes]:
+        with DeltaBaseCache._lock:
+            content = DeltaBaseCache._entries.get(key)
+            if content is not None:
+                DeltaBaseCache._entries.move_to_end(key)
+        Tracer.count("delta cache hits" if content is not None else "delta cache misses")
+        return content
+
+    @staticmethod
+    def put(key: Tuple[str, int], content: bytes):
+        if len(content) > DeltaBaseCache.max_size // 4:
+            return
+        with DeltaBaseCache._lock:
+            if key in DeltaBaseCache._entries:
+                DeltaBaseCache._entries.move_to_end(key)
+                return
+
+            DeltaBaseCache._entries[key] = content
+            DeltaBaseCache._size += len(content)
+            while DeltaBaseCache._size > DeltaBaseCache.max_size:
+                _, evicted = DeltaBaseCache._entries.popitem(last=False)
+                DeltaBaseCache._size -= len(evicted)
+
+    @staticmethod
+    def clear():
+        with DeltaBaseCache._lock:
+            DeltaBaseCache._entries.clear()
+            DeltaBaseCache._size = 0
+
+
+class Pack:
+    def __init__(self, idx_path: str):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[: -len(".idx")] + ".pack"
+
+        with open(idx_path, "rb") as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version = IDX_HEADER.unpack_from(self._idx, 0)
+        if signature != IDX_SIGNATURE or version != IDX_VERSION:
+            self.close()
+            raise ValueError(f"Not a pack index: {idx_path}")
+
+        self._fanout = FANOUT.unpack_from(self._idx, IDX_HEADER.size)
+        self.count = self._fanout[255]
+        self._hashes_pos = IDX_HEADER.size + FANOUT.size
+        self._offsets_pos = self._hashes_pos + self.count * HASH_LEN
+
+    def close(self):
+        self._idx.close()
+        self._pack.close()
+
+    def _hash_at(self, position: int) -> bytes:
+        start = self._hashes_pos + position * HASH_LEN
+        return self._idx[start:start + HASH_LEN]
+
+    # Fanout narrows the search to hashes sharing the first byte, then a
+    # binary search over the sorted hash table finds the entry
+    def _find(self, raw_hash: bytes) -> Optional[int]:
+        first = raw_hash[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        position = bisect.bisect_left(range(hi), raw_hash, lo=lo, key=self._hash_at)
+        if position < hi and self._hash_at(position) == raw_hash:
+            return position
+        return None
+
+    # Sorted hashes around raw_key, which may be a prefix: the first count
+    # at or after it, and the last one before it. Used for short names.
+    def _position(self, raw_key: bytes) -> int:
+        first = raw_key[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        return bisect.bisect_left(range(hi), raw_key, lo=lo, key=self._hash_at)
+
+    def names_from(self, raw_key: bytes, count: int) -> List[bytes]:
+        position = self._position(raw_key)
+        return [self._hash_at(i) for i in range(position, min(self.count, position + count))]
+
+    def name_before(self, raw_key: bytes) -> Optional[bytes]:
+        position = self._position(raw_key)
+        return self._hash_at(position - 1) if position else None
+
+    def offset_of(self, obj_hash: str) -> Optional[int]:
+        position = self._find(bytes.fromhex(obj_hash))
+        if position is None:
+            return None
+        return self._offset_at(position)
+
+    def contains(self, obj_hash: str) -> bool:
+        return self.offset_of(obj_hash) is not None
+
+    def iter_hashes(self) -> Iterator[str]:
+        for position in range(self.count):
+            yield self._hash_at(position).hex()
+
+    # Entry header at offset:
+    # (type, inflated size, data start, data end, raw base hash or None)
+    def _entry(self, offset: int) -> Tuple[int, int, int, int, Optional[bytes]]:
+        obj_type = self._pack[offset]
+        size, pos = decode_varint(self._pack, offset + 1)
+        compressed_size, pos = decode_varint(self._pack, pos)
+        base_hash = None
+        if obj_type == OBJ_REF_DELTA:
+            base_hash = self._pack[pos:pos + HASH_LEN]
+            pos += HASH_LEN
+        return obj_type, size, pos, pos + compressed_size, base_hash
+
+    def size_of(self, obj_hash: str) -> int:
+        return self._entry(self.offset_of(obj_hash))[1]
+
+    def is_delta(self, obj_hash: str) -> bool:
+        return self._entry(self.offset_of(obj_hash))[0] == OBJ_REF_DELTA
+
+    # Follows the delta chain down to a full object or a cached base, then
+    # applies the deltas back up, caching each step as a future base
+    def _read_at(self, offset: int) -> bytes:
+        chain = []
+        while True:
+            content = DeltaBaseCache.get((self.pack_path, offset))
+            if content is not None:
+                break
+
+            obj_type, size, start, end, base_hash = self._entry(offset)
+            data = zlib.decompress(self._pack[start:end])
+            Tracer.count("bytes inflated", len(data))
+            if obj_type == OBJ_FULL:
+                if len(data) != size:
+                    raise zlib.error(f"Size mismatch for packed object at {offset}")
+                content = data
+                if chain:
+                    DeltaBaseCache.put((self.pack_path, offset), content)
+                break
+
+            chain.append((offset, data))
+            position = self._find(base_hash)
+            if position is None:
+                raise ValueError(f"Delta base {base_hash.hex()} missing from pack")
+            offset = self._offset_at(position)
+
+        for delta_offset, delta in reversed(chain):
+            content = Delta.apply(content, delta)
+            DeltaBaseCache.put((self.pack_path, delta_offset), content)
+        return content
+
+    def _offset_at(self, position: int) -> int:
+        return OFFSET.unpack_from(self._idx, self._offsets_pos + position * 8)[0]
+
+    def read(self, obj_hash: str) -> Optional[bytes]:
+        offset = self.offset_of(obj_hash)
+        if offset is None:
+            return None
+        return self._read_at(offset)
+
+    def iter_object(self, obj_hash: str) -> Iterator[bytes]:
+        offset = self.offset_of(obj_hash)
+        if offset is None:
+            raise FileNotFoundError(f"Object not in pack: {obj_hash}")
+
+        obj_type, _, start, end, _ = self._entry(offset)
+        if obj_type == OBJ_REF_DELTA:
+            # Deltas are only made for objects small enough to rebuild whole
+            yield self._read_at(offset)
+            return
+        yield from CompressUtil.inflate_chunks(self._slices(start, end))
+
+    def _slices(self, start: int, end: int) -> Iterator[bytes]:
+        for pos in range(start, end, STREAM_CHUNK_SIZE):
+            yield self._pack[pos:min(pos + STREAM_CHUNK_SIZE, end)]
+
+    # Inflated size, compressed size and the raw zlib stream of a full
+    # entry, so repacking can copy it without inflating and deflating again
+    def compressed(self, obj_hash: str) -> Tuple[int, int, Iterator[bytes]]:
+        obj_type, size, start, end, _ = self._entry(self.offset_of(obj_hash))
+        if obj_type != OBJ_FULL:
+            raise ValueError(f"Packed object {obj_hash} is a delta")
+        return size, end - start, self._slices(start, end)
+
+
+class PackWriter:
+    def __init__(self):
+        FileHandler.ensure_directory_exists(PACK_DIR)
+        fd, self._tmp_path = tempfile.mkstemp(prefix="tmp_pack_", dir=PACK_DIR)
+        self._file = os.fdopen(fd, "wb")
+        self._offset = 0
+        self._offsets: Dict[bytes, int] = {}
+        # Object count is patched in once all entries are written
+        self._write(PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, 0))
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def __contains__(self, obj_hash: str) -> bool:
+        return bytes.fromhex(obj_hash) in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    # Adds one object whose zlib stream is copied from chunks
+    def add_compressed(
+        self, obj_hash: str, size: int, compressed_size: int, chunks: Iterator[bytes]
+    ):
+        offset = self._offset
+        self._write(
+            bytes([OBJ_FULL]) + encode_varint(size) + encode_varint(compressed_size)
+        )
+        written = 0
+        for chunk in chunks:
+            self._write(chunk)
+            written += len(chunk)
+        if written != compressed_size:
+            raise ValueError(f"Object {obj_hash} changed while packing")
+        self._offsets[bytes.fromhex(obj_hash)] = offset
+
+    def add_delta(self, obj_hash: str, size: int, base_hash: str, delta: bytes):
+        offset = self._offset
+        compressed = zlib.compress(delta)
+        self._write(
+            bytes([OBJ_REF_DELTA])
+            + encode_varint(size)
+            + encode_varint(len(compressed))
+            + bytes.fromhex(base_hash)
+        )
+        self._write(compressed)
+        self._offsets[bytes.fromhex(obj_hash)] = offset
+
+    def add_object(self, obj_hash: str, content: bytes):
+        compressed = zlib.compress(content)
+        self.add_compressed(obj_hash, len(content), len(compressed), iter([compressed]))
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    # Writes the trailer and index and moves both into place. Returns the
+    # path of the new pack index.
+    def finish(self) -> str:
+        self._file.close()
+
+        # Patch the object count, then checksum the whole pack
+        with open(self._tmp_path, "r+b") as f:
+            f.seek(0)
+            f.write(PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(self._offsets)))
+            f.seek(0)
+            sha1 = hashlib.sha1()
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+            pack_checksum = sha1.digest()
+            f.write(pack_checksum)
+            f.flush()
+            os.fsync(f.fileno())
+
+        hashes = sorted(self._offsets)
+        fanout = [0] * 256
+        for raw_hash in hashes:
+            fanout[raw_hash[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        idx = b"".join(
+            [IDX_HEADER.pack(IDX_SIGNATURE, IDX_VERSION), FANOUT.pack(*fanout)]
+            + hashes
+            + [OFFSET.pack(self._offsets[raw_hash]) for raw_hash in hashes]
+            + [pack_checksum]
+        )
+        idx += hashlib.sha1(idx).digest()
+
+        base = os.path.join(PACK_DIR, f"pack-{pack_checksum.hex()}")
+        os.replace(self._tmp_path, base + ".pack")
+
+        # The index goes last: readers only look for packs through it
+        tmp_idx = base + ".idx.tmp"
+        with open(tmp_idx, "wb") as f:
+            f.write(idx)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_idx, base + ".idx")
+
+        logger.info("Wrote pack %s with %s objects", base, len(hashes))
+        return base + ".idx"
+
+
+class PackStore:
+
+    # Packs opened by this process, loaded on first use
+    _packs: Optional[List[Pack]] = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def packs() -> List[Pack]:
+        if PackStore._packs is None:
+            with PackStore._lock:
+                if PackStore._packs is None:
+                    packs = []
+                    if os.path.isdir(PACK_DIR):
+                        for name in sorted(os.listdir(PACK_DIR)):
+                            if not (name.startswith("pack-") and name.endswith(".idx")):
+                                continue
+                            try:
+                                packs.append(Pack(os.path.join(PACK_DIR, name)))
+                            except (OSError, ValueError) as e:
+                                logger.error("Skipping unreadable pack %s: %s", name, e)
+                    PackStore._packs = packs
+        return PackStore._packs
+
+    @staticmethod
+    def reload():
+        for pack in PackStore._packs or []:
+            pack.close()
+        PackStore._packs = None
+        DeltaBaseCache.clear()
+
+    @staticmethod
+    def find(obj_hash: str) -> Optional[Pack]:
+        if len(obj_hash) != 2 * HASH_LEN:
+            return None
+        try:
+            bytes.fromhex(obj_hash)
+        except ValueError:
+            return None
+
+        for pack in PackStore.packs():
+            if pack.contains(obj_hash):
+                return pack
+        return None
+
+    @staticmethod
+    def contains(obj_hash: str) -> bool:
+        return PackStore.find(obj_hash) is not None
+
+    @staticmethod
+    def read(obj_hash: str) -> Optional[bytes]:
+        pack = PackStore.find(obj_hash)
+        return pack.read(obj_hash) if pack else None
@@ -0,0 +1,330 @@
+import mmap
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.file_utils import FileHandler
+from utils.trace_utils import Tracer
+from utils.constants import GIT_DIR, HEAD_FILE, HEADS_DIR, PACKED_REFS_FILE
+
+logger = LoggerUtil.setup_logger(__name__)
+
+HEADS_PREFIX = "refs/heads/"
+SYMREF_PREFIX = "ref: "
+PACKED_REFS_HEADER = b"# pack-refs with: sorted\n"
+LOCK_SUFFIX = ".lock"
+HASH_HEX_LEN = 40
+# Expected old value of a ref that must not exist yet
+ZERO_HASH = "0" * HASH_HEX_LEN
+INVALID_REF_CHARS = set(" ~^:?*[\\\x7f") | {chr(c) for c in range(32)}
+
+
+# "<hash> <name>" lines sorted by name, after a header, mapped rather
+# than parsed: one ref is found by binary search over the lines and a
+# prefix is listed by reading only its own lines
+class PackedRefs:
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+
+        if data[:len(PACKED_REFS_HEADER)] == PACKED_REFS_HEADER:
+            self._data = data
+            self._start = len(PACKED_REFS_HEADER)
+        else:
+            # Not written by pack_refs(), so not known to be sorted
+            logger.warning("%s is not sorted, reading all of it", path)
+            lines = [
+                line for line in bytes(data).splitlines() if line[:1] not in (b"#", b"^", b"")
+            ]
+            lines.sort(key=lambda line: line[HASH_HEX_LEN + 1:])
+            self._data = b"".join(line + b"\n" for line in lines)
+            self._start = 0
+
+    def _line(self, start: int) -> Tuple[bytes, str, int]:
+        end = self._data.find(b"\n", start)
+        if end < 0:
+            end = len(self._data)
+        line = self._data[start:end]
+        return line[HASH_HEX_LEN + 1:], line[:HASH_HEX_LEN].decode("ascii"), end + 1
+
+    # Offset of the first line whose name is not below key
+    def _lower_bound(self, key: bytes) -> int:
+        lo, hi = self._start, len(self._data)
+        while lo < hi:
+            mid = self._data.rfind(b"\n", lo, (lo + hi) // 2) + 1 or lo
+            name, _, next_line = self._line(mid)
+            if name < key:
+                lo = next_line
+            else:
+                hi = mid
+        return lo
+
+    def find(self, name: str) -> Optional[str]:
+        key = name.encode("utf-8")
+        start = self._lower_bound(key)
+        if start >= len(self._data):
+            return None
+        found, obj_hash, _ = self._line(start)
+        return obj_hash if found == key else None
+
+    # (name, hash) of the refs under prefix, in order
+    def iter(self, prefix: str = "") -> Iterator[Tuple[str, str]]:
+        key = prefix.encode("utf-8")
+        start = self._lower_bound(key)
+        while start < len(self._data):
+            name, obj_hash, start = self._line(start)
+            if not name.startswith(key):
+                return
+            yield name.decode("utf-8"), obj_hash
+
+
+# Held while a ref, the index or another repository file is rewritten:
+# <path>.lock is created exclusively, so only one process changes the
+# file at a time, and the new content is renamed over it, so readers
+# see the old value or the new one
+class RefLock:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = path + LOCK_SUFFIX
+        self._fd = None
+
+    def __enter__(self) -> "RefLock":
+        FileHandler.ensure_directory_exists(os.path.dirname(self.path))
+        try:
+            self._fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            raise ValueError(
+                f"Unable to create {self.lock_path}: another questgit process "
+                "may be running, or remove the file if one crashed"
+            )
+        except OSError as e:
+            raise ValueError(f"Cannot lock {self.path}: {e}")
+        return self
+
+    def commit(self, content: bytes):
+        view = memoryview(content)
+        while view:
+            view = view[os.write(self._fd, view):]
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        try:
+            os.replace(self.lock_path, self.path)
+        except BaseException:
+            os.remove(self.lock_path)
+            raise
+
+    def __exit__(self, *exc_info):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.remove(self.lock_path)
+        return False
+
+
+# Branches under refs/heads, one loose file per ref as written, and
+# packed-refs holding many refs in one sorted file; a loose ref
+# overrides a packed one of the same name. pack_refs() moves loose refs
+# into packed-refs so that listing them opens one file. The mapped
+# packed-refs is kept for the process and reopened when the file is
+# replaced.
+class RefStore:
+
+    _packed: Optional[PackedRefs] = None
+
+    @staticmethod
+    def _path(name: str) -> str:
+        return os.path.join(GIT_DIR, *name.split("/"))
+
+    @staticmethod
+    def _packed_refs() -> Optional[PackedRefs]:
+        try:
+            st = os.stat(PACKED_REFS_FILE)
+        except FileNotFoundError:
+            RefStore._packed = None
+            return None
+
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if RefStore._packed is None or RefStore._packed.stamp != stamp:
+            RefStore._packed = PackedRefs(PACKED_REFS_FILE)
+            Tracer.count("packed-refs loaded")
+        return RefStore._packed
+
+    @staticmethod
+    def _read_loose(name: str) -> Optional[str]:
+        try:
+            with open(RefStore._path(name), "r", encoding="utf-8") as f:
+                value = f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+        Tracer.count("files read")
+        # An empty file is a branch without commits yet, as init writes
+        return value or None
+
+    # Commit hash of a full ref name such as refs/heads/master
+    @staticmethod
+    def read(name: str) -> Optional[str]:
+        value = RefStore._read_loose(name)
+        if value is not None:
+            return value
+        packed = RefStore._packed_refs()
+        return packed.find(name) if packed is not None else None
+
+    # (ref HEAD points to, or None when it holds a commit; HEAD's commit)
+    @staticmethod
+    def head() -> Tuple[Optional[str], Optional[str]]:
+        content = (FileHandler.read(HEAD_FILE) or "").strip()
+        if content.startswith(SYMREF_PREFIX):
+            target = content[len(SYMREF_PREFIX):].strip()
+            return target, RefStore.read(target)
+        return None, content or None
+
+    # Commit hash of HEAD, a branch name or a full ref name
+    @staticmethod
+    def resolve(name: str) -> Optional[str]:
+        if name == "HEAD":
+            return RefStore.head()[1]
+        if name.startswith("refs/"):
+            return RefStore.read(name)
+        return RefStore.read(HEADS_PREFIX + name)
+
+    # (name, hash) of every ref under prefix, sorted by name. Loose refs
+    # are found by listing their directories; only they are opened.
+    @staticmethod
+    def list(prefix: str = HEADS_PREFIX) -> List[Tuple[str, str]]:
+        packed = RefStore._packed_refs()
+        refs = dict(packed.iter(prefix)) if packed is not None else {}
+        refs.update(RefStore._loose_refs(prefix))
+        return sorted(refs.items())
+
+    @staticmethod
+    def _loose_refs(prefix: str) -> Dict[str, str]:
+        refs = {}
+        base = RefStore._path(prefix.rstrip("/"))
+        for dir_path, _, names in os.walk(base):
+            rel_dir = os.path.relpath(dir_path, GIT_DIR).replace(os.sep, "/")
+            for file_name in names:
+                if file_name.endswith(LOCK_SUFFIX):
+                    continue
+                name = f"{rel_dir}/{file_name}"
+                value = RefStore._read_loose(name) if name.startswith(prefix) else None
+                if value is not None:
+                    refs[name] = value
+        return refs
+
+    @staticmethod
+    def _check_old(name: str, old_hash: Optional[str]):
+        if old_hash is None:
+            return
+        current = RefStore.read(name)
+        if (current or ZERO_HASH) != old_hash:
+            if old_hash == ZERO_HASH:
+                raise ValueError(f"{name} already exists")
+            raise ValueError(f"{name} is at {current or 'nothing'}, expected {old_hash}")
+
+    # Points name at new_hash if it still points at old_hash: ZERO_HASH
+    # when it must not exist yet, None to skip the check
+    @staticmethod
+    def update(name: str, new_hash: str, old_hash: Optional[str] = None):
+        with RefLock(RefStore._path(name)) as lock:
+            RefStore._check_old(name, old_hash)
+            lock.commit(f"{new_hash}\n".encode("ascii"))
+        logger.info("Updated %s to %s", name, new_hash)
+
+    @staticmethod
+    def delete(name: str, old_hash: Optional[str] = None):
+        path = RefStore._path(name)
+        with RefLock(path):
+            RefStore._check_old(name, old_hash)
+            packed = RefStore._packed_refs()
+            if packed is not None and packed.find(name) is not None:
+                with RefLock(PACKED_REFS_FILE) as packed_lock:
+                    packed = RefStore._packed_refs()
+                    refs = [ref for ref in packed.iter() if ref[0] != name]
+                    packed_lock.commit(RefStore._packed_content(refs))
+            if os.path.exists(path):
+                os.remove(path)
+        RefStore._remove_empty_dirs(os.path.dirname(path))
+        logger.info("Deleted %s", name)
+
+    @staticmethod
+    def _packed_content(refs: List[Tuple[str, str]]) -> bytes:
+        return PACKED_REFS_HEADER + "".join(
+            f"{obj_hash} {name}\n" for name, obj_hash in sorted(refs)
+        ).encode("utf-8")
+
+    # Removes empty directories from dir_path up to refs/heads
+    @staticmethod
+    def _remove_empty_dirs(dir_path: str):
+        heads_dir = os.path.normpath(HEADS_DIR)
+        while os.path.normpath(dir_path).startswith(heads_dir + os.sep):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                return
+            dir_path = os.path.dirname(dir_path)
+
+    # Writes every ref into packed-refs and removes the loose files that
+    # still hold what was packed. Returns the number of loose refs packed.
+    @staticmethod
+    @Tracer.traced("refs.pack")
+    def pack_refs() -> int:
+        with RefLock(PACKED_REFS_FILE) as lock:
+            packed = RefStore._packed_refs()
+            refs = dict(packed.iter()) if packed is not None else {}
+            loose = RefStore._loose_refs("refs/")
+            refs.update(loose)
+            lock.commit(RefStore._packed_content(list(refs.items())))
+
+        for name, value in loose.items():
+            path = RefStore._path(name)
+            try:
+                with RefLock(path):
+                    if RefStore._read_loose(name) == value:
+                        os.remove(path)
+            except ValueError as e:
+                logger.warning("Leaving %s loose: %s", name, e)
+                continue
+            RefStore._remove_empty_dirs(os.path.dirname(path))
+
+        logger.info("Packed %s loose refs, %s refs in packed-refs", len(loose), len(refs))
+        return len(loose)
+
+    # The rules git applies to ref names, so every name is a usable path
+    @staticmethod
+    def check_branch_name(branch: str):
+        parts = branch.split("/")
+        if (
+            not branch
+            or branch == "HEAD"
+            or branch.startswith("-")
+            or branch.endswith(".")
+            or ".." in branch
+            or "@{" in branch
+            or any(c in INVALID_REF_CHARS for c in branch)
+            or any(not part or part.startswith(".") or part.endswith(LOCK_SUFFIX) for part in parts)
+        ):
+            raise ValueError(f"Not a valid branch name: {branch}")
+
+    # A ref can't sit where another one needs a directory, or the other
+    # way round
+    @staticmethod
+    def _check_conflicts(name: str):
+        parts = name.split("/")
+        for end in range(len(HEADS_PREFIX.split("/")), len(parts)):
+            parent = "/".join(parts[:end])
+            if RefStore.read(parent) is not None:
+                raise ValueError(f"Cannot create {name}: {parent} exists")
+        if RefStore.list(name + "/"):
+            raise ValueError(f"Cannot create {name}: refs under {name}/ exist")
+
+    @staticmethod
+    def create_branch(branch: str, commit_hash: str):
+        RefStore.check_branch_name(branch)
+        name = HEADS_PREFIX + branch
+        RefStore._check_conflicts(name)
+        RefStore.update(name, commit_hash, ZERO_HASH)
@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
+from .objects import ObjectStore
+
+logger = LoggerUtil.setup_logger(__name__)
+
+# (filepath, blob hash or None on failure, objects written, objects deduplicated)
+StageResult = Tuple[str, Optional[str], int, int]
+
+
+class Staging:
+
+    # Below this many files a process pool costs more than it saves
+    MIN_PARALLEL_FILES = 256
+    CHUNKS_PER_WORKER = 8
+
+    @staticmethod
+    def default_jobs() -> int:
+        return os.cpu_count() or 1
+
+    # Runs in worker processes: read, hash, compress and write one file.
+    # Errors are returned rather than raised so one bad file doesn't abort
+    # the whole batch.
+    @staticmethod
+    def stage_file(filepath: str) -> StageResult:
+        written = ObjectStore.objects_written
+        deduplicated = ObjectStore.objects_deduplicated
+        try:
+            blob_hash = ObjectStore.store_blob(filepath)
+        except Exception as e:
+            logger.error("Error processing %s: %s", filepath, e)
+            blob_hash = None
+
+        return (
+            filepath,
+            blob_hash,
+            ObjectStore.objects_written - written,
+            ObjectStore.objects_deduplicated - deduplicated,
+        )
+
+    # Results come back in the order of filepaths whatever the job count,
+    # so the caller can apply them to the index deterministically
+    @staticmethod
+    @Tracer.traced("stage")
+    def stage_files(filepaths: List[str], jobs: int) -> List[StageResult]:
+        with ObjectStore.batch():
+            return Staging._stage_files(filepaths, jobs)
+
+    @staticmethod
+    def _stage_files(filepaths: List[str], jobs: int) -> List[StageResult]:
+        if jobs <= 1 or len(filepaths) < Staging.MIN_PARALLEL_FILES:
+            results = [Staging.stage_file(filepath) for filepath in filepaths]
+        elif not ObjectStore.backend().multiprocess:
+            # The backend's one connection is shared by threads instead;
+            # hashing and deflating release the GIL, so they still overlap
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(Staging.stage_file, filepaths))
+        else:
+            chunksize = max(1, len(filepaths) // (jobs * Staging.CHUNKS_PER_WORKER))
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(
+                    executor.map(Staging.stage_file, filepaths, chunksize=chunksize)
+                )
+
+            # Worker counters don't reach this process on their own
+            for _, _, written, deduplicated in results:
+                ObjectStore.objects_written += written
+                ObjectStore.objects_deduplicated += deduplicated
+                LoggerUtil.count("objects written", written)
+                LoggerUtil.count("objects deduplicated", deduplicated)
+
+        return results
@@ -0,0 +1,136 @@
+import os
+import stat
+from typing import Dict, Iterable, List, Optional, Set
+
+from utils.logger_utils import LoggerUtil
+from utils.trace_utils import Tracer
+from utils.constants import GIT_DIR, IGNORE_FILE
+from .repository import Repository
+from .ignore import IgnoreCache
+from .fsmonitor import FSMonitor, FSMonitorState
+
+logger = LoggerUtil.setup_logger(__name__)
+
+
+# Result of looking at the working tree for add and status
+class WorkTreeScan:
+    def __init__(self):
+        # path -> lstat of files worth checking against the index: every
+        # file after a full scan, only possibly changed ones otherwise
+        self.files: Dict[str, os.stat_result] = {}
+        # Tracked paths that are gone
+        self.missing: Set[str] = set()
+        # Every file that is neither tracked nor ignored
+        self.untracked: Set[str] = set()
+        self.full = True
+        self._state: Optional[FSMonitorState] = None
+
+    # Records what the caller found, once the index is saved. dirty are the
+    # tracked paths that still don't match the index; the next scan checks
+    # them again whether or not the daemon reports them.
+    def save_state(self, index, dirty: Iterable[str]):
+        index.fsmonitor_managed = False
+        if self._state is None:
+            return
+        self._state.index_stamp = index.file_stamp
+        self._state.dirty = set(dirty)
+        self._state.untracked = set(self.untracked)
+        self._state.save()
+
+
+class WorkTree:
+
+    # Asks the fsmonitor daemon, when enabled and running, which paths
+    # changed since the last scan. Falls back to walking everything when
+    # there is no usable answer.
+    @staticmethod
+    @Tracer.traced("worktree.scan")
+    def scan(index) -> WorkTreeScan:
+        scan = WorkTreeScan()
+        if FSMonitor.enabled():
+            state = FSMonitorState.load()
+            if state is not None and state.index_stamp != index.file_stamp:
+                state = None
+            reply = FSMonitor.query(state.token if state else None)
+            if reply is None:
+                logger.info("fsmonitor not running, scanning the whole working tree")
+                FSMonitorState.invalidate()
+            else:
+                token, changed = reply
+                scan._state = FSMonitorState(token, None, set(), set())
+                index.fsmonitor_managed = True
+                if state is not None and changed is not None:
+                    if WorkTree._scan_changed(index, scan, state, changed):
+                        scan.full = False
+                        return scan
+
+        WorkTree._scan_all(index, scan)
+        return scan
+
+    @staticmethod
+    def _scan_all(index, scan: WorkTreeScan):
+        scan.files = dict(Repository.walk_files())
+        for path in scan.files:
+            if not index.get_entry(path):
+                scan.untracked.add(path)
+
+        # Tracked files stay tracked even once an ignore pattern matches
+        # them, so the walker not listing them doesn't mean they are gone
+        for path in index.sorted_paths():
+            if path not in scan.files:
+                WorkTree._check_tracked(scan, path)
+
+    @staticmethod
+    def _check_tracked(scan: WorkTreeScan, path: str):
+        Tracer.count("files stat'ed")
+        try:
+            scan.files[path] = os.lstat(path)
+        except FileNotFoundError:
+            scan.missing.add(path)
+        except OSError as e:
+            logger.error("Error reading %s: %s", path, e)
+
+    # Looks only at paths the daemon reported, plus those the last scan
+    # left dirty or untracked. Returns False when a full scan is needed.
+    @staticmethod
+    def _scan_changed(index, scan: WorkTreeScan, state: FSMonitorState, changed: List[str]) -> bool:
+        for path in changed:
+            # A changed ignore file can affect any path below it
+            if os.path.basename(path) == IGNORE_FILE or path.startswith(GIT_DIR + os.sep):
+                return False
+
+        ignored = IgnoreCache(Repository.IGNORED_DIRS)
+        for path in set(changed) | state.dirty | state.untracked:
+            Tracer.count("files stat'ed")
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                st = None
+            except OSError as e:
+                logger.error("Error reading %s: %s", path, e)
+                continue
+
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                # A new or moved directory: everything in it is a candidate
+                if not ignored.is_ignored(path, True):
+                    for filepath, file_st in Repository.walk_files(path):
+                        scan.files[filepath] = file_st
+                for filepath in index.paths_under(path):
+                    if filepath not in scan.files:
+                        WorkTree._check_tracked(scan, filepath)
+                continue
+
+            tracked = index.get_entry(path) is not None
+            if st is None:
+                if tracked:
+                    scan.missing.add(path)
+                # The path may have been a directory
+                for filepath in index.paths_under(path):
+                    WorkTree._check_tracked(scan, filepath)
+            elif tracked or not ignored.is_ignored(path, False):
+                scan.files[path] = st
+
+        for path in scan.files:
+            if index.get_entry(path) is None:
+                scan.untracked.add(path)
+        return True
@@ -4,6 +4,8 @@ setup(
     name="questgit",
     version="0.1",
     packages=find_packages(),
+    # bisect with key=, used by the index, pack and commit-graph lookups
+    python_requires=">=3.10",
     entry_points={
         "console_scripts": [
             "questgit = cli.main:main",
@@ -0,0 +1,34 @@
+import zlib
+from typing import Iterable, Iterator
+
+from utils.constants import STREAM_CHUNK_SIZE
+from utils.trace_utils import Tracer
+
+
+class CompressUtil:
+
+    # Inflates a zlib stream piece by piece. Each output piece is bounded,
+    # so a small, highly compressed input can't expand into one huge buffer.
+    @staticmethod
+    def inflate_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        decompressor = zlib.decompressobj()
+        inflated = 0
+        for chunk in chunks:
+            data = decompressor.decompress(chunk, STREAM_CHUNK_SIZE)
+            if data:
+                inflated += len(data)
+                yield data
+            while decompressor.unconsumed_tail:
+                data = decompressor.decompress(
+                    decompressor.unconsumed_tail, STREAM_CHUNK_SIZE
+                )
+                if data:
+                    inflated += len(data)
+                    yield data
+        tail = decompressor.flush()
+        if tail:
+            inflated += len(tail)
+            yield tail
+        Tracer.count("bytes inflated", inflated)
+        if not decompressor.eof:
+            raise zlib.error("Truncated zlib stream")
@@ -2,13 +2,25 @@ import os
 
 GIT_DIR = ".questgit"
 OBJECTS_DIR = os.path.join(GIT_DIR, "objects")
+PACK_DIR = os.path.join(OBJECTS_DIR, "pack")
+OBJECT_DB_FILE = os.path.join(OBJECTS_DIR, "objects.db")
+LOOSE_NAMES_FILE = os.path.join(OBJECTS_DIR, "info", "loose-names")
+COMMIT_GRAPH_FILE = os.path.join(OBJECTS_DIR, "info", "commit-graph")
 REFS_DIR = os.path.join(GIT_DIR, "refs")
 INDEX_FILE = os.path.join(GIT_DIR, "index")
 HEADS_DIR = os.path.join(REFS_DIR, "heads")
 HEAD_FILE = os.path.join(GIT_DIR, "HEAD")
 MASTER_FILE = os.path.join(HEADS_DIR, "master")
+PACKED_REFS_FILE = os.path.join(GIT_DIR, "packed-refs")
+EXCLUDE_FILE = os.path.join(GIT_DIR, "info", "exclude")
+IGNORE_FILE = ".questgitignore"
+FSMONITOR_SOCKET = os.path.join(GIT_DIR, "fsmonitor.sock")
+FSMONITOR_STATE_FILE = os.path.join(GIT_DIR, "fsmonitor-state")
 
 BLOB_DIR_LEN = 2
 BLOB_HASH_LEN = 38
 
 REQUIRED_DIRS = [OBJECTS_DIR, REFS_DIR, HEADS_DIR]
+
+# Files and objects are streamed in chunks of this size
+STREAM_CHUNK_SIZE = 64 * 1024
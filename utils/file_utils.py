@@ -1,7 +1,9 @@
 import os
-from typing import Optional, Dict
+from typing import Optional, Dict, Iterator
 
 from utils.logger_utils import LoggerUtil
+from utils.constants import STREAM_CHUNK_SIZE
+from utils.trace_utils import Tracer
 
 
 logger = LoggerUtil.setup_logger(__name__)
@@ -12,7 +14,7 @@ class FileHandler:
     @staticmethod
     def read(filepath: str) -> Optional[str]:
         if not os.path.isfile(filepath):
-            logger.warning(f"File not found: {filepath}")
+            logger.warning("File not found: %s", filepath)
             return None
         # with open(filepath, "r", encoding="utf-8") as f:
         #         # print(".................",f.read())
@@ -20,75 +22,95 @@ class FileHandler:
         try:
             with open(filepath, "r", encoding="utf-8") as f:
                 # print(".................",f.read())
-                return f.read()
+                content = f.read()
+            Tracer.count("files read")
+            return content
         except IOError as e:
-            logger.error(f"Error reading file {filepath} : {e}")
+            logger.error("Error reading file %s : %s", filepath, e)
             return None
 
     @staticmethod
     def read_binary(filepath: str) -> Optional[bytes]:
         if not os.path.isfile(filepath):
-            logger.warning(f"File not found: {filepath}")
+            logger.warning("File not found: %s", filepath)
             return None
         try:
             with open(filepath, "rb") as f:
-                return f.read()
+                content = f.read()
+            Tracer.count("files read")
+            Tracer.count("bytes read", len(content))
+            return content
         except IOError as e:
-            logger.error(f"Error reading file {filepath}: {e}")
+            logger.error("Error reading file %s: %s", filepath, e)
             return None
 
+    @staticmethod
+    def iter_chunks(
+        filepath: str, chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        with open(filepath, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
     @staticmethod
     def write(filepath: str, content: str):
         try:
             with open(filepath, "w", encoding="utf-8") as f:
                 f.write(content)
-            logger.info(f"Successfully worte to file: {filepath}")
+            logger.debug("Successfully worte to file: %s", filepath)
+            LoggerUtil.count("files written")
         except IOError as e:
-            logger.error(f"Error writing to file {filepath}: {e}")
+            logger.error("Error writing to file %s: %s", filepath, e)
 
     @staticmethod
     def write_binary(filepath: str, content: bytes):
         try:
             with open(filepath, "wb") as f:
                 f.write(content)
-            logger.info(f"Successfully worte to file: {filepath}")
+            Tracer.count("bytes written", len(content))
+            logger.debug("Successfully worte to file: %s", filepath)
+            LoggerUtil.count("files written")
         except IOError as e:
-            logger.error(f"Error writing to file {filepath}: {e}")
+            logger.error("Error writing to file %s: %s", filepath, e)
 
     @staticmethod
     def append(filepath, content):
         try:
             with open(filepath, "a", encoding="utf-8") as f:
                 f.write(content, "\n")
-            logger.info(f"Successfully appended to file: {filepath}")
+            logger.debug("Successfully appended to file: %s", filepath)
         except IOError as e:
-            logger.error(f"Error appending to file {filepath}: {e}")
+            logger.error("Error appending to file %s: %s", filepath, e)
 
     @staticmethod
     def append_binary(filepath: str, content: str):
         try:
             with open(filepath, "ab") as f:
                 f.write(content)
-            logger.info(f"Successfully appended to file: {filepath}")
+            logger.debug("Successfully appended to file: %s", filepath)
         except IOError as e:
-            logger.error(f"Error appending to file {filepath}: {e}")
+            logger.error("Error appending to file %s: %s", filepath, e)
             return None
 
     @staticmethod
     def ensure_directory_exists(directory):
         try:
             os.makedirs(directory, exist_ok=True)
-            logger.info(f"Directory ensured: {directory}")
+            logger.debug("Directory ensured: %s", directory)
+            LoggerUtil.count("directories ensured")
         except OSError as e:
-            logger.error(f"Error creating directory {directory}: {e}")
+            logger.error("Error creating directory %s: %s", directory, e)
 
     @staticmethod
     def ensure_filepath_exists(filepath):
         try:
             open(filepath, "a").close()
-            logger.info(f"File ensured: {filepath}")
+            logger.debug("File ensured: %s", filepath)
         except IOError as e:
-            logger.error(f"Error ensuring file {filepath}: {e}")
+            logger.error("Error ensuring file %s: %s", filepath, e)
 
     @staticmethod
     def read_config(filepath: str) -> Dict[str, str]:
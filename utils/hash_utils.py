@@ -1,5 +1,7 @@
 import hashlib
 from utils.logger_utils import LoggerUtil
+from utils.file_utils import FileHandler
+from utils.trace_utils import Tracer
 
 logger = LoggerUtil.setup_logger(__name__)
 
@@ -12,7 +14,29 @@ class HashCalculate:
             logger.error("Hash's content is empty or none.")
             raise ValueError("Content connot be empty or none.")
 
-        hash_digested = hashlib.sha1(content.encode()).hexdigest()
-        logger.info(f"Hash calculated successfully: {hash_digested}.")
+        data = content.encode()
+        Tracer.count("bytes hashed", len(data))
+        hash_digested = hashlib.sha1(data).hexdigest()
+        logger.debug("Hash calculated successfully: %s.", hash_digested)
+        LoggerUtil.count("hashes calculated")
 
         return hash_digested
+
+    @staticmethod
+    def calculate_sha1_bytes(content: bytes) -> str:
+        Tracer.count("bytes hashed", len(content))
+        return hashlib.sha1(content).hexdigest()
+
+    @staticmethod
+    def calculate_file_sha1(filepath: str) -> str:
+        sha1 = hashlib.sha1()
+        size = 0
+        for chunk in FileHandler.iter_chunks(filepath):
+            sha1.update(chunk)
+            size += len(chunk)
+        Tracer.count("bytes hashed", size)
+
+        hash_digested = sha1.hexdigest()
+        logger.debug("Hash calculated successfully: %s.", hash_digested)
+        LoggerUtil.count("hashes calculated")
+        return hash_digested
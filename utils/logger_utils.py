@@ -1,31 +1,107 @@
+import atexit
 import logging
 import os
+import threading
+from typing import Dict
+
+from utils.trace_utils import Tracer
+
+LEVEL_ENV = "QUESTGIT_LOG_LEVEL"
+
+
+# Opens the log file, creating its directory, on the first record rather
+# than when the logger is set up, so commands that log nothing touch no
+# files
+class LazyFileHandler(logging.FileHandler):
+
+    def __init__(self, filename: str):
+        super().__init__(filename, encoding="utf-8", delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+# Hands records to a QueueListener thread that writes them to the log
+# file, so a command never waits on the disk to log. logging.handlers is
+# imported, and the thread started, only once the first record arrives.
+class BackgroundHandler(logging.Handler):
+
+    def __init__(self, target: logging.Handler):
+        super().__init__()
+        self.target = target
+        self._queue_handler = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _start(self):
+        import logging.handlers
+        import queue
+
+        log_queue = queue.SimpleQueue()
+        self._queue_handler = logging.handlers.QueueHandler(log_queue)
+        # Records never leave this process, so they are queued as they are
+        # and their messages are formatted on the listener thread
+        self._queue_handler.prepare = lambda record: record
+        self._listener = logging.handlers.QueueListener(log_queue, self.target)
+        self._listener.start()
+
+    def emit(self, record: logging.LogRecord):
+        # Worker processes forked from this one have no listener thread
+        if os.getpid() != self._pid:
+            self.target.handle(record)
+            return
+        # Several threads may log the first record at once; only one of
+        # them may start the listener
+        if self._listener is None:
+            with self._start_lock:
+                if self._listener is None:
+                    self._start()
+        self._queue_handler.emit(record)
+
+    # Waits for queued records to be written
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
 
 
 class LoggerUtil:
 
     LOG_DIR = "logs"
     LOG_FILE = os.path.join(LOG_DIR, "app.log")
+    DEFAULT_LEVEL = logging.INFO
+
+    # One handler shared by every module's logger
+    _handler = None
+    _loggers: Dict[str, logging.Logger] = {}
+    _level = None
+
+    # Per-object events are counted rather than logged one by one; the
+    # totals are logged once when the process exits
+    _counters: Dict[str, int] = {}
+    _counters_lock = threading.Lock()
 
     @classmethod
     def setup_logger(cls, name):
 
-        os.makedirs(cls.LOG_DIR, exist_ok=True)
-
         logger = logging.getLogger(name)
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(cls.level())
 
         if logger.hasHandlers():
             return logger
 
-        log_format = logging.Formatter(
-            "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
-        )
+        if cls._handler is None:
+            log_format = logging.Formatter(
+                "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+            )
 
-        # save
-        file_handler = logging.FileHandler(cls.LOG_FILE, encoding="utf-8")
-        file_handler.setFormatter(log_format)
-        file_handler.setLevel(logging.DEBUG)
+            # save
+            file_handler = LazyFileHandler(cls.LOG_FILE)
+            file_handler.setFormatter(log_format)
+            cls._handler = BackgroundHandler(file_handler)
+            atexit.register(cls._shutdown)
 
         # Display
         # console_handler = logging.StreamHandler()
@@ -33,7 +109,45 @@ class LoggerUtil:
         # console_handler.setLevel(logging.INFO)
 
         if not logger.hasHandlers():  # Prevent duplicate handlers
-            logger.addHandler(file_handler)
+            logger.addHandler(cls._handler)
             # logger.addHandler(console_handler)
 
+        cls._loggers[name] = logger
         return logger
+
+    # Level from QUESTGIT_LOG_LEVEL, else INFO
+    @classmethod
+    def level(cls) -> int:
+        if cls._level is None:
+            name = os.environ.get(LEVEL_ENV, "").upper()
+            level = logging.getLevelName(name) if name else cls.DEFAULT_LEVEL
+            cls._level = level if isinstance(level, int) else cls.DEFAULT_LEVEL
+        return cls._level
+
+    # Accepts a level name such as "debug" or "warning"; returns False if
+    # it is not one
+    @classmethod
+    def set_level(cls, name: str) -> bool:
+        level = logging.getLevelName(name.upper())
+        if not isinstance(level, int):
+            return False
+        cls._level = level
+        for logger in cls._loggers.values():
+            logger.setLevel(level)
+        return True
+
+    @classmethod
+    def count(cls, event: str, amount: int = 1):
+        Tracer.count(event, amount)
+        with cls._counters_lock:
+            cls._counters[event] = cls._counters.get(event, 0) + amount
+
+    @classmethod
+    def _shutdown(cls):
+        if cls._counters:
+            summary = ", ".join(
+                f"{event}={amount}" for event, amount in sorted(cls._counters.items())
+            )
+            cls.setup_logger(__name__).info("Event counts: %s", summary)
+            cls._counters.clear()
+        cls._handler.stop()
@@ -0,0 +1,188 @@
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, TextIO, Tuple
+
+TRACE_ENV = "QUESTGIT_TRACE"
+# Code flag of generator functions, as inspect.CO_GENERATOR
+CO_GENERATOR = 0x20
+
+# (phase, start ns, end ns, thread id)
+SpanRecord = Tuple[str, int, int, int]
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        Tracer.spans.append(
+            (self.name, self.start, time.perf_counter_ns(), threading.get_ident())
+        )
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+# Per-phase timings and counters for one process. Off by default; while
+# off, span() hands back a shared no-op context manager and count()
+# returns straight away, so instrumented code pays one attribute check.
+# Turned on by QUESTGIT_TRACE or `questgit --trace`: "summary" (or "1")
+# prints a table on stderr at exit, a path ending in .json gets a Chrome
+# trace-event file instead (chrome://tracing, Perfetto).
+class Tracer:
+
+    enabled = False
+    # None for the summary table, else where to write the Chrome trace
+    output: Optional[str] = None
+    spans: List[SpanRecord] = []
+    counters: Dict[str, int] = {}
+    _lock = threading.Lock()
+    _origin = time.perf_counter_ns()
+    _registered = False
+
+    @staticmethod
+    def configure(value: Optional[str]) -> bool:
+        value = (value or "").strip()
+        if value.lower() in ("", "0", "false", "off", "no"):
+            Tracer.enabled = False
+            return True
+        if value.lower() in ("1", "true", "on", "yes", "summary"):
+            Tracer.output = None
+        elif value.endswith(".json"):
+            Tracer.output = value
+        else:
+            return False
+
+        Tracer.enabled = True
+        if not Tracer._registered:
+            atexit.register(Tracer.finish)
+            Tracer._registered = True
+        return True
+
+    @staticmethod
+    def span(name: str):
+        return _Span(name) if Tracer.enabled else _NO_SPAN
+
+    # Decorator timing every call as one span of phase name. Generator
+    # functions are timed from the first item to the last, including the
+    # time the caller spends between items.
+    @staticmethod
+    def traced(name: str) -> Callable:
+        def decorate(func: Callable) -> Callable:
+            if func.__code__.co_flags & CO_GENERATOR:
+                @functools.wraps(func)
+                def generator_wrapper(*args, **kwargs):
+                    if not Tracer.enabled:
+                        return (yield from func(*args, **kwargs))
+                    with _Span(name):
+                        return (yield from func(*args, **kwargs))
+                return generator_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not Tracer.enabled:
+                    return func(*args, **kwargs)
+                with _Span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    @staticmethod
+    def count(name: str, amount: int = 1):
+        if not Tracer.enabled:
+            return
+        with Tracer._lock:
+            Tracer.counters[name] = Tracer.counters.get(name, 0) + amount
+
+    @staticmethod
+    def summary(out: TextIO):
+        # phase -> [calls, total ns]
+        phases: Dict[str, List[int]] = {}
+        for name, start, end, _ in Tracer.spans:
+            totals = phases.setdefault(name, [0, 0])
+            totals[0] += 1
+            totals[1] += end - start
+
+        print(f"{'phase':<28} {'calls':>8} {'total ms':>10} {'mean ms':>9}", file=out)
+        for name, (calls, total) in sorted(phases.items(), key=lambda item: -item[1][1]):
+            print(
+                f"{name:<28} {calls:>8} {total / 1e6:>10.2f} {total / calls / 1e6:>9.3f}",
+                file=out,
+            )
+        if Tracer.counters:
+            print(f"\n{'counter':<28} {'value':>12}", file=out)
+            for name, value in sorted(Tracer.counters.items()):
+                print(f"{name:<28} {value:>12}", file=out)
+
+    # Complete ("X") events for the spans, one counter ("C") event with
+    # the totals at the end
+    @staticmethod
+    def chrome_events() -> List[dict]:
+        pid = os.getpid()
+        events = [
+            {
+                "name": name,
+                "cat": "questgit",
+                "ph": "X",
+                "ts": (start - Tracer._origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, start, end, tid in Tracer.spans
+        ]
+        if Tracer.counters:
+            end = max((span[2] for span in Tracer.spans), default=Tracer._origin)
+            events.append(
+                {
+                    "name": "counters",
+                    "ph": "C",
+                    "ts": (end - Tracer._origin) / 1000,
+                    "pid": pid,
+                    "args": dict(Tracer.counters),
+                }
+            )
+        return events
+
+    @staticmethod
+    def finish():
+        if not Tracer.enabled:
+            return
+        Tracer.enabled = False
+        if Tracer.output is None:
+            print(file=sys.stderr)
+            Tracer.summary(sys.stderr)
+            return
+        import json
+
+        try:
+            with open(Tracer.output, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": Tracer.chrome_events(), "displayTimeUnit": "ms"}, f)
+            print(f"Trace written to {Tracer.output}", file=sys.stderr)
+        except OSError as e:
+            print(f"Could not write trace to {Tracer.output}: {e}", file=sys.stderr)
+
+
+Tracer.configure(os.environ.get(TRACE_ENV))